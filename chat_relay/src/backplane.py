@@ -0,0 +1,297 @@
+import asyncio
+from dataclasses import dataclass, asdict
+from json import dumps, loads
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import unquote, urlparse
+from uuid import uuid4
+
+BACKPLANE_LOCAL = 'local'
+BACKPLANE_REDIS = 'redis'
+
+CHANNEL_PREFIX = 'chat:'
+RECONNECT_DELAY = 1 # seconds
+
+# Called with (channel, payloads) for the messages published on the
+# other nodes.
+Deliver = Callable[[str, List[str]], None]
+
+@dataclass
+class BackplaneStats:
+	published: int = 0
+	batches_out: int = 0
+	batches_in: int = 0
+	received: int = 0
+	# Published while not connected.
+	dropped: int = 0
+	reconnects: int = 0
+	errors: int = 0
+
+# Single process, there are no other nodes to forward the messages to.
+class LocalBackplane:
+
+	def __init__(self):
+		self.stats = BackplaneStats()
+
+	async def start(self, deliver: Deliver):
+		pass
+
+	async def stop(self):
+		pass
+
+	def subscribe(self, channel: str):
+		pass
+
+	def unsubscribe(self, channel: str):
+		pass
+
+	def publish(self, channel: str, payload: str):
+		self.stats.published += 1
+
+	def as_dict(self):
+		return {'mode': BACKPLANE_LOCAL, **asdict(self.stats)}
+
+class ResponseError(Exception):
+	pass
+
+def encode_command(*args) -> bytes:
+	parts = [ b"*%d\r\n" % len(args) ]
+	for arg in args:
+		if isinstance(arg, str):
+			arg = arg.encode()
+
+		parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+
+	return b''.join(parts)
+
+async def read_reply(reader: asyncio.StreamReader):
+	line = await reader.readline()
+	if not line:
+		raise ConnectionError("Connection closed.")
+
+	kind, rest = line[:1], line[1:-2]
+	if kind == b'+':
+		return rest.decode()
+	if kind == b'-':
+		raise ResponseError(rest.decode())
+	if kind == b':':
+		return int(rest)
+	if kind == b'$':
+		length = int(rest)
+		if length < 0:
+			return None
+
+		return (await reader.readexactly(length + 2))[:-2]
+	if kind == b'*':
+		length = int(rest)
+		if length < 0:
+			return None
+
+		return [ await read_reply(reader) for _ in range(length) ]
+
+	raise ResponseError(f"Unexpected reply: {line}")
+
+# Shares channels between the relay replicas through a redis (or any server
+# speaking the same protocol) pub/sub. Messages published by the local
+# connections are delivered locally right away (by the server) and
+# forwarded to the other nodes in batches: everything published on a channel
+# during batch_window goes out as a single PUBLISH (window is skipped if
+# batch_size messages are already waiting). Node only subscribes to the
+# channels it has connections in and ignores its own batches.
+# Uses two connections, subscribed one can't be used for publishing.
+class RedisBackplane:
+
+	def __init__(self, url: str, batch_window: float, batch_size: int):
+		parsed = urlparse(url)
+		self.host = parsed.hostname
+		self.port = parsed.port or 6379
+		# redis://[[username]:password@]host:port, username requires ACLs (6+).
+		self.username = unquote(parsed.username) if parsed.username else None
+		self.password = unquote(parsed.password) if parsed.password is not None else None
+
+		self.batch_window = batch_window
+		self.batch_size = batch_size
+
+		self.node_id = uuid4().hex
+		self.channels: Set[str] = set()
+		self.outbox: Dict[str, List[str]] = {}
+		self.outbox_len = 0
+		self.outbox_ready = asyncio.Event()
+
+		self.deliver: Deliver = None
+		self.pub_writer: Optional[asyncio.StreamWriter] = None
+		self.sub_writer: Optional[asyncio.StreamWriter] = None
+
+		self.stats = BackplaneStats()
+		self.tasks: List[asyncio.Task] = []
+
+	async def start(self, deliver: Deliver):
+		self.deliver = deliver
+		self.tasks.append(asyncio.create_task(self.connection_loop()))
+		self.tasks.append(asyncio.create_task(self.flush_loop()))
+
+	async def stop(self):
+		for task in self.tasks:
+			task.cancel()
+
+		await asyncio.gather(*self.tasks, return_exceptions=True)
+		self.tasks = []
+
+		await self.close_connections()
+
+	def subscribe(self, channel: str):
+		if channel not in self.channels:
+			self.channels.add(channel)
+			self.send_sub('SUBSCRIBE', channel)
+
+	def unsubscribe(self, channel: str):
+		if channel in self.channels:
+			self.channels.discard(channel)
+			self.send_sub('UNSUBSCRIBE', channel)
+
+	def send_sub(self, command: str, channel: str):
+		# Not connected, all of the channels are subscribed on (re)connect.
+		if self.sub_writer is not None:
+			self.sub_writer.write(encode_command(command, CHANNEL_PREFIX + channel))
+
+	def publish(self, channel: str, payload: str):
+		self.stats.published += 1
+		self.outbox.setdefault(channel, []).append(payload)
+		self.outbox_len += 1
+		self.outbox_ready.set()
+
+	async def flush_loop(self):
+		while True:
+			await self.outbox_ready.wait()
+
+			# Collect for the rest of the window unless the batch is full.
+			if self.outbox_len < self.batch_size:
+				await asyncio.sleep(self.batch_window)
+
+			self.outbox_ready.clear()
+			await self.flush()
+
+	async def flush(self):
+		outbox = self.outbox
+		self.outbox = {}
+		self.outbox_len = 0
+
+		if self.pub_writer is None:
+			self.stats.dropped += sum(len(msgs) for msgs in outbox.values())
+			return
+
+		commands = [ encode_command('PUBLISH',
+									CHANNEL_PREFIX + channel,
+									dumps({'node': self.node_id, 'msgs': msgs}))
+					for channel, msgs in outbox.items() ]
+
+		# Pipelined, replies (receiver counts) are read by read_publish_replies.
+		self.pub_writer.write(b''.join(commands))
+		self.stats.batches_out += len(commands)
+
+		try:
+			await self.pub_writer.drain()
+		except Exception as e:
+			# Connection loop will reconnect.
+			print(f"Backplane publish failed: {e}")
+			self.stats.errors += 1
+
+	async def connection_loop(self):
+		while True:
+			try:
+				pub_reader, sub_reader = await self.connect()
+				await asyncio.gather(self.read_publish_replies(pub_reader),
+									self.read_messages(sub_reader))
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				print(f"Backplane connection failed: {e}")
+				self.stats.errors += 1
+
+			await self.close_connections()
+			self.stats.reconnects += 1
+			await asyncio.sleep(RECONNECT_DELAY)
+
+	async def connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamReader]:
+		pub_reader, pub_writer = await asyncio.open_connection(self.host, self.port)
+		sub_writer = None
+		try:
+			sub_reader, sub_writer = await asyncio.open_connection(self.host, self.port)
+
+			await self.authenticate(pub_reader, pub_writer)
+			await self.authenticate(sub_reader, sub_writer)
+		except BaseException:
+			# Not yet handed over to close_connections.
+			pub_writer.close()
+			if sub_writer is not None:
+				sub_writer.close()
+
+			raise
+
+		if len(self.channels) > 0:
+			sub_writer.write(encode_command('SUBSCRIBE',
+								*[ CHANNEL_PREFIX + channel for channel in self.channels ]))
+
+		self.pub_writer = pub_writer
+		self.sub_writer = sub_writer
+		print(f"Backplane connected to: {self.host}:{self.port}")
+
+		return pub_reader, sub_reader
+
+	async def authenticate(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		if self.password is None:
+			return
+
+		if self.username is not None:
+			writer.write(encode_command('AUTH', self.username, self.password))
+		else:
+			writer.write(encode_command('AUTH', self.password))
+
+		# Raises ResponseError if rejected.
+		await read_reply(reader)
+
+	async def close_connections(self):
+		for writer in (self.pub_writer, self.sub_writer):
+			if writer is not None:
+				writer.close()
+
+		self.pub_writer = None
+		self.sub_writer = None
+
+	async def read_publish_replies(self, reader: asyncio.StreamReader):
+		while True:
+			try:
+				await read_reply(reader)
+			except ResponseError as e:
+				print(f"Backplane publish failed: {e}")
+				self.stats.errors += 1
+
+	async def read_messages(self, reader: asyncio.StreamReader):
+		while True:
+			reply = await read_reply(reader)
+			if not isinstance(reply, list) or len(reply) != 3 or reply[0] != b'message':
+				# (un)subscribe confirmations
+				continue
+
+			channel, batch = parse_batch(reply[1], reply[2])
+			if batch['node'] == self.node_id:
+				continue
+
+			self.stats.batches_in += 1
+			self.stats.received += len(batch['msgs'])
+			self.deliver(channel, batch['msgs'])
+
+	def as_dict(self):
+		return {'mode': BACKPLANE_REDIS,
+				'node_id': self.node_id,
+				'connected': self.pub_writer is not None,
+				'channels': len(self.channels),
+				**asdict(self.stats)}
+
+def parse_batch(channel: bytes, data: bytes) -> Tuple[str, dict]:
+	return channel.decode()[len(CHANNEL_PREFIX):], loads(data)
+
+def create_backplane(mode: str, url: str, batch_window: float, batch_size: int):
+	if mode == BACKPLANE_REDIS:
+		return RedisBackplane(url, batch_window, batch_size)
+
+	return LocalBackplane()
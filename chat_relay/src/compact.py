@@ -0,0 +1,131 @@
+from json import loads
+from typing import Dict, List, Tuple
+
+from shared_model.chat_message import MsgType
+
+# Opt-in binary encoding of the chat messages, negotiated through the
+# websocket subprotocol (Sec-WebSocket-Protocol: chat.compact.v1).
+#
+# Body (what the client sends, one per binary frame):
+#   type: uint8, index into MSG_TYPES
+#   text: length + utf-8
+# Record (what the server sends, one or more per binary frame):
+#   sender: uint16 (big endian) id, if the high bit is set the id is
+#       (re)bound to the name that follows (length + utf-8)
+#   body
+# Length is a single byte below 0xff, otherwise 0xff and an uint32.
+# Sender ids are assigned per connection, a sender costs 2 bytes after its
+# first message on the connection.
+COMPACT_SUBPROTOCOL = 'chat.compact.v1'
+
+MSG_TYPES = [ msg_type.value for msg_type in MsgType ]
+TYPE_CODES = { msg_type: code for code, msg_type in enumerate(MSG_TYPES) }
+
+SENDER_DEFINED = 0x8000
+MAX_SENDER_ID = 0x7fff
+LONG_LENGTH = 0xff
+
+def pack_len(length: int) -> bytes:
+	if length < LONG_LENGTH:
+		return bytes((length,))
+
+	return bytes((LONG_LENGTH,)) + length.to_bytes(4, 'big')
+
+def unpack_len(data: bytes, offset: int) -> Tuple[int, int]:
+	length = data[offset]
+	if length < LONG_LENGTH:
+		return length, offset + 1
+
+	return int.from_bytes(data[offset + 1:offset + 5], 'big'), offset + 5
+
+def pack_str(value: str) -> bytes:
+	encoded = value.encode()
+	return pack_len(len(encoded)) + encoded
+
+def unpack_str(data: bytes, offset: int) -> Tuple[str, int]:
+	length, offset = unpack_len(data, offset)
+	end = offset + length
+	if end > len(data):
+		raise ValueError("Truncated compact message.")
+
+	return data[offset:end].decode(), end
+
+def encode_body(msg_type: str, text: str) -> bytes:
+	return bytes((TYPE_CODES[msg_type],)) + pack_str(text)
+
+# Returns (type, text, offset after the body).
+def decode_body(data: bytes, offset: int = 0) -> Tuple[str, str, int]:
+	if offset >= len(data) or data[offset] >= len(MSG_TYPES):
+		raise ValueError("Invalid compact message type.")
+
+	msg_type = MSG_TYPES[data[offset]]
+	text, offset = unpack_str(data, offset + 1)
+	return msg_type, text, offset
+
+# Body sent by a client, has to be exactly one message.
+def decode_client_body(data: bytes) -> Tuple[str, str]:
+	msg_type, text, offset = decode_body(data)
+	if offset != len(data):
+		raise ValueError("Trailing data after compact message.")
+
+	return msg_type, text
+
+# (sender, type, text) of a decoded json message, raises ValueError if it's
+# not a valid ChatMessage.
+def message_fields(msg) -> Tuple[str, str, str]:
+	if not isinstance(msg, dict):
+		raise ValueError("Message is not an object.")
+
+	sender, msg_type, text = msg.get('sender'), msg.get('type'), msg.get('txtContent')
+	if not isinstance(sender, str) or not isinstance(text, str):
+		raise ValueError("Message sender and txtContent have to be strings.")
+
+	if msg_type not in TYPE_CODES:
+		raise ValueError(f"Invalid message type: {msg_type}")
+
+	return sender, msg_type, text
+
+# (sender, body) of an already serialized (json) message.
+def body_from_payload(payload: str) -> Tuple[str, bytes]:
+	sender, msg_type, text = message_fields(loads(payload))
+	return sender, encode_body(msg_type, text)
+
+# Server side, sender ids of a single connection.
+class SenderTable:
+
+	def __init__(self):
+		self.ids: Dict[str, int] = {}
+
+	def encode(self, sender: str, body: bytes) -> bytes:
+		sender_id = self.ids.get(sender)
+		if sender_id is not None:
+			return sender_id.to_bytes(2, 'big') + body
+
+		if len(self.ids) > MAX_SENDER_ID:
+			# Ids are rebound as the senders show up again.
+			self.ids.clear()
+
+		sender_id = self.ids[sender] = len(self.ids)
+		return (sender_id | SENDER_DEFINED).to_bytes(2, 'big') + pack_str(sender) + body
+
+# Client side, decodes the records sent over a single connection.
+class SenderNames:
+
+	def __init__(self):
+		self.names: Dict[int, str] = {}
+
+	# Returns [ (sender, type, text) ].
+	def decode(self, data: bytes) -> List[Tuple[str, str, str]]:
+		msgs = []
+		offset = 0
+		while offset < len(data):
+			sender_id = int.from_bytes(data[offset:offset + 2], 'big')
+			offset += 2
+			if sender_id & SENDER_DEFINED:
+				sender_id &= MAX_SENDER_ID
+				self.names[sender_id], offset = unpack_str(data, offset)
+
+			msg_type, text, offset = decode_body(data, offset)
+			msgs.append((self.names[sender_id], msg_type, text))
+
+		return msgs
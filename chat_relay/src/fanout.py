@@ -0,0 +1,321 @@
+import asyncio
+from itertools import count
+from dataclasses import dataclass, asdict, field
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import WebSocket
+
+from compact import SenderTable, body_from_payload
+
+# What to do with a connection whose send queue is full.
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_DISCONNECT = 'disconnect'
+
+# Policy violation, client is not reading fast enough.
+SLOW_CONSUMER_CLOSE_CODE = 1008
+
+# Counts events in one second buckets, rate is the last complete second.
+@dataclass
+class RateMeter:
+	second: int = 0
+	current: int = 0
+	last: int = 0
+
+	def add(self, count: int = 1):
+		now = int(monotonic())
+		if now != self.second:
+			self.last = self.current if now == self.second + 1 else 0
+			self.current = 0
+			self.second = now
+
+		self.current += count
+
+	def per_sec(self) -> int:
+		now = int(monotonic())
+		if now == self.second:
+			return self.last
+		if now == self.second + 1:
+			return self.current
+
+		return 0
+
+@dataclass
+class ChannelStats:
+	messages: int = 0
+	delivered: int = 0
+	# Websocket frames sent, less than delivered if batching.
+	frames: int = 0
+	bytes_out: int = 0
+	dropped: int = 0
+	disconnected: int = 0
+	rate: RateMeter = field(default_factory=RateMeter)
+
+@dataclass(eq=False)
+class Frame:
+	payload: str # json
+	size: int # of the utf-8 encoded payload
+	# (sender, body) for the compact connections, see compact.py. Made on
+	# first use if not provided by the publisher, once for all connections.
+	compact: Tuple[str, bytes] = None
+	# Payload is not a valid message, compact connections skip it.
+	invalid: bool = False
+
+	# Never raises, it's called by the connection writers.
+	def compact_body(self) -> Optional[Tuple[str, bytes]]:
+		if self.compact is None and not self.invalid:
+			try:
+				self.compact = body_from_payload(self.payload)
+			except Exception as e:
+				print(f"Invalid message skipped for compact connections: {e}")
+				self.invalid = True
+
+		return self.compact
+
+	@staticmethod
+	def from_payload(payload: str, compact: Tuple[str, bytes] = None) -> 'Frame':
+		return Frame(payload, len(payload.encode()), compact)
+
+@dataclass(eq=False)
+class WsConnection:
+	id: int
+	socket: WebSocket
+	name: str
+	queue: asyncio.Queue
+	writer: asyncio.Task = None
+	# Set if the connection opted in for batching, see batch_write_loop.
+	batch_ready: asyncio.Event = None
+	# Set if the connection negotiated the compact encoding.
+	senders: SenderTable = None
+	# When the writer's current send started, None while it's not sending.
+	send_started: float = None
+
+# Messages are coalesced only in channels busier than hot_rate (messages per
+# second), quiet ones keep the immediate delivery.
+@dataclass
+class BatchConfig:
+	window: float # seconds
+	size: int
+	hot_rate: int
+
+# Broadcasts messages to the channel's connections. Each message is
+# serialized once and put on every connection's bounded send queue, each
+# connection has its own writer task draining it, so one slow client can
+# only fill its own queue (and then loses the oldest messages or gets
+# disconnected, depending on the policy) instead of stalling the channel.
+# Channel's connections are indexed by the connection id, join and leave are
+# O(1) and the channel (with its stats) is dropped with its last connection.
+# Used from the event loop only, no locking required.
+class FanOut:
+
+	def __init__(self, queue_size: int, policy: str, batching: BatchConfig):
+		self.queue_size = queue_size
+		self.policy = policy
+		self.batching = batching
+
+		self.channels: Dict[str, Dict[int, WsConnection]] = {}
+		self.stats: Dict[str, ChannelStats] = {}
+		self.connections = 0
+		self.next_id = count()
+		# Dead connections removed by reap.
+		self.reaped = 0
+
+	# Backfill (recent history) is sent by the writer, as a single frame,
+	# before any of the messages published after the join. Compact
+	# connections are always batched, their frames carry any number of
+	# messages.
+	def join(self, channel: str, socket: WebSocket, name: str, 
+			batch: bool = False, compact: bool = False,
+			backfill: List[Frame] = None) -> WsConnection:
+
+		conn = WsConnection(id=next(self.next_id),
+						socket=socket,
+						name=name,
+						queue=asyncio.Queue(maxsize=self.queue_size))
+
+		# Writer keeps the stats, the channel may be dropped before it starts.
+		stats = self.stats.setdefault(channel, ChannelStats())
+		if compact:
+			conn.senders = SenderTable()
+
+		if batch or compact:
+			conn.batch_ready = asyncio.Event()
+			conn.writer = asyncio.create_task(self.batch_write_loop(channel, conn, stats, backfill))
+		else:
+			conn.writer = asyncio.create_task(self.write_loop(conn, stats))
+
+		self.channels.setdefault(channel, {})[conn.id] = conn
+		self.connections += 1
+		return conn
+
+	# Safe to call more than once for the same connection.
+	def leave(self, channel: str, conn: WsConnection):
+		if conn.writer is not None:
+			conn.writer.cancel()
+
+		conns = self.channels.get(channel)
+		if conns is None or conns.pop(conn.id, None) is None:
+			return
+
+		self.connections -= 1
+		if len(conns) == 0:
+			del self.channels[channel]
+			self.stats.pop(channel, None)
+
+	def connection_count(self, channel: str) -> int:
+		return len(self.channels.get(channel, ()))
+
+	def names(self, channel: str) -> List[str]:
+		return [ conn.name for conn in self.channels.get(channel, {}).values() ]
+
+	# Payload is the already serialized (json) message, compact is its
+	# (sender, body) if the publisher has it at hand.
+	def publish(self, channel: str, payload: str, compact: Tuple[str, bytes] = None):
+		conns = self.channels.get(channel)
+		if conns is None:
+			return
+
+		stats = self.stats[channel]
+		frame = Frame.from_payload(payload, compact)
+		stats.messages += 1
+		stats.rate.add()
+
+		# Copy, slow consumers may be removed while iterating.
+		for conn in list(conns.values()):
+			if conn.queue.full():
+				if self.policy == POLICY_DISCONNECT:
+					self.disconnect(channel, conn)
+					stats.disconnected += 1
+					continue
+
+				conn.queue.get_nowait()
+				stats.dropped += 1
+
+			conn.queue.put_nowait(frame)
+			if conn.batch_ready is not None and conn.queue.qsize() >= self.batching.size:
+				conn.batch_ready.set()
+
+	def disconnect(self, channel: str, conn: WsConnection):
+		print(f"Disconnecting slow consumer: {conn.name} from: {channel}")
+		self.leave(channel, conn)
+		asyncio.create_task(self.close(conn))
+
+	async def close(self, conn: WsConnection):
+		try:
+			await conn.socket.close(code=SLOW_CONSUMER_CLOSE_CODE)
+		except Exception as e:
+			print(f"Failed to close connection of: {conn.name}, reason: {e}")
+
+	async def write_loop(self, conn: WsConnection, stats: ChannelStats):
+		while True:
+			frame = await conn.queue.get()
+			conn.send_started = monotonic()
+			try:
+				await conn.socket.send_text(frame.payload)
+			except Exception as e:
+				# Receive loop will notice the disconnect and leave the channel.
+				print(f"Failed to send to: {conn.name}, reason: {e}")
+				return
+
+			conn.send_started = None
+			stats.delivered += 1
+			stats.frames += 1
+			stats.bytes_out += frame.size
+
+	# Removes (and closes) the connections whose writer failed or has been
+	# stuck in a single send for longer than send_timeout, dead peers the
+	# receive loop hasn't noticed yet. Idle connections are never reaped.
+	# Frames waiting in the queue don't count, the writer takes them as soon
+	# as it's done with the previous send. Returns (channel, connection)
+	# pairs, callers leave the channels through the same path as disconnects.
+	def reap(self, send_timeout: float) -> List[Tuple[str, WsConnection]]:
+		now = monotonic()
+		dead = []
+		for channel, conns in self.channels.items():
+			for conn in conns.values():
+				if conn.writer.done() or \
+						(conn.send_started is not None and now - conn.send_started > send_timeout):
+					dead.append((channel, conn))
+
+		for channel, conn in dead:
+			print(f"Reaping dead connection: {conn.name} from: {channel}")
+			asyncio.create_task(self.close(conn))
+
+		self.reaped += len(dead)
+		return dead
+
+	def is_hot(self, channel: str) -> bool:
+		stats = self.stats.get(channel)
+		return stats is not None and stats.rate.per_sec() >= self.batching.hot_rate
+
+	# Sends a batch of messages as a single frame, returns the frame size.
+	async def send_batch(self, conn: WsConnection, frames: List[Frame]) -> int:
+		if conn.senders is not None:
+			bodies = [ body for body in map(Frame.compact_body, frames) if body is not None ]
+			if len(bodies) == 0:
+				return 0
+
+			data = b''.join(conn.senders.encode(*body) for body in bodies)
+			await conn.socket.send_bytes(data)
+			return len(data)
+
+		await conn.socket.send_text('[' + ','.join(frame.payload for frame in frames) + ']')
+		return sum(frame.size for frame in frames) + len(frames) + 1
+
+	# Sends json arrays (or compact records) of messages. In hot channels the
+	# writer waits for the batch window (or until the batch is full) after the
+	# first message, otherwise only the messages that are already queued are
+	# coalesced.
+	async def batch_write_loop(self, channel: str, conn: WsConnection,
+							stats: ChannelStats, backfill: List[Frame]):
+		if backfill:
+			conn.send_started = monotonic()
+			try:
+				await self.send_batch(conn, backfill)
+			except Exception as e:
+				print(f"Failed to send backfill to: {conn.name}, reason: {e}")
+				return
+
+			conn.send_started = None
+
+		while True:
+			frames = [ await conn.queue.get() ]
+
+			if self.is_hot(channel) and conn.queue.qsize() + 1 < self.batching.size:
+				conn.batch_ready.clear()
+				try:
+					await asyncio.wait_for(conn.batch_ready.wait(), self.batching.window)
+				except asyncio.TimeoutError:
+					pass
+
+			while len(frames) < self.batching.size and not conn.queue.empty():
+				frames.append(conn.queue.get_nowait())
+
+			conn.send_started = monotonic()
+			try:
+				size = await self.send_batch(conn, frames)
+			except Exception as e:
+				print(f"Failed to send to: {conn.name}, reason: {e}")
+				return
+
+			conn.send_started = None
+			stats.delivered += len(frames)
+			stats.frames += 1
+			stats.bytes_out += size
+
+	def as_dict(self):
+		data = {}
+		for channel, stats in self.stats.items():
+			depths = [ conn.queue.qsize() for conn in self.channels.get(channel, {}).values() ]
+			channel_data = asdict(stats)
+			channel_data['rate'] = stats.rate.per_sec()
+			channel_data['connections'] = len(depths)
+			channel_data['queue_depth_max'] = max(depths, default=0)
+			channel_data['queue_depth_total'] = sum(depths)
+			data[channel] = channel_data
+
+		return {'queue_size': self.queue_size,
+				'connections': self.connections,
+				'policy': self.policy,
+				'batching': asdict(self.batching),
+				'channels': data}
@@ -0,0 +1,132 @@
+from dataclasses import dataclass, asdict
+from time import monotonic
+from typing import Dict, Tuple
+
+ALLOWED = 'allowed'
+USER_LIMITED = 'user_limited'
+CHANNEL_LIMITED = 'channel_limited'
+GLOBAL_LIMITED = 'global_limited'
+DUPLICATE = 'duplicate'
+
+@dataclass
+class Limit:
+	rate: float # tokens (messages) per second
+	burst: int
+
+class TokenBucket:
+
+	def __init__(self, limit: Limit):
+		self.limit = limit
+		self.tokens = float(limit.burst)
+		self.updated = monotonic()
+
+	def refill(self, now: float):
+		self.tokens = min(self.limit.burst,
+						self.tokens + (now - self.updated) * self.limit.rate)
+		self.updated = now
+
+	def take(self, now: float) -> bool:
+		self.refill(now)
+		if self.tokens < 1:
+			return False
+
+		self.tokens -= 1
+		return True
+
+	def is_full(self, now: float) -> bool:
+		self.refill(now)
+		return self.tokens >= self.limit.burst
+
+@dataclass
+class FloodStats:
+	allowed: int = 0
+	user_limited: int = 0
+	channel_limited: int = 0
+	global_limited: int = 0
+	duplicate: int = 0
+	# Connections closed for exceeding the limits too many times in a row.
+	shed: int = 0
+
+# Token bucket limits per user (across all of their connections and
+# channels), per channel and for the whole process (bounds the fan-out work
+# no matter how many users are flooding), plus suppression of the same
+# message repeated by the same user within duplicate_window seconds.
+# Checks are plain dict lookups and arithmetic, cheap enough to run before
+# the message is even parsed (user limit) or authorized.
+# Used from the event loop only, no locking required.
+class FloodControl:
+
+	def __init__(self, user_limit: Limit,
+			channel_limit: Limit,
+			global_limit: Limit,
+			duplicate_window: float):
+
+		self.user_limit = user_limit
+		self.channel_limit = channel_limit
+		self.duplicate_window = duplicate_window
+
+		self.users: Dict[str, TokenBucket] = {}
+		self.channels: Dict[str, TokenBucket] = {}
+		self.process = TokenBucket(global_limit)
+		# (user, channel) -> (hash of the last message, when it was sent)
+		self.last_messages: Dict[Tuple[str, str], Tuple[int, float]] = {}
+
+		self.stats = FloodStats()
+
+	def check_user(self, user: str) -> str:
+		bucket = self.users.get(user)
+		if bucket is None:
+			bucket = self.users[user] = TokenBucket(self.user_limit)
+
+		if not bucket.take(monotonic()):
+			return self.count(USER_LIMITED)
+
+		return ALLOWED
+
+	# Called after check_user allowed the message.
+	def check_message(self, user: str, channel: str, text: str) -> str:
+		now = monotonic()
+
+		key = (user, channel)
+		text_hash = hash(text)
+		last = self.last_messages.get(key)
+		if last is not None and last[0] == text_hash and now - last[1] < self.duplicate_window:
+			return self.count(DUPLICATE)
+
+		self.last_messages[key] = (text_hash, now)
+
+		bucket = self.channels.get(channel)
+		if bucket is None:
+			bucket = self.channels[channel] = TokenBucket(self.channel_limit)
+
+		if not bucket.take(now):
+			return self.count(CHANNEL_LIMITED)
+
+		if not self.process.take(now):
+			return self.count(GLOBAL_LIMITED)
+
+		return self.count(ALLOWED)
+
+	def count(self, verdict: str) -> str:
+		setattr(self.stats, verdict, getattr(self.stats, verdict) + 1)
+		return verdict
+
+	def shed(self):
+		self.stats.shed += 1
+
+	# Drops the state of the users and channels that have been idle long
+	# enough for their buckets to refill.
+	def prune(self):
+		now = monotonic()
+		for buckets in (self.users, self.channels):
+			for key in [ key for key, bucket in buckets.items() if bucket.is_full(now) ]:
+				del buckets[key]
+
+		for key in [ key for key, (_, sent) in self.last_messages.items()
+					if now - sent >= self.duplicate_window ]:
+			del self.last_messages[key]
+
+	def as_dict(self):
+		return {**asdict(self.stats),
+				'users': len(self.users),
+				'channels': len(self.channels)}
@@ -0,0 +1,105 @@
+from collections import OrderedDict, deque
+from dataclasses import dataclass, asdict
+from time import monotonic
+from typing import Deque, List
+
+@dataclass
+class HistoryStats:
+	# Channels dropped after idle_timeout without messages.
+	evicted_idle: int = 0
+	# Messages dropped to stay under the memory cap.
+	evicted_cap: int = 0
+	backfills: int = 0
+	backfill_bytes: int = 0
+
+class ChannelHistory:
+
+	def __init__(self, size: int):
+		# utf-8 encoded payloads, oldest first
+		self.messages: Deque[bytes] = deque(maxlen=size)
+		self.bytes = 0
+		self.updated = monotonic()
+
+	# Returns the number of bytes freed by the ring dropping its oldest message.
+	def add(self, payload: bytes) -> int:
+		freed = 0
+		if len(self.messages) == self.messages.maxlen:
+			freed = len(self.messages[0])
+
+		self.messages.append(payload)
+		self.bytes += len(payload) - freed
+		self.updated = monotonic()
+		return freed
+
+	def pop_oldest(self) -> int:
+		freed = len(self.messages.popleft())
+		self.bytes -= freed
+		return freed
+
+# Last size messages of every active channel, kept as the already serialized
+# payloads so a joining viewer gets them as a single frame with no
+# per-message serialization. Channels are ordered by their last message, idle ones
+# are evicted by evict_idle and once max_bytes is exceeded the oldest messages
+# of the least recently active channels are dropped first.
+# Used from the event loop only, no locking required.
+class History:
+
+	def __init__(self, size: int, max_bytes: int, idle_timeout: float):
+		self.size = size
+		self.max_bytes = max_bytes
+		self.idle_timeout = idle_timeout
+
+		self.channels: OrderedDict[str, ChannelHistory] = OrderedDict()
+		self.bytes = 0
+
+		self.stats = HistoryStats()
+
+	def add(self, channel: str, payload: str):
+		history = self.channels.get(channel)
+		if history is None:
+			history = self.channels[channel] = ChannelHistory(self.size)
+		else:
+			self.channels.move_to_end(channel)
+
+		data = payload.encode()
+		self.bytes += len(data) - history.add(data)
+		self.enforce_cap()
+
+	def enforce_cap(self):
+		while self.bytes > self.max_bytes and len(self.channels) > 0:
+			channel, history = next(iter(self.channels.items()))
+			self.bytes -= history.pop_oldest()
+			self.stats.evicted_cap += 1
+
+			if len(history.messages) == 0:
+				del self.channels[channel]
+
+	# Channel's recent (utf-8 encoded json) messages, oldest first.
+	def backfill(self, channel: str) -> List[bytes]:
+		history = self.channels.get(channel)
+		if history is None or len(history.messages) == 0:
+			return []
+
+		self.stats.backfills += 1
+		self.stats.backfill_bytes += history.bytes
+		return list(history.messages)
+
+	def evict_idle(self):
+		now = monotonic()
+		# Ordered by the last message, idle channels are at the front.
+		while len(self.channels) > 0:
+			channel, history = next(iter(self.channels.items()))
+			if now - history.updated < self.idle_timeout:
+				break
+
+			del self.channels[channel]
+			self.bytes -= history.bytes
+			self.stats.evicted_idle += 1
+
+	def as_dict(self):
+		return {'size': self.size,
+				'max_bytes': self.max_bytes,
+				'total_bytes': self.bytes,
+				'channels': len(self.channels),
+				'messages': sum(len(history.messages) for history in self.channels.values()),
+				**asdict(self.stats)}
@@ -1,7 +1,12 @@
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
+from datetime import timedelta
 from enum import Enum
 from httpx import AsyncClient 
-from typing import Dict
+import asyncio
+from json import dumps, loads
+import os
+from typing import Dict, List
 from fastapi.websockets import WebSocketState
 from fastapi import FastAPI, HTTPException, WebSocket
 from fastapi import status as code
@@ -9,18 +14,117 @@ import uvicorn
 from jsonpickle import decode
 from shared_model.user import User
 from shared_model.chat_message import ChatMessage, MsgType
+from shared_model.session_cache import SessionCache
 
-@dataclass 
-class WsConnection: 
-	socket: WebSocket
-	name: str
+from fanout import FanOut, BatchConfig, Frame, POLICY_DROP_OLDEST
+from backplane import create_backplane, BACKPLANE_LOCAL
+from flood_control import FloodControl, Limit, ALLOWED
+from history import History
+from compact import COMPACT_SUBPROTOCOL, decode_client_body, encode_body
+from compact import body_from_payload, message_fields
 
 DOMAIN_NAME = "session.com"
 AUTHORIZE_URL = lambda channel: f"http://{DOMAIN_NAME}/auth/authorize_chatter/{channel}"
+ACCESS_TOKEN_COOKIE = 'sAccessToken'
 
-app = FastAPI()
+# isAuthorized is called for every received message, cached result is used
+# for the most of them. Ttl has to be shorter than the access token lifetime.
+SESSION_CACHE_TTL = timedelta(seconds=30)
+SESSION_CACHE_SIZE = 10000
 
-channels: Dict[str, WsConnection] = {}
+# Messages waiting to be sent to a single connection, see fanout.py.
+SEND_QUEUE_SIZE = 256
+SLOW_CONSUMER_POLICY = POLICY_DROP_OLDEST
+
+# Protocol level pings (uvicorn), peers not answering within the timeout
+# are disconnected. Connections stuck sending for longer than SEND_TIMEOUT
+# are reaped every REAP_INTERVAL, see fanout.py.
+WS_PING_INTERVAL = 20 # seconds
+WS_PING_TIMEOUT = 20 # seconds
+SEND_TIMEOUT = 60 # seconds
+REAP_INTERVAL = 15 # seconds
+
+# Opt-in (?batch=1) delivery of json arrays of messages, see fanout.py.
+BATCH_PARAM = 'batch'
+BATCHING = BatchConfig(window=0.075, size=50, hot_rate=20)
+
+# local (single replica) or redis, see backplane.py.
+BACKPLANE = os.getenv('CHAT_BACKPLANE', BACKPLANE_LOCAL)
+BACKPLANE_URL = os.getenv('CHAT_BACKPLANE_URL', f"redis://chat-backplane.{DOMAIN_NAME}:6379")
+BACKPLANE_BATCH_WINDOW = 0.005 # seconds
+BACKPLANE_BATCH_SIZE = 100
+
+# Flood control, see flood_control.py. Connection exceeding the limits
+# MAX_VIOLATIONS times in a row is closed.
+USER_LIMIT = Limit(rate=1, burst=5)
+CHANNEL_LIMIT = Limit(rate=200, burst=400)
+GLOBAL_LIMIT = Limit(rate=5000, burst=10000)
+DUPLICATE_WINDOW = 30 # seconds
+MAX_VIOLATIONS = 20
+FLOOD_PRUNE_INTERVAL = 60 # seconds
+POLICY_VIOLATION_CLOSE_CODE = 1008
+
+# Recent messages of every channel, sent (as a single json array) to the
+# viewers joining the channel, see history.py. Only sent to the connections
+# accepting arrays (batch) or compact frames.
+HISTORY_SIZE = 50 # messages per channel
+HISTORY_MAX_BYTES = 64 * 1024 * 1024
+HISTORY_IDLE_TIMEOUT = 15 * 60 # seconds
+HISTORY_EVICT_INTERVAL = 60 # seconds
+
+session_cache = SessionCache(SESSION_CACHE_TTL, SESSION_CACHE_SIZE)
+flood_control = FloodControl(USER_LIMIT, CHANNEL_LIMIT, GLOBAL_LIMIT, DUPLICATE_WINDOW)
+history = History(HISTORY_SIZE, HISTORY_MAX_BYTES, HISTORY_IDLE_TIMEOUT)
+fanout = FanOut(SEND_QUEUE_SIZE, SLOW_CONSUMER_POLICY, BATCHING)
+backplane = create_backplane(BACKPLANE, 
+							BACKPLANE_URL, 
+							BACKPLANE_BATCH_WINDOW, 
+							BACKPLANE_BATCH_SIZE)
+
+# Messages published on the other replicas (validated there).
+def deliver_remote(channel: str, payloads: List[str]):
+	for payload in payloads:
+		try:
+			compact = body_from_payload(payload)
+		except Exception as e:
+			print(f"Invalid message from the backplane: {e}")
+			continue
+
+		fanout.publish(channel, payload, compact)
+		history.add(channel, payload)
+
+async def flood_prune_loop():
+	while True:
+		await asyncio.sleep(FLOOD_PRUNE_INTERVAL)
+		flood_control.prune()
+
+async def reap_loop():
+	while True:
+		await asyncio.sleep(REAP_INTERVAL)
+		for channel, conn in fanout.reap(SEND_TIMEOUT):
+			leave(channel, conn)
+
+async def history_evict_loop():
+	while True:
+		await asyncio.sleep(HISTORY_EVICT_INTERVAL)
+		history.evict_idle()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+	print(f"Starting {BACKPLANE} backplane.")
+	await backplane.start(deliver_remote)
+	tasks = [ asyncio.create_task(flood_prune_loop()),
+			asyncio.create_task(history_evict_loop()),
+			asyncio.create_task(reap_loop()) ]
+
+	yield
+
+	for task in tasks:
+		task.cancel()
+
+	await backplane.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.websocket("/chat/{channel}")
@@ -30,7 +134,9 @@ async def chat(ws: WebSocket, channel: str):
 		raise HTTPException(status_code=code.HTTP_400_BAD_REQUEST, 
 					detail='Provide channel name.')
 
-	await ws.accept()
+	# Binary encoding, see compact.py.
+	compact = COMPACT_SUBPROTOCOL in ws.scope.get('subprotocols', [])
+	await ws.accept(subprotocol=COMPACT_SUBPROTOCOL if compact else None)
 	print("Connection accepted, will try to authorize.")
 
 	user: User = await isAuthorized(ws.cookies, channel)
@@ -40,58 +146,113 @@ async def chat(ws: WebSocket, channel: str):
 
 	print(f"{user.username} is successfully authorization.")
 
-	if channel not in channels: 
-		print(f"Will create chat channel for: {channel}")
-		channels[channel] = [WsConnection(socket=ws, name=user.username)]
-	else: 
-		print(f"Adding: {user.username} to the: {channel}")
-		channels[channel].append(WsConnection(socket=ws, name=user.username))
+	print(f"Adding: {user.username} to the: {channel}")
+	conn = join(channel, ws, user.username, ws.query_params.get(BATCH_PARAM) == '1', compact)
+	print(f"state: {fanout.names(channel)}")
+
+	# Whatever ends the loop, the connection leaves the channel (leave is
+	# idempotent).
+	try:
+		await receive_loop(ws, channel, user, compact)
+	finally:
+		print(f"{user.username} disconnected from: {channel}.")
+		leave(channel, conn)
+		print(f"state: {fanout.names(channel)}")
+	
+	return "Goodbye."
 
-	print(f"state: {list(map(lambda c: c.name, channels[channel]))}")
 
+async def receive_loop(ws: WebSocket, channel: str, user: User, compact: bool):
+	violations = 0
 	while ws.client_state == WebSocketState.CONNECTED: 
 		try: 
-			data = await ws.receive_json()
-			# data = await ws.receive_text()
+			data = await ws.receive_bytes() if compact else await ws.receive_text()
 		except Exception as e: 
 			print(f"ws exception with: {user.username} -> {e}")
 			
 			if ws.client_state != WebSocketState.DISCONNECTED: 
 				await ws.close()
 
-			if channel in channels: 
-				print("Removing chatter.")
-				channels[channel] = filter_out(user.username, channels[channel])
-
 			return
 
+		# User limit is checked before the message is even parsed.
+		verdict = flood_control.check_user(user.username)
+		if verdict == ALLOWED:
+			try:
+				msg, body = parse_message(data, compact, user)
+				verdict = flood_control.check_message(user.username, channel, msg.txtContent)
+			except Exception as e:
+				print(f"Invalid message from: {user.username} -> {e}")
+				await ws.close()
+				return
+
+		if verdict != ALLOWED:
+			violations += 1
+			if violations >= MAX_VIOLATIONS:
+				print(f"Shedding flooding chatter: {user.username}")
+				flood_control.shed()
+				await ws.close(code=POLICY_VIOLATION_CLOSE_CODE)
+				return
+
+			continue
+
+		violations = 0
 		print(f"Received: {data}")
 
 		if not await isAuthorized(ws.cookies, channel):
 			print("Not authorized.")
-			ws.close()
+			await ws.close()
+			return
 
-		msg = ChatMessage(**data)
+		# Serialized once for all of the channel's connections (same format
+		# send_json would produce).
+		payload = dumps(msg.__dict__, separators=(",", ":"), ensure_ascii=False)
+		fanout.publish(channel, payload, body)
+		history.add(channel, payload)
+		backplane.publish(channel, payload)
 
-		for chat_user in channels[channel]: 
-			print(f"Sending to: {chat_user.name}", end=' ... ')
-			await chat_user.socket.send_json(msg.__dict__)
-			print("Sent.")
+# Returns the message and its compact (sender, body), compact clients send
+# the body only, sender is the authorized user. Raises on invalid messages,
+# only the validated ones are published (and kept in the history).
+def parse_message(data, compact: bool, user: User):
+	if compact:
+		msg_type, text = decode_client_body(data)
+		msg = ChatMessage(sender=user.username, type=msg_type, txtContent=text)
+		return msg, (user.username, data)
 
-	print(f"{user.username} disconnected from: {channel}.")
-	if channel in channels:
-		# channels[channel] = filter(lambda c: c.name != user.username, channels[channel])
-		channels[channel] = filter_out(user.username, channels[channel])
-		print(f"state: {list(map(lambda c: c.name, channels[channel]))}")
-	
-	return "Goodbye."
+	sender, msg_type, text = message_fields(loads(data))
+	msg = ChatMessage(sender=sender, type=msg_type, txtContent=text)
+	return msg, (sender, encode_body(msg_type, text))
+
+# Node is subscribed (on the backplane) to the channels it has connections in.
+def join(channel: str, ws: WebSocket, name: str, batch: bool, compact: bool):
+	backfill = None
+	if batch or compact:
+		backfill = [ Frame(payload.decode(), len(payload)) for payload in history.backfill(channel) ]
 
+	conn = fanout.join(channel, ws, name, batch, compact, backfill)
+	if fanout.connection_count(channel) == 1:
+		backplane.subscribe(channel)
+
+	return conn
+
+def leave(channel: str, conn):
+	fanout.leave(channel, conn)
+	if fanout.connection_count(channel) == 0:
+		backplane.unsubscribe(channel)
 
 async def isLive(channel: str):
 	print(f"Checking is live: {channel}")
 	return True
 
 async def isAuthorized(cookies:Dict[str,str], channel: str) -> User: 
+	token = cookies.get(ACCESS_TOKEN_COOKIE)
+	cache_key = (token, channel) if token is not None else None
+
+	return await session_cache.get(cache_key, 
+								lambda: fetchAuthorization(cookies, channel))
+
+async def fetchAuthorization(cookies:Dict[str,str], channel: str) -> User: 
 	print(f"Checking chatters authorization for {channel}")
 
 	async with AsyncClient() as client: 
@@ -104,8 +265,39 @@ async def isAuthorized(cookies:Dict[str,str], channel: str) -> User:
 		print(f"Is authorized: {res.json()}")
 		return User(**res.json())
 
-def filter_out(username, collection): 
-	return list(filter(lambda el: el.name != username, collection))
+@app.get("/stats/session_cache")
+def get_session_cache_stats():
+	return session_cache.as_dict()
+
+# Per process gauges.
+@app.get("/stats/connections")
+async def get_connection_stats():
+	return {'connections': fanout.connections,
+			'channels': len(fanout.channels),
+			'reaped': fanout.reaped}
+
+@app.get("/stats/history")
+async def get_history_stats():
+	return history.as_dict()
+
+@app.get("/stats/flood_control")
+async def get_flood_control_stats():
+	return flood_control.as_dict()
+
+@app.get("/stats/backplane")
+async def get_backplane_stats():
+	return backplane.as_dict()
+
+@app.get("/stats/fanout")
+async def get_fanout_stats():
+	return fanout.as_dict()
 
 if __name__ == "__main__":
-	uvicorn.run("server:app", host='0.0.0.0', port=80)
\ No newline at end of file
+	# Compression is negotiated with the clients supporting it, pays off
+	# mostly with the batched frames.
+	uvicorn.run("server:app", 
+				host='0.0.0.0', 
+				port=80, 
+				ws_per_message_deflate=True, 
+				ws_ping_interval=WS_PING_INTERVAL, 
+				ws_ping_timeout=WS_PING_TIMEOUT)
\ No newline at end of file
@@ -118,7 +118,7 @@ const oldConfig: configuration = {
 	highCategoryIconUrl: (name: string) =>
 		`http://${DOMAIN}/stream/category_high_tnail/${name}`,
 	updateStreamUrl: `http://${DOMAIN}/stream/update`,
-	chatRelayUrl: (channel) => `ws://${DOMAIN}/chat/${channel}`,
+	chatRelayUrl: (channel) => `ws://${DOMAIN}/chat/${channel}?batch=1`,
 	streamSearchUrl: (query, start, count, region) =>
 		`http://session.com/stream/stream_query/${query}?
 													start=${start}&
@@ -197,7 +197,7 @@ const newConfig: configuration = {
 	highCategoryIconUrl: (name: string) =>
 		`http://${DOMAIN}/${PREFIX}/stream/category_high_tnail/${name}`,
 	updateStreamUrl: `http://${DOMAIN}/${PREFIX}/stream/update`,
-	chatRelayUrl: (channel) => `ws://${DOMAIN}/${PREFIX}/chat/${channel}`,
+	chatRelayUrl: (channel) => `ws://${DOMAIN}/${PREFIX}/chat/${channel}?batch=1`,
 	streamSearchUrl: (query, start, count, region) =>
 		`http://session.com/stream/stream_query/${query}?
 													start=${start}&
@@ -11,21 +11,23 @@ export default function Chat({ channel, getUser }:
 
 	const [messages, setMessages] = React.useState<ChatMessage[]>([])
 	const [myMessage, setMyMessage] = React.useState<string>("")
-	const { sendJsonMessage, lastJsonMessage: newJsonMessage, readyState } =
-		useWebSocket<ChatMessage>(config.chatRelayUrl(channel));
+	// Relay sends batches (arrays) of messages, see chatRelayUrl.
+	const { sendJsonMessage, lastJsonMessage: newJsonMessages, readyState } =
+		useWebSocket<ChatMessage[]>(config.chatRelayUrl(channel));
 	const [username, setUsername] = React.useState<string | undefined>(undefined)
 
 	useEffect(() => {
-		if (newJsonMessage) {
-			console.log("Received message: " + JSON.stringify(newJsonMessage))
-			setMessages([newJsonMessage, ...messages])
+		if (newJsonMessages) {
+			console.log("Received messages: " + JSON.stringify(newJsonMessages))
+			// Newest first, batch is in the order of arrival.
+			setMessages([...[...newJsonMessages].reverse(), ...messages])
 		}
 
 		if (username == undefined) {
 			loadUsername()
 		}
 
-	}, [newJsonMessage])
+	}, [newJsonMessages])
 
 	async function loadUsername(): Promise<void> {
 		let user = await getUser()
@@ -0,0 +1,31 @@
+from bisect import bisect_left
+from typing import List
+
+DEFAULT_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+# Non-cumulative latency histogram (count per bucket), last count is for everything
+# above the largest bucket bound. Only touched from the event loop so there is
+# no locking.
+class LatencyHistogram:
+
+	def __init__(self, buckets_ms: List[float] = DEFAULT_BUCKETS_MS):
+		self.buckets_ms = buckets_ms
+		self.counts = [0] * (len(buckets_ms) + 1)
+		self.count = 0
+		self.total_ms = 0.0
+		self.max_ms = 0.0
+
+	def observe(self, value_ms: float):
+		self.counts[bisect_left(self.buckets_ms, value_ms)] += 1
+		self.count += 1
+		self.total_ms += value_ms
+		self.max_ms = max(self.max_ms, value_ms)
+
+	def as_dict(self):
+		bounds = [ f"le_{b}ms" for b in self.buckets_ms ] + ['inf']
+		return {
+			'count': self.count,
+			'avg_ms': self.total_ms / self.count if self.count > 0 else 0,
+			'max_ms': self.max_ms,
+			'buckets': dict(zip(bounds, self.counts))
+		}
@@ -0,0 +1,83 @@
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import timedelta
+from time import monotonic
+from typing import Any, Awaitable, Callable, Hashable
+
+@dataclass
+class SessionCacheStats:
+	hits: int = 0
+	misses: int = 0
+	# Lookups that joined an already running upstream call.
+	coalesced: int = 0
+	evictions: int = 0
+
+# Bounded (LRU) in-process cache for session verification results, keyed by
+# the access token (cookie). Ttl should be well below the supertokens access
+# token lifetime so that revoked sessions are not honored for too long.
+# Concurrent misses for the same key share a single fetch. Only successful
+# (not None) results are cached.
+# Used from the event loop only, no locking required.
+class SessionCache:
+
+	def __init__(self, ttl: timedelta, max_size: int):
+		self.ttl = ttl.total_seconds()
+		self.max_size = max_size
+		self.entries: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+		self.pending: dict[Hashable, asyncio.Future] = {}
+		self.stats = SessionCacheStats()
+
+	async def get(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]):
+		if key is None:
+			return await fetch()
+
+		entry = self.entries.get(key)
+		if entry is not None:
+			value, expires_at = entry
+			if monotonic() < expires_at:
+				self.entries.move_to_end(key)
+				self.stats.hits += 1
+				return value
+
+			del self.entries[key]
+
+		pending = self.pending.get(key)
+		if pending is not None:
+			self.stats.coalesced += 1
+			return await asyncio.shield(pending)
+
+		self.stats.misses += 1
+		pending = asyncio.ensure_future(fetch())
+		self.pending[key] = pending
+		pending.add_done_callback(lambda task: self.on_fetched(key, task))
+
+		# Shielded so that one cancelled caller doesn't cancel the fetch for
+		# the others waiting on it.
+		return await asyncio.shield(pending)
+
+	def on_fetched(self, key: Hashable, task: asyncio.Future):
+		self.pending.pop(key, None)
+
+		if task.cancelled() or task.exception() is not None:
+			return
+
+		if task.result() is not None:
+			self.put(key, task.result())
+
+	def put(self, key: Hashable, value):
+		self.entries[key] = (value, monotonic() + self.ttl)
+		self.entries.move_to_end(key)
+
+		while len(self.entries) > self.max_size:
+			self.entries.popitem(last=False)
+			self.stats.evictions += 1
+
+	def invalidate(self, key: Hashable):
+		self.entries.pop(key, None)
+
+	def as_dict(self):
+		return {**self.stats.__dict__,
+				'size': len(self.entries),
+				'max_size': self.max_size,
+				'pending': len(self.pending)}
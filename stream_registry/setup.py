@@ -9,8 +9,11 @@ setup(
                       'jsonpickle',
 					  'dataclasses',
                       'requests',
+					  'httpx',
 					  'ffmpeg-python',
+					  'av',
 					#   "Werkzeug==2.2", 
 					# ^ this specific version was required for flasks status.
-                      'mongoengine'],
+                      'mongoengine',
+					  'motor'],
     zip_safe=False)
@@ -1,6 +1,7 @@
 import asyncio
+from contextlib import asynccontextmanager
 import os
-from typing import List
+from typing import List, Tuple
 
 from fastapi import FastAPI, HTTPException, Response, Request, status
 from fastapi.encoders import jsonable_encoder
@@ -11,11 +12,12 @@ from fastapi.responses import FileResponse
 import uvicorn
 
 from datetime import datetime, timedelta
+from time import perf_counter
 
-from requests import get
-from httpx import AsyncClient, Response as HttpxResp
+from httpx import Response as HttpxResp
 
 from shared_model.continue_view_request import ContinueViewRequest
+from shared_model.latency_histogram import LatencyHistogram
 from shared_model.following_info import FollowingInfo
 from shared_model.media_server_request import MediaServerRequest
 from shared_model.media_server_info import MediaServerInfo
@@ -24,7 +26,21 @@ from shared_model.update_request import UpdateRequest
 from shared_model.category import Category as PublicCategory
 
 from shared_model.user import User
-from stream_registry.src.db import Db
+from shared_model.session_cache import SessionCache
+from stream_registry.src.async_db import AsyncDb, open_db
+from stream_registry.src.pool_stats import PoolStats
+from stream_registry.src.upstream import Upstreams, TOKENS_API
+from stream_registry.src.stream_directory import StreamDirectory, DirectorySync
+from stream_registry.src.ordered_index import Key, KeyTypes, InvalidCursor
+from stream_registry.src.ordered_index import encode_cursor, decode_cursor
+from stream_registry.src.search_index import SEARCH_KEY_TYPES
+from stream_registry.src.ranking import Ranking, RankingUpdater
+from stream_registry.src.viewer_presence import ViewerPresence, PresenceFlusher
+from stream_registry.src.thumbnails import Thumbnails, FfmpegPull, TNAIL_MEDIA_TYPE
+from stream_registry.src.thumbnails import TNAIL_LOCAL_PREVIEW
+from stream_registry.src.local_preview import LocalPreview
+from stream_registry.src.category_icons import CategoryIcons, ICON_LOW, ICON_HIGH
+from stream_registry.src.category_icons import IMMUTABLE_CACHE_CONTROL
 
 from stream_registry.src.app_config import AppConfig, DOMAIN_NAME
 from stream_registry.src.app_config import Category as ConfCategory
@@ -33,21 +49,125 @@ from stream_registry.src.stream_data import StreamData
 
 JSON_CONTENT_TYPE = 'application/json'
 
-app = FastAPI()
+db: AsyncDb = None
+pool_stats: PoolStats = None
+upstreams: Upstreams = None
+session_cache: SessionCache = None
+presence: ViewerPresence = None
+presence_flusher: PresenceFlusher = None
+thumbnails: Thumbnails = None
+category_icons: CategoryIcons = None
+ranking: Ranking = None
+ranking_updater: RankingUpdater = None
+directory: StreamDirectory = None
+directory_sync: DirectorySync = None
+
+ACCESS_TOKEN_COOKIE = 'sAccessToken'
+# Continuation token for the listing endpoints, pass it back as the cursor 
+# param to get the next page. Missing if there are no more streams.
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+# Whole start_stream request (key validation and the stream skeleton), the
+# ingest's rtmp publish waits for it.
+start_stream_latency = LatencyHistogram()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+	global db, pool_stats, upstreams, session_cache
+	global presence, presence_flusher, ranking, ranking_updater
+	global directory, directory_sync, thumbnails, category_icons
+
+	config = AppConfig.get_instance()
+
+	print(f"Connecting {config.db_driver} db with pool size: {config.db_pool_size}")
+	pool_stats = PoolStats(config.db_pool_size)
+	db = await open_db(config, pool_stats)
+
+	upstreams = Upstreams(config.upstream_limits, 
+						config.upstream_timeout, 
+						config.upstream_keepalive)
+
+	session_cache = SessionCache(config.session_cache_ttl, 
+								config.session_cache_size)
+
+	presence = ViewerPresence(config.viewer_longevity, config.viewer_bucket)
+	ranking = Ranking(presence, config.ranking_category_scores)
+	directory = StreamDirectory(ranking)
+
+	print(f"Loading stream directory, sync mode: {config.directory_sync}")
+	directory_sync = DirectorySync(directory, 
+								db, 
+								config.directory_sync, 
+								config.directory_resync_interval)
+	await directory_sync.start()
+
+	ranking_updater = RankingUpdater(ranking, 
+									directory, 
+									upstreams, 
+									config.follower_counts_url,
+									config.ranking_interval,
+									config.followers_refresh_interval)
+	await ranking_updater.start()
+
+	presence_flusher = PresenceFlusher(presence, 
+										db, 
+										config.viewer_flush_interval,
+										config.replica_id)
+	await presence_flusher.start()
+
+	category_icons = CategoryIcons()
+	category_icons.load(config.categories)
+
+	print(f"Thumbnail mode: {config.tnail_mode}")
+	tnail_generator = FfmpegPull(config.tnail_pull_timeout)
+	if config.tnail_mode == TNAIL_LOCAL_PREVIEW:
+		tnail_generator = LocalPreview(config.preview_dir, fallback=tnail_generator)
+
+	thumbnails = Thumbnails(directory,
+							tnail_generator,
+							config.tnail_workers,
+							config.tnail_queue_size,
+							config.tnail_longevity,
+							config.tnail_refresh_ahead,
+							config.tnail_refresh_interval,
+							config.tnail_max_stale)
+	await thumbnails.start()
+
+	yield
+
+	await thumbnails.stop()
+	await presence_flusher.stop()
+	await ranking_updater.stop()
+	await directory_sync.stop()
+
+	print("Closing upstreams client.")
+	await upstreams.close()
+
+	print("Closing db connection pool.")
+	db.close()
+	db = None
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(CORSMiddleware, 
 				   allow_origins=[f'http://{DOMAIN_NAME}'], 
 				   allow_credentials=True, 
-				   allow_headers=['rid', 'st-auth-mode'])
+				   allow_headers=['rid', 'st-auth-mode'],
+				   expose_headers=[NEXT_CURSOR_HEADER])
 
 
-TNAIL_LONGEVITY = 120 # 120s 
-tnails = {}
-
 def jsonify(content) -> str:
 	return jsonable_encoder(content)
 
-def get_db() -> Db:
-	return Db(AppConfig.get_instance().db_url)
+def etag_matches(request: Request, etag: str) -> bool:
+	if_none_match = request.headers.get('if-none-match')
+	if if_none_match is None:
+		return False
+
+	tags = [ tag.strip() for tag in if_none_match.split(',') ]
+	return '*' in tags or etag in tags
+
+def get_db() -> AsyncDb:
+	return db
 
 def media_server_dict_to_info(data):
 	return MediaServerInfo(quality=data['quality'], access_url=data['media_url'])
@@ -59,8 +179,12 @@ def stream_dict_to_info(data) -> StreamInfo:
 				   category=data['category'],
 				   media_servers=servers)
 
-def stream_data_to_info(data:StreamData)->StreamInfo:
-	servers = list(map(media_server_data_to_info, data.media_servers))
+# Directory's documents are shared, region is filtered here instead of
+# modifying them (filter_region_streams).
+def stream_data_to_info(data:StreamData, region: str = None)->StreamInfo:
+	servers = [ media_server_data_to_info(server) 
+				for server in data.media_servers 
+				if region is None or server.region == region ]
 	return StreamInfo(title=data.title,
 				creator=data.creator,
 				category=data.category,
@@ -77,6 +201,13 @@ def ping():
 # request.ip should be the ingest instance's ip.
 @app.post("/start_stream")
 async def start_stream(request: Request):
+	start = perf_counter()
+	try:
+		return await register_stream(request)
+	finally:
+		start_stream_latency.observe((perf_counter() - start) * 1000)
+
+async def register_stream(request: Request):
 	print("Processing start stream request.")
 	
 	args = url_decode((await request.body()).decode())
@@ -87,8 +218,11 @@ async def start_stream(request: Request):
 	print(f"StreamKey: {key} from: {ingest_ip}")
 
 	try:
-		print(f"Requesting key match for: {key}.")
-		match_res = get(AppConfig.get_instance().match_key_url(key))
+		# Single round trip, tokens_api matches and invalidates the key with
+		# a single query.
+		print(f"Requesting key validation for: {key}.")
+		match_res = await upstreams.get(TOKENS_API, 
+									AppConfig.get_instance().validate_key_url(key))
 
 		if match_res is None: 
 			raise Exception("Match key response is None.")
@@ -101,12 +235,13 @@ async def start_stream(request: Request):
 		print(f"Key successfully matched to: {match_data['value']}")
 
 		print("Saving stream info skeleton.")
-		db_res = get_db().save_empty(match_data["value"], ingest_ip, key)
+		db_res = await get_db().save_empty(match_data["value"], ingest_ip, key)
 		if db_res is None:
 			raise HTTPException(status_code=500)
 			# return  Response(content="Failure.", 
 			# 		   status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 		
+		directory.put(db_res)
 		print("Stream saved.")
 
 		# response.headers["Location"] = match_data["value"]
@@ -125,7 +260,7 @@ async def add_media_server(server_data: MediaServerRequest):
 
 	print(f"Media server:{server_data.media_server_ip} to:{server_data.content_name}")
 
-	add_res = get_db().add_media_server(server_data.content_name, 
+	add_res = await get_db().add_media_server(server_data.content_name, 
 								server_data.quality,
 								server_data.media_server_ip,
 								server_data.region,
@@ -136,6 +271,7 @@ async def add_media_server(server_data: MediaServerRequest):
 		return Response("Failed to add media server.", 
 				status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 	else:
+		directory.put(add_res)
 		return Response("Success.")
 
 @app.post("/remove_media_server")
@@ -144,7 +280,9 @@ async def remove_media_server(remove_req: MediaServerRequest):
 
 	print(f"mediaIp: {remove_req.media_server_ip} content: {remove_req.content_name}")
 
-	get_db().remove_media_server(remove_req.content_name, remove_req.media_server_ip)
+	remove_res = await get_db().remove_media_server(remove_req.content_name, 
+												remove_req.media_server_ip)
+	directory.put(remove_res)
 
 	return Response("Success.")
 
@@ -157,91 +295,124 @@ async def update(update_data: UpdateRequest, request: Request):
 	
 	print("User authorized.")
 
-	update_success = get_db().update(update_data.username, update_data)
+	update_success = await get_db().update(update_data.username, update_data)
 
 	if update_success:
+		directory.put(await get_db().get_stream(update_data.username))
 		return "Stream updated."
 	else: 
 		raise HTTPException(status_code=500, detail='Failed to update stream.')
 
 async def getUser(cookies) -> User:
-	async with AsyncClient() as client: 
-		auth_url = AppConfig.get_instance().is_authenticated_url
-		auth_res: HttpxResp = await client.get(url=auth_url, cookies=cookies)
+	return await session_cache.get(cookies.get(ACCESS_TOKEN_COOKIE), 
+								lambda: fetch_user(cookies))
 
-		if auth_res is None or auth_res.status_code != 200: 
-			return None
+async def fetch_user(cookies) -> User:
+	auth_url = AppConfig.get_instance().is_authenticated_url
+	auth_res: HttpxResp = await upstreams.get(TOKENS_API, auth_url, cookies=cookies)
 
-		return User(**auth_res.json())
+	if auth_res is None or auth_res.status_code != 200: 
+		return None
 
+	return User(**auth_res.json())
+
+# Heartbeats are only aggregated in memory (viewer_presence.py), counts are
+# flushed to the db periodically.
 @app.post("/continue_view")
 async def add_viewer(view_request: ContinueViewRequest):
-
-	print("Processing continue view request.")
-	print(f"User: {view_request.username}, stream:{view_request.stream_name}")
-	
-
-	result = get_db().update_viewer(viewer_username=view_request.username, 
-						stream_name=view_request.stream_name)
-	if result is None: 
-		print("Failed to update viewer.")
-		raise HTTPException(status_code=500)
-		return "Failed to update viewer.", status.HTTP_500_INTERNAL_SERVER_ERROR
-
+	ranking.viewer_seen(view_request.stream_name, view_request.username)
 	return "Viewer updated."
 
 @app.get('/viewer_count/{streamer}')
 async def get_viewer_count(streamer: str):
-	count = get_db().get_view_count(streamer)
-	print(f"Found count: {count}")
+	return ranking.viewer_count(streamer)
+
+# Scope is the listing (and its ordering) the cursor was issued by.
+def parse_cursor(cursor: str, scope: str, key_types: KeyTypes) -> Key:
+	try:
+		return decode_cursor(cursor, scope, key_types)
+	except InvalidCursor as e:
+		print(f"Invalid cursor: {cursor}, reason: {e}")
+		raise HTTPException(status_code=400, detail='Invalid cursor.')
+
+def set_next_cursor(response: Response, scope: str, next_key: Key):
+	if next_key is not None:
+		response.headers[NEXT_CURSOR_HEADER] = encode_cursor(scope, next_key)
 
-	return count
+def ordering_scope(listing: str, ordering: str) -> Tuple[str, KeyTypes]:
+	name = directory.ordering_name(ordering)
+	return f"{listing}:{name}", directory.ordering(name).key_types
 
+# start (offset) is still supported for the clients not using cursor yet, 
+# it is ignored if the cursor is provided.
 @app.get("/all")
-def get_all(region:str="eu", start:int=0, count:int=4, ordering: str = 'None'):
+async def get_all(response: Response,
+				region:str="eu", 
+				start:int=0, 
+				count:int=4, 
+				ordering: str = 'None',
+				cursor: str = None):
 	print("Processing get all streams request.")
 	print(f"Ordering: {ordering}")
-	streams_data = get_db().get_all(start, count, region, ordering)
-
-	if streams_data is None: 
-		print("Failed to obtain requested streams.")
-		return "Failed.", status.HTTP_500_INTERNAL_SERVER_ERROR
+	scope, key_types = ordering_scope('all', ordering)
+	streams_data, next_key = directory.all(ordering, 
+										count, 
+										start=start, 
+										after=parse_cursor(cursor, scope, key_types))
 
-	return list(map(stream_dict_to_info, streams_data))
-	# return list(map(stream_data_to_info, streams_data))
+	set_next_cursor(response, scope, next_key)
+	return list(map(stream_data_to_info, streams_data))
 
 @app.get("/stream_query/{name_query}")
-def get_by_query(name_query: str, 
+async def get_by_query(response: Response,
+			name_query: str, 
 			region:str="eu", 
-			start:int=0, count:int=4):
+			start:int=0, count:int=4,
+			cursor: str = None):
 	
 	print(f"Processing get by query request: {name_query}")
-	streams = get_db().get_by_query(name_query, region , start, count)
+	streams, next_key = directory.get_by_query(name_query, 
+											region, 
+											count, 
+											start=start, 
+											after=parse_cursor(cursor, 
+																'query', 
+																SEARCH_KEY_TYPES))
 	
-	as_objs = list(map(stream_dict_to_info, streams))
+	as_objs = [ stream_data_to_info(data, region) for data in streams ]
 
+	set_next_cursor(response, 'query', next_key)
 	return as_objs
 
 @app.get("/by_category/{category}")
-def get_by_category(category: str, 
+async def get_by_category(response: Response,
+					category: str, 
 					region: str='eu', 
 					start: int = 0, 
 					count:int=3,
-					ordering: str = 'None' ):
+					ordering: str = 'None',
+					cursor: str = None):
 	print(f"Processing get by category request for: {category}")
 	print(f"Ordering: {ordering}")
 
-	streams_data = get_db().get_by_category(category, region, start, count)
-	if streams_data is None:
-		raise HTTPException(status_code=404)
+	scope, key_types = ordering_scope('category', ordering)
+	streams_data, next_key = directory.get_by_category(category, 
+													region, 
+													ordering,
+													count, 
+													start=start, 
+													after=parse_cursor(cursor, 
+																		scope, 
+																		key_types))
 	
-	return list(map(stream_data_to_info, streams_data))
+	set_next_cursor(response, scope, next_key)
+	return [ stream_data_to_info(data, region) for data in streams_data ]
 
 @app.get("/stream_info/{streamer}")
 async def get_stream_info(request: Request, streamer: str, region:str = 'eu'):
 	print(f"Processing get stream info request for: {streamer} in: {region}")
 
-	stream_data:StreamData = get_db().get_stream(streamer)
+	stream_data:StreamData = directory.get(streamer)
 
 	if stream_data is None:
 		raise HTTPException(status_code=404, detail='No such stream..')
@@ -264,8 +435,11 @@ async def get_following(request: Request,
 
 	config = AppConfig.get_instance()
 	following_data: List[FollowingInfo] = []
+	followed_res: HttpxResp = None
 	try: 
-		followed_res = get(config.followingUrl, cookies=request.cookies)
+		followed_res = await upstreams.get(TOKENS_API, 
+										config.followingUrl, 
+										cookies=request.cookies)
 		if followed_res is None:
 			raise Exception("Request failed.")
 		
@@ -276,7 +450,8 @@ async def get_following(request: Request,
 
 	except Exception as e:
 		print(f"Failed to obtain followed channels: {e}")
-		raise HTTPException(status_code=followed_res.status_code, 
+		raise HTTPException(status_code=followed_res.status_code 
+								if followed_res is not None else 500, 
 					detail='Failed to obtain followed channels.')
 
 	return following_data
@@ -296,37 +471,52 @@ def get_explore(region: str="eu", start:int=0, count:int=2):
 
 @app.get("/tnail/{streamer}")
 async def get_tnail(request: Request, streamer: str='unavailable'):
-	print(f"Requested tnail for: {streamer}.")
-
-	config = AppConfig.get_instance()
-
 	if streamer == 'unavailable':
 		print("Requested static unavailable thumbnail.")
 		raise HTTPException(status_code=400, detail='Stream name not provided.') # bad request
 
 	if not is_live(streamer):
 		raise HTTPException(status_code=404, detail='Stream is not live.') 
-	
-	if streamer not in tnails or is_expired(tnails[streamer]):
-		print("Thumbnail expired, will generate new.")
 
-		tnail_path = config.tnail_path(streamer)
-		gen_result = await generate_thumbnail(streamer, tnail_path)
+	tnail = await thumbnails.get(streamer)
+	if tnail is None:
+		raise HTTPException(status_code=503, detail='Thumbnail not available.')
+
+	headers = {'ETag': tnail.etag, 
+			'Cache-Control': f"public, max-age={tnail.max_age()}"}
+
+	if etag_matches(request, tnail.etag):
+		return Response(status_code=304, headers=headers)
+
+	return Response(content=tnail.data, media_type=TNAIL_MEDIA_TYPE, headers=headers)
+
+@app.get("/stats/db_pool")
+def get_db_pool_stats():
+	return pool_stats.as_dict()
+
+@app.get("/stats/start_stream")
+def get_start_stream_stats():
+	return start_stream_latency.as_dict()
 
-		if not gen_result:
-			print(f"Failed to generate thumbnail for: {streamer}.")
-			raise HTTPException(status_code=500) 
+@app.get("/stats/upstream")
+def get_upstream_stats():
+	return upstreams.as_dict()
 
-		exp_date = datetime.now() + timedelta(seconds=TNAIL_LONGEVITY)
-		tnails[streamer] = exp_date
-		print(f"Tnail generated, will expire at: {exp_date}.")
+@app.get("/stats/session_cache")
+def get_session_cache_stats():
+	return session_cache.as_dict()
 
-	if not os.path.exists(config.tnail_path(streamer)):
-		print(f"Failed to generate tnail at: {config.tnail_path(streamer)}")
-		raise HTTPException(status_code=500) 
+@app.get("/stats/viewers")
+async def get_viewers_stats():
+	return presence.as_dict()
 
-	print(f"Returning tnail for {streamer}.")
-	return FileResponse(path=config.tnail_path(streamer), media_type="image/jpg")
+@app.get("/stats/thumbnails")
+async def get_thumbnails_stats():
+	return thumbnails.as_dict()
+
+@app.get("/stats/directory")
+def get_directory_stats():
+	return directory_sync.as_dict()
 
 @app.get("/is_live/{streamer}")
 async def is_live_request(streamer: str):
@@ -352,100 +542,37 @@ def to_public_cat(cat: ConfCategory):
 	return PublicCategory(name=cat.name, display_name=cat.displayName)
 
 @app.get("/category_low_tnail/{category}")
-async def get_category_low_tnail(category: str):
-	cat:ConfCategory = next(filter(lambda c: c.name==category, 
-							AppConfig.get_instance().categories), 
-						None)
-	
-	if cat is None: 
-		raise HTTPException(status_code=404)
-
-	if not os.path.exists(cat.low_icon_path):
-		print(f"Failed to server low icon from: {cat.low_icon_path}")
-		raise HTTPException(status_code=500)
-
-	ext = get_extension(cat.low_icon_path)
-
-	return FileResponse(path=cat.low_icon_path, media_type=f"image/{ext}")
+async def get_category_low_tnail(request: Request, category: str):
+	return category_icon_response(request, category, ICON_LOW)
 
 @app.get("/category_high_tnail/{category}")
-async def get_category_high_tnail(category: str):
-	cat:ConfCategory = next(filter(lambda c: c.name==category, 
-							AppConfig.get_instance().categories), 
-						None)
-	
-	if cat is None: 
+async def get_category_high_tnail(request: Request, category: str):
+	return category_icon_response(request, category, ICON_HIGH)
+
+def category_icon_response(request: Request, category: str, size: str):
+	if not category_icons.has_category(category):
 		raise HTTPException(status_code=404)
 
-	if not os.path.exists(cat.high_icon_path):
-		print(f"Failed to server high icon from: {cat.high_icon_path}")
+	icon = category_icons.get(category, size, request.headers.get('accept'))
+	if icon is None:
+		print(f"Failed to serve {size} icon for: {category}, icon not loaded.")
 		raise HTTPException(status_code=500)
 
-	ext = get_extension(cat.high_icon_path)
+	headers = {'ETag': icon.etag,
+			'Cache-Control': IMMUTABLE_CACHE_CONTROL,
+			'Vary': 'Accept'}
 
-	return FileResponse(path=cat.high_icon_path, media_type=f"image/{ext}")
+	if etag_matches(request, icon.etag):
+		return Response(status_code=304, headers=headers)
 
-def get_extension(file: str):
-	return file.split('.')[1]
+	return Response(content=icon.data, media_type=icon.media_type, headers=headers)
 
 def flatten_cookies(cookies):
 	return f"Cookie: sAccessToken={cookies['sAccessToken']}"
 	return ",".join([f"{key}:{cookies[key]}" for key in cookies])
 
-def is_expired(expiration_date: datetime):
-	return expiration_date is None or datetime.now() > expiration_date
-
-async def generate_thumbnail(streamer, path):
-	print(f"Generate tnail for: {streamer} at: {path}")
-	stream_data:StreamData = get_db().get_stream(streamer)
-
-	found_valid = False
-	preview_servers= filter(preview_quality_filter, stream_data.media_servers)
-	# servers = iter(stream_data.media_servers)
-
-	while (server:=next(preview_servers, None)) and not found_valid: 
-		try:
-			print(f"Pulling from: {server.media_url}")
-			proc = await asyncio.create_subprocess_exec(
-				"ffmpeg",
-				# Replace SessionOrigin field with some secret, or somehow
-				# authenticate registry service.
-				# "-headers", "sessionorigin: streamregistry", 
-				"-i",
-				server.media_url,
-				"-vframes", "1",
-				'-update', '1',
-				path,
-				"-y",
-				stdout=asyncio.subprocess.PIPE,
-				stderr=asyncio.subprocess.PIPE)
-			
-			ret_code = await proc.wait()
-			print(f"Pull return code: {ret_code}")
-
-			# log, err = await proc.communicate()
-
-			# if log is not None:
-			# 	print(f"Log: {log.decode()}")
-
-			# if err is not None: 
-			# 	print(f"Err: {err.decode()}")
-			
-			# For some reason I am getting 'muxing overhead: unknown' error 
-			# but thumbnail is susscessfully generated.
-			# Ignore it I guess ... 
-
-		except Exception as err: 
-			print(f"Error while generating tnail: {err}")
-			return False
-
-	return True
-
-def preview_quality_filter(server:MediaServerData):
-	return server.quality == 'preview'
-
 def is_live(streamer: str):
-	return get_db().get_stream(streamer) is not None
+	return directory.is_live(streamer)
 
 # mockup data
 def gen_stream_info(ind: int):
@@ -466,13 +593,16 @@ async def stop_stream(request: Request):
 	stream_key = args['name']
 
 	print(f"Removing stream with the key: {stream_key}")
-	stream_name = get_db().remove_stream_by_key(stream_key)
+	stream_db = get_db()
+	stream_name = await stream_db.remove_stream_by_key(stream_key)
 
+	# Viewers are in-memory only (viewer_presence.py).
 	if stream_name is not None: 
 		print(f"Clearing viewers for: {stream_name}")
-		get_db().clear_viewers(stream_name)	
+		directory.remove(stream_name)
+		ranking.clear(stream_name)
 	else: 
-		print("Stream name was not resolved, db will eventually clear viewers.")
+		print("Stream name was not resolved.")
 	
 	return Response(f"Stream {stream_key} removed.")
 
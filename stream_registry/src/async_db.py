@@ -0,0 +1,240 @@
+from datetime import datetime, timedelta, UTC
+from ipaddress import ip_address
+from typing import Dict, List
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, TEXT
+from starlette.concurrency import run_in_threadpool
+
+from shared_model.update_request import UpdateRequest
+
+from stream_registry.src.app_config import AppConfig, Config
+from stream_registry.src.db import Db, filter_region_streams, pool_options
+from stream_registry.src.media_server_data import MediaServerData
+from stream_registry.src.pool_stats import PoolStats
+from stream_registry.src.stream_data import StreamData, VIEWER_COUNT_FIELDS
+from stream_registry.src.viewer_data import ViewerData
+
+DRIVER_MOTOR = 'motor'
+DRIVER_SYNC = 'sync'
+
+# StreamData viewer count fields (and their subfields).
+VIEWER_COUNT_FIELDS_REGEX = rf"^({'|'.join(VIEWER_COUNT_FIELDS)})(\.|$)"
+
+# Motor (asyncio) implementation of every Db method, same arguments and same
+# return values (mongoengine documents are built from the raw ones using
+# _from_son) so that api doesn't have to care which one is used.
+# Mongoengine models are still used as the schema, just not for the queries.
+class AsyncDb:
+
+	def __init__(self, conn_string: str,
+				pool_size: int = 100,
+				idle_timeout: timedelta = None,
+				wait_timeout: timedelta = None,
+				pool_stats: PoolStats = None):
+
+		self.client = AsyncIOMotorClient(conn_string,
+			**pool_options(pool_size, idle_timeout, wait_timeout, pool_stats))
+
+		database = self.client.get_default_database()
+		self.streams = database[StreamData._get_collection_name()]
+		self.viewers = database[ViewerData._get_collection_name()]
+
+	# Mongoengine creates these on the first query, motor won't.
+	async def ensure_indexes(self):
+		await self.viewers.create_index('expire_at', expireAfterSeconds=0)
+		await self.streams.create_index([('title', TEXT), ('creator', TEXT)],
+										default_language='english',
+										weights={'title': 2, 'creator': 10})
+
+	def close(self):
+		self.client.close()
+
+	async def get_all(self, from_ind, cnt, region, ordering):
+		pipeline = []
+
+		if ordering == "Recommended":
+			pipeline = Db.recommended_sort_pipeline()
+		elif ordering == "Views":
+			pipeline = Db.views_sort_pipeline()
+		else:
+			pipeline = Db.no_sort_pipeline()
+
+		pipeline.append(Db.from_stage(from_ind))
+		pipeline.append(Db.count_stage(cnt))
+
+		return await self.streams.aggregate(pipeline).to_list(None)
+
+	async def get_by_query(self, name_query: str, region: str, s_index:int, count:int):
+		pipeline = Db.search_pipeline(name_query, region, s_index, count)
+		return await self.streams.aggregate(pipeline).to_list(None)
+
+	async def get_by_category(self,
+					category: str,
+					region: str,
+					start: int,
+					count: int) -> List[StreamData]:
+
+		cursor = self.streams.find({'category': category,
+								'media_servers.region': region})\
+					.skip(start)\
+					.limit(count)
+
+		datas = [ StreamData._from_son(doc) async for doc in cursor ]
+		return filter_region_streams(datas, region)
+
+	async def save_empty(self, creator: str,
+				ingest_ip: str,
+				stream_key: str) -> StreamData:
+
+		data = StreamData.empty(creator, ingest_ip, stream_key)
+		data.validate()
+
+		insert_res = await self.streams.insert_one(data.to_mongo().to_dict())
+		data.id = insert_res.inserted_id
+
+		return data
+
+	async def update(self, streamer: str, update_req: UpdateRequest) -> bool:
+
+		if not Db.validate_category(update_req.category):
+			print(f"Failed to update, stream category invalid: {update_req.category}")
+			return False
+
+		update_result = await self.streams.update_one(
+			{'creator': streamer},
+			{'$set': {'title': update_req.title,
+					'category': update_req.category,
+					'is_public': update_req.is_public}})
+
+		return update_result.matched_count > 0
+
+	async def remove_stream_by_key(self, key:str) -> str:
+		data = await self.streams.find_one_and_delete({'stream_key': key},
+													projection={'creator': True})
+		if data is not None:
+			return data['creator']
+
+		return None
+
+	async def add_media_server(self, stream_creator: str,
+					quality: str,
+					server_ip: str,
+					region:str,
+					media_url:str) -> StreamData:
+
+		new_server_data = MediaServerData(quality=quality,
+									ip=int(ip_address(server_ip)),
+									region=region,
+									media_url=media_url)
+
+		# $addToSet makes already registered server a no-op, same as the
+		# 'already registered' check in the sync version.
+		stream = await self.streams.find_one_and_update(
+			{'creator': stream_creator},
+			{'$addToSet': {'media_servers': new_server_data.to_mongo().to_dict()}},
+			return_document=ReturnDocument.AFTER)
+
+		if stream is None:
+			print(f"Failed to find stream with creator: {stream_creator} ...")
+			return None
+
+		return StreamData._from_son(stream)
+
+	async def remove_media_server(self, stream_creator: str, server_ip: str) -> StreamData:
+		int_addr = int(ip_address(server_ip))
+
+		stream = await self.streams.find_one_and_update(
+			{'creator': stream_creator},
+			{'$pull': {'media_servers': {'ip': int_addr}}},
+			return_document=ReturnDocument.AFTER)
+
+		if stream is None:
+			# Normal, see the sync version.
+			print("Failed to find requested stream data.")
+			return None
+
+		return StreamData._from_son(stream)
+
+	async def get_stream(self, streamer) -> StreamData:
+		stream = await self.streams.find_one({'creator': streamer})
+		return StreamData._from_son(stream) if stream is not None else None
+
+	async def get_all_streams(self) -> List[StreamData]:
+		return [ StreamData._from_son(doc) async for doc in self.streams.find() ]
+
+	# Requires replica set. Used as an async context manager and iterator.
+	# Updates of the viewer counts only (presence flushes of every replica)
+	# are filtered out, directory takes the counts from the local ranking.
+	def watch_streams(self):
+		changed_fields = {'$map': {'input': {'$objectToArray': '$updateDescription.updatedFields'},
+								'in': '$$this.k'}}
+		other_fields = {'$filter': {'input': changed_fields,
+									'cond': {'$not': [{'$regexMatch': {
+										'input': '$$this',
+										'regex': VIEWER_COUNT_FIELDS_REGEX}}]}}}
+
+		pipeline = [{'$match': {'$expr': {'$or': [
+			{'$ne': ['$operationType', 'update']},
+			{'$gt': [{'$size': other_fields}, 0]},
+			{'$gt': [{'$size': {'$ifNull': ['$updateDescription.removedFields', []]}}, 0]}
+		]}}}]
+
+		return self.streams.watch(pipeline, full_document='updateLookup')
+
+	async def update_viewer(self, viewer_username: str, stream_name: str) -> ViewerData:
+		longevity = AppConfig.get_instance().viewer_longevity
+
+		view_data = await self.viewers.find_one_and_update(
+			{'stream': stream_name, 'viewer': viewer_username},
+			{'$set': {'expire_at': datetime.now(UTC) + longevity}},
+			upsert=True,
+			return_document=ReturnDocument.AFTER)
+
+		return ViewerData._from_son(view_data)
+
+	async def clear_viewers(self, stream_name) -> int:
+		delete_result = await self.viewers.delete_many({'stream': stream_name})
+		return delete_result.deleted_count
+
+	async def set_viewer_counts(self, counts: Dict[str, int], replica: str):
+		await self.streams.bulk_write(Db.viewer_count_updates(counts, replica), ordered=False)
+
+	async def get_view_count(self, stream_name):
+		return await self.viewers.count_documents({'stream': stream_name})
+
+# Exposes the sync Db with the same (awaitable) interface as the AsyncDb,
+# each call is executed in the starlette's threadpool so that at least the
+# event loop is not blocked. Useful where motor is not available.
+class ThreadedDb:
+
+	def __init__(self, db: Db):
+		self.db = db
+
+	async def ensure_indexes(self):
+		pass
+
+	def close(self):
+		self.db.close()
+
+	def __getattr__(self, name):
+		method = getattr(self.db, name)
+
+		async def threaded_call(*args, **kwargs):
+			return await run_in_threadpool(method, *args, **kwargs)
+
+		return threaded_call
+
+async def open_db(config: Config, pool_stats: PoolStats):
+	pool_args = {'pool_size': config.db_pool_size,
+				'idle_timeout': config.db_pool_idle_timeout,
+				'wait_timeout': config.db_pool_wait_timeout,
+				'pool_stats': pool_stats}
+
+	if config.db_driver == DRIVER_SYNC:
+		db = ThreadedDb(Db(config.db_url, **pool_args))
+	else:
+		db = AsyncDb(config.db_url, **pool_args)
+
+	await db.ensure_indexes()
+	return db
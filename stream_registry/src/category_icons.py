@@ -0,0 +1,99 @@
+from dataclasses import dataclass
+from hashlib import sha1
+from mimetypes import guess_type
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+from stream_registry.src.app_config import Category
+
+ICON_LOW = 'low'
+ICON_HIGH = 'high'
+
+# Precomputed variants are looked up next to the original icon (same name,
+# different extension), in the order of preference.
+VARIANTS = [('.avif', 'image/avif'), ('.webp', 'image/webp')]
+
+# Icons only change with a new deployment, clients never have to revalidate.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+@dataclass
+class IconVariant:
+	data: bytes
+	media_type: str
+	etag: str
+
+def load_variant(path: str, media_type: str) -> Optional[IconVariant]:
+	try:
+		with open(path, 'rb') as icon_file:
+			data = icon_file.read()
+	except FileNotFoundError:
+		return None
+
+	return IconVariant(data=data,
+					media_type=media_type,
+					etag=f'"{sha1(data).hexdigest()}"')
+
+def get_media_type(path: str) -> str:
+	media_type, _ = guess_type(path)
+	return media_type if media_type is not None else 'application/octet-stream'
+
+# Media types from the Accept header, ones with q=0 are excluded.
+def accepted_types(accept: str) -> Set[str]:
+	types = set()
+	for media_range in accept.split(','):
+		media_type, *params = [ part.strip() for part in media_range.split(';') ]
+		if any(param.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+			for param in params):
+			continue
+
+		types.add(media_type.lower())
+
+	return types
+
+# Category icons (and their webp/avif variants) read once on startup and
+# served from memory, indexed by (category name, ICON_LOW/ICON_HIGH).
+class CategoryIcons:
+
+	def __init__(self):
+		# (category, size) -> variants, preferred first, original is the last one
+		self.icons: Dict[Tuple[str, str], List[IconVariant]] = {}
+		self.categories: Set[str] = set()
+
+	def load(self, categories: List[Category]):
+		for cat in categories:
+			self.categories.add(cat.name)
+
+			for size, path in ((ICON_LOW, cat.low_icon_path),
+							(ICON_HIGH, cat.high_icon_path)):
+
+				original = load_variant(path, get_media_type(path))
+				if original is None:
+					print(f"Failed to load {size} icon for: {cat.name} from: {path}")
+					continue
+
+				stem, _ = os.path.splitext(path)
+				variants = [ variant
+							for ext, media_type in VARIANTS
+							if (variant := load_variant(stem + ext, media_type)) is not None ]
+
+				self.icons[(cat.name, size)] = variants + [original]
+
+	def has_category(self, category: str) -> bool:
+		return category in self.categories
+
+	# Returns None if icon is not loaded.
+	def get(self, category: str, size: str, accept: str = None) -> Optional[IconVariant]:
+		variants = self.icons.get((category, size))
+		if variants is None:
+			return None
+
+		accepted = accepted_types(accept) if accept is not None else set()
+		for variant in variants[:-1]:
+			if variant.media_type in accepted:
+				return variant
+
+		return variants[-1]
+
+	def as_dict(self):
+		return {f"{category}/{size}": [ variant.media_type for variant in variants ]
+				for (category, size), variants in self.icons.items()}
@@ -1,15 +1,17 @@
-from typing import List
+from typing import Dict, List
 from stream_data import StreamData
 from shared_model.update_request import UpdateRequest
 from stream_data import StreamData
 from stream_category import StreamCategory
 from mongoengine import connect, disconnect
+from pymongo import UpdateOne
 from ipaddress import ip_address
 
 from stream_registry.src.media_server_data import MediaServerData
 from stream_registry.src.viewer_data import ViewerData
+from stream_registry.src.pool_stats import PoolStats
 
-from datetime import datetime, UTC
+from datetime import datetime, timedelta, UTC
 from app_config import AppConfig
 
 def filter_region_streams(streams, region):
@@ -18,17 +20,44 @@ def filter_region_streams(streams, region):
 	def region_filter(stream:StreamData):
 		return stream.region == region
 
+	streams = list(streams)
 	for stream in streams:
 		stream.media_servers = list(filter(region_filter, stream.media_servers ))
 		
 	return streams
 
-# TODO refactor this to be just a collection of methods, where each calls
-# connect at the beginning.
+# Same options are passed to the async (motor) client, see async_db.py.
+def pool_options(pool_size: int, 
+				idle_timeout: timedelta, 
+				wait_timeout: timedelta, 
+				pool_stats: PoolStats):
+
+	options = {'maxPoolSize': pool_size}
+
+	if idle_timeout is not None:
+		options['maxIdleTimeMS'] = int(idle_timeout.total_seconds()*1000)
+
+	if wait_timeout is not None:
+		options['waitQueueTimeoutMS'] = int(wait_timeout.total_seconds()*1000)
+
+	if pool_stats is not None:
+		options['event_listeners'] = [pool_stats]
+
+	return options
+
+# Single instance is supposed to live as long as the process does (api creates
+# it on startup and closes it on shutdown), mongoengine/pymongo client it
+# connects holds the connection pool shared by all of the requests.
 class Db:
 
-	def __init__(self, conn_string: str):
-		connect(host=conn_string)
+	def __init__(self, conn_string: str, 
+				pool_size: int = 100, 
+				idle_timeout: timedelta = None,
+				wait_timeout: timedelta = None,
+				pool_stats: PoolStats = None):
+
+		connect(host=conn_string, 
+			**pool_options(pool_size, idle_timeout, wait_timeout, pool_stats))
 
 	def close(self):
 		disconnect()
@@ -36,15 +65,42 @@ class Db:
 	def fetch_analytics(viewer: str):
 		return []
 
+	# Db only has the viewer counts (persisted by the api) and the categories,
+	# follower counts are only considered by the api's in-memory ranking.
 	def recommended_sort_pipeline():
-		return [{'$match': {}}]
+		scores = AppConfig.get_instance().ranking_category_scores
+		branches = [ {'case': {'$eq': ['$category', category]}, 'then': score}
+					for category, score in scores.items() ]
+
+		return [
+			{'$addFields': {'rec_score': {'$add': [
+				{'$ifNull': ['$viewer_count', 0]},
+				{'$switch': {'branches': branches, 'default': 0}}
+			]}}},
+			{'$sort': {'rec_score': -1, '_id': 1}},
+			{'$project': {'rec_score': False}}
+		]
 
 	def views_sort_pipeline():
-		return [{'$match': {}}]
+		return [{'$sort': {'viewer_count': -1, '_id': 1}}]
 
 	def no_sort_pipeline():
 		return [{'$match': {}}]
 
+	# Used by the api's viewer presence flush, see viewer_presence.py. Sets
+	# the replica's count and recomputes the total (viewer_count) from the
+	# counts of all of the replicas, within the same (atomic) update.
+	def viewer_count_updates(counts: Dict[str, int], replica: str) -> List[UpdateOne]:
+		field = replica_field(replica)
+		return [ UpdateOne({'creator': creator}, [
+					{'$set': {'replica_viewer_counts': {'$mergeObjects': [
+						{'$ifNull': ['$replica_viewer_counts', {}]},
+						{field: count}]}}},
+					{'$set': {'viewer_count': {'$sum': {'$map': {
+						'input': {'$objectToArray': '$replica_viewer_counts'},
+						'in': '$$this.v'}}}}}])
+				for creator, count in counts.items() ]
+
 	def from_stage(ind: int):
 		return {'$skip': ind}
 
@@ -70,22 +126,36 @@ class Db:
 		# 	.skip(from_ind)\
 		# 	.limit(cnt)
 
-		return StreamData.objects().aggregate(pipeline)
+		return list(StreamData.objects().aggregate(pipeline))
 
 		# return filter_region_streams(datas, region)
 
-	def get_by_query(self, name_query: str, region: str, s_index:int, count:int):
-		return StreamData.objects().aggregate([
-			{'$match': {
-				"$or": [
-					{'$expr': {'$gt': [{'$indexOfCP': ["$title", name_query]}, -1]}},
-					{'$expr': {'$gt': [{'$indexOfCP': ["$creator", name_query]}, -1]}},
-				]
+	# Text index (see StreamData.meta) matches whole (stemmed) words, not
+	# substrings like the in-process search index does.
+	def search_pipeline(name_query: str, region: str, s_index: int, count: int):
+		return [
+			{'$match': {'$text': {'$search': name_query}, 
+						'media_servers.region': region}},
+			{'$sort': {'score': {'$meta': 'textScore'}, '_id': 1}},
+			Db.from_stage(s_index),
+			Db.count_stage(count),
+			{'$project': {
+				'title': True,
+				'creator': True,
+				'category': True,
+				'media_servers': { 
+					'$filter': {
+						'input': '$media_servers',
+						'as': 'server',
+						'cond': {"$eq": ['$$server.region', region]}
+					}
+				}
 			}}
-			# {"$match": {"region": region}},
-			# Db.from_stage(s_index),
-			# Db.count_stage(count)
-		])
+		]
+
+	def get_by_query(self, name_query: str, region: str, s_index:int, count:int):
+		pipeline = Db.search_pipeline(name_query, region, s_index, count)
+		return list(StreamData.objects().aggregate(pipeline))
 	
 	def get_by_category(self, 
 					category: StreamCategory, 
@@ -125,8 +195,8 @@ class Db:
 		return next(filter(lambda c: c.name == cat, cats), None) is not None
 
 	def remove_stream_by_key(self, key:str) -> str: # return the name
-		data = StreamData.objects(stream_key=key).first()
-		data.delete()
+		# Single findAndModify, stream is resolved and removed atomically.
+		data = StreamData.objects(stream_key=key).only('creator').modify(remove=True)
 
 		if data is not None: 
 			return data.creator
@@ -160,7 +230,7 @@ class Db:
 			print("Media server already registered.")
 			# If None is returned the return code is server error, cdn_instance
 			# will keep trying to execute on_publish call. 
-			return new_server_data
+			return stream
 		
 
 		stream.media_servers.append(new_server_data)
@@ -193,6 +263,9 @@ class Db:
 
 	def get_stream(self, streamer) -> StreamData:
 		return StreamData.objects(creator=streamer).first()
+
+	def get_all_streams(self) -> List[StreamData]:
+		return list(StreamData.objects())
 	
 	def update_viewer(self, viewer_username: str, stream_name: str) -> ViewerData: 
 		view_data = ViewerData.objects(stream=stream_name, viewer=viewer_username).first()
@@ -212,13 +285,17 @@ class Db:
 
 		return view_data.save()
 	
-	def clear_viewers(self, stream_name):
-		viewers = ViewerData.objects(stream=stream_name)
+	# Single server-side delete, returns the number of removed documents.
+	def clear_viewers(self, stream_name) -> int:
+		return ViewerData.objects(stream=stream_name).delete()
 
-		print("Viewers: ")
-		for v in viewers:
-			print(v.to_json())
-			v.delete()
+	def set_viewer_counts(self, counts: Dict[str, int], replica: str):
+		StreamData._get_collection().bulk_write(Db.viewer_count_updates(counts, replica),
+												ordered=False)
 
 	def get_view_count(self, stream_name):
 		return ViewerData.objects(stream=stream_name).count()
+
+# Replica id as a field name (no dots or $).
+def replica_field(replica: str) -> str:
+	return replica.replace('.', '_').replace('$', '_')
@@ -0,0 +1,114 @@
+import asyncio
+from dataclasses import dataclass, asdict
+from fractions import Fraction
+import os
+from typing import Optional
+
+import av
+
+from stream_registry.src.stream_data import StreamData
+from stream_registry.src.thumbnails import ThumbnailGenerator
+
+# Written by the cdn instance's preview application (hls_nested on), one
+# directory per stream.
+PLAYLIST_NAME = 'index.m3u8'
+JPEG_PIX_FMT = 'yuvj420p'
+# mjpeg quantizer, 2 (best) - 31 (worst).
+JPEG_QUALITY = 3
+
+@dataclass
+class LocalPreviewStats:
+	local: int = 0
+	# Preview segment not found (or not decodable), fallback was used.
+	fallbacks: int = 0
+
+# Newest complete segment is the last one listed in the playlist, the newest
+# file in the directory may be the one still being written.
+def latest_segment(stream_dir: str) -> Optional[str]:
+	try:
+		with open(os.path.join(stream_dir, PLAYLIST_NAME)) as playlist:
+			lines = playlist.read().splitlines()
+	except FileNotFoundError:
+		return None
+
+	segments = [ line for line in lines if line and not line.startswith('#') ]
+	if len(segments) == 0:
+		return None
+
+	return os.path.join(stream_dir, segments[-1])
+
+# Only keyframes are decoded, the last one in the segment is the newest frame
+# that doesn't depend on any other.
+def decode_keyframe(segment: str) -> Optional[av.VideoFrame]:
+	with av.open(segment) as container:
+		if len(container.streams.video) == 0:
+			return None
+
+		video = container.streams.video[0]
+		video.codec_context.skip_frame = 'NONKEY'
+
+		frame = None
+		for frame in container.decode(video):
+			pass
+
+		return frame
+
+def encode_jpeg(frame: av.VideoFrame) -> bytes:
+	encoder = av.CodecContext.create('mjpeg', 'w')
+	encoder.width = frame.width
+	encoder.height = frame.height
+	encoder.pix_fmt = JPEG_PIX_FMT
+	encoder.time_base = Fraction(1, 1)
+	encoder.options = {'qmin': str(JPEG_QUALITY), 'qmax': str(JPEG_QUALITY)}
+
+	frame = frame.reformat(format=JPEG_PIX_FMT)
+	packets = encoder.encode(frame) + encoder.encode(None)
+	return b''.join(bytes(packet) for packet in packets)
+
+# Takes the thumbnail from the preview HLS the cdn instance already writes
+# (128x72, see ingest/nginx.conf) instead of pulling it through the cdn with
+# ffmpeg: no subprocess, no network hop, just a read of a ~100KB segment from
+# the shared preview volume and an in-process decode (PyAV).
+# Streams whose preview is not in the preview_dir (served by some other cdn
+# instance) are handled by the fallback generator, if provided.
+class LocalPreview:
+
+	def __init__(self, preview_dir: str, fallback: ThumbnailGenerator = None):
+		self.preview_dir = preview_dir
+		self.fallback = fallback
+		self.stats = LocalPreviewStats()
+
+	async def generate(self, stream: StreamData) -> Optional[bytes]:
+		# Decode is blocking, PyAV releases the GIL while in ffmpeg.
+		data = await asyncio.to_thread(self.grab, stream.creator)
+		if data is not None:
+			self.stats.local += 1
+			return data
+
+		if self.fallback is None:
+			return None
+
+		self.stats.fallbacks += 1
+		return await self.fallback.generate(stream)
+
+	def grab(self, creator: str) -> Optional[bytes]:
+		segment = latest_segment(os.path.join(self.preview_dir, creator))
+		if segment is None:
+			return None
+
+		# None (any decode/encode failure included) lets the fallback run.
+		try:
+			frame = decode_keyframe(segment)
+			if frame is None:
+				return None
+
+			data = encode_jpeg(frame)
+		except (av.FFmpegError, OSError, ValueError) as e:
+			# Segment can be removed (hls_playlist_length) while being read.
+			print(f"Failed to grab preview from: {segment}, reason: {e}")
+			return None
+
+		return data if len(data) > 0 else None
+
+	def as_dict(self):
+		return asdict(self.stats)
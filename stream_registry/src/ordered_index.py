@@ -0,0 +1,113 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bisect import bisect_right, insort
+from itertools import islice
+from json import dumps, loads
+from typing import Callable, Dict, List, Tuple
+
+from stream_registry.src.stream_data import StreamData
+
+# Sort key is (primary value(s)..., str(_id), creator), _id makes it unique and
+# therefore stable across pages, creator is there just to resolve the stream.
+Key = Tuple
+
+# Types of the key's elements (checked for the keys decoded from cursors).
+NUMBER = (int, float)
+KeyTypes = Tuple
+VIEWS_KEY_TYPES: KeyTypes = (NUMBER, str, str)
+CREATION_KEY_TYPES: KeyTypes = (str, str)
+
+class InvalidCursor(Exception):
+	pass
+
+def views_key(stream: StreamData) -> Key:
+	return (-(stream.viewer_count or 0), str(stream.id), stream.creator)
+
+def creation_key(stream: StreamData) -> Key:
+	return (str(stream.id), stream.creator)
+
+# Streams sorted by the provided key function, used for keyset (cursor)
+# pagination: next page starts right after the last key of the previous one
+# no matter how many streams started or stopped in between, and its cost
+# doesn't depend on how deep the page is.
+class OrderedIndex:
+
+	def __init__(self, key_func: Callable[[StreamData], Key], key_types: KeyTypes):
+		self.key_func = key_func
+		self.key_types = key_types
+		self.keys: List[Key] = []
+		self.by_creator: Dict[str, Key] = {}
+
+	def __len__(self):
+		return len(self.keys)
+
+	def put(self, stream: StreamData):
+		key = self.key_func(stream)
+		if self.by_creator.get(stream.creator) == key:
+			return
+
+		self.remove(stream.creator)
+		insort(self.keys, key)
+		self.by_creator[stream.creator] = key
+
+	def remove(self, creator: str):
+		key = self.by_creator.pop(creator, None)
+		if key is None:
+			return
+
+		ind = bisect_right(self.keys, key) - 1
+		del self.keys[ind]
+
+	# Either after (cursor's key) or start (plain offset, kept for the clients
+	# not using cursors yet) is used. Returns at most count keys.
+	def page(self, count: int,
+			start: int = 0,
+			after: Key = None,
+			accept: Callable[[str], bool] = None) -> List[Key]:
+
+		if after is not None:
+			start = bisect_right(self.keys, tuple(after))
+			skip = 0
+		elif accept is not None:
+			# Offset is in the filtered sequence.
+			skip = start
+			start = 0
+		else:
+			skip = 0
+
+		keys = ( self.keys[ind] for ind in range(start, len(self.keys)) )
+		if accept is not None:
+			keys = ( k for k in keys if accept(k[-1]) )
+
+		return list(islice(keys, skip, skip + count))
+
+# Cursor is bound to the listing (and ordering) it was issued for (scope),
+# keys of the other orderings are not comparable.
+def encode_cursor(scope: str, key: Key) -> str:
+	return urlsafe_b64encode(dumps([scope, key]).encode()).decode()
+
+def decode_cursor(cursor: str, scope: str, key_types: KeyTypes) -> Key:
+	if cursor is None:
+		return None
+
+	try:
+		data = loads(urlsafe_b64decode(cursor.encode()))
+	except Exception as e:
+		raise InvalidCursor(f"Malformed cursor: {e}")
+
+	if not isinstance(data, list) or len(data) != 2 or not isinstance(data[1], list):
+		raise InvalidCursor("Malformed cursor.")
+
+	if data[0] != scope:
+		raise InvalidCursor(f"Cursor of: {data[0]} used for: {scope}.")
+
+	key = tuple(data[1])
+	if len(key) != len(key_types) or \
+			not all(matches_type(value, value_type) 
+					for value, value_type in zip(key, key_types)):
+		raise InvalidCursor(f"Cursor key doesn't match: {scope}.")
+
+	return key
+
+def matches_type(value, value_type) -> bool:
+	# bool is an int as well.
+	return isinstance(value, value_type) and not isinstance(value, bool)
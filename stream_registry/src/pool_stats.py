@@ -0,0 +1,80 @@
+from dataclasses import dataclass, asdict
+from threading import Lock
+
+from pymongo import monitoring
+
+@dataclass
+class PoolCounters:
+	checkouts: int = 0
+	checkins: int = 0
+	# Checkout started while every pooled connection was already in use.
+	waits: int = 0
+	# Usually waitQueueTimeoutMS expired or the pool was cleared.
+	checkout_failures: int = 0
+	connections_created: int = 0
+	connections_closed: int = 0
+	pools_cleared: int = 0
+	in_use: int = 0
+	open: int = 0
+
+# Registered as pymongo event listener on the registry's client so that pool
+# usage can be exposed through /stats/db_pool and used to size the pool.
+# Events are emitted from whichever thread is doing the checkout, hence the lock.
+class PoolStats(monitoring.ConnectionPoolListener):
+
+	def __init__(self, max_pool_size: int):
+		self.max_pool_size = max_pool_size
+		self.counters = PoolCounters()
+		self.lock = Lock()
+
+	def as_dict(self):
+		with self.lock:
+			data = asdict(self.counters)
+
+		data['max_pool_size'] = self.max_pool_size
+		return data
+
+	def pool_created(self, event):
+		pass
+
+	def pool_ready(self, event):
+		pass
+
+	def pool_cleared(self, event):
+		with self.lock:
+			self.counters.pools_cleared += 1
+
+	def pool_closed(self, event):
+		pass
+
+	def connection_created(self, event):
+		with self.lock:
+			self.counters.connections_created += 1
+			self.counters.open += 1
+
+	def connection_ready(self, event):
+		pass
+
+	def connection_closed(self, event):
+		with self.lock:
+			self.counters.connections_closed += 1
+			self.counters.open -= 1
+
+	def connection_check_out_started(self, event):
+		with self.lock:
+			if self.counters.in_use >= self.max_pool_size:
+				self.counters.waits += 1
+
+	def connection_check_out_failed(self, event):
+		with self.lock:
+			self.counters.checkout_failures += 1
+
+	def connection_checked_out(self, event):
+		with self.lock:
+			self.counters.checkouts += 1
+			self.counters.in_use += 1
+
+	def connection_checked_in(self, event):
+		with self.lock:
+			self.counters.checkins += 1
+			self.counters.in_use -= 1
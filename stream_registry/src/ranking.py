@@ -0,0 +1,131 @@
+import asyncio
+from datetime import timedelta
+from typing import Dict, List, Set
+
+from stream_registry.src.stream_data import StreamData
+from stream_registry.src.upstream import TOKENS_API
+from stream_registry.src.viewer_presence import ViewerPresence
+
+VIEWER_WEIGHT = 1.0
+FOLLOWER_WEIGHT = 0.2
+# Has to be at most the tokens_api's follower_counts_max.
+FOLLOWER_COUNTS_BATCH = 500
+
+# Per-stream viewer counts (from the viewer presence) and follower counts
+# from which the recommendation score is computed. Counts are updated
+# incrementally (viewer_seen, clear, set_followers) and the streams whose
+# score changed are marked dirty, the directory re-sorts them in batches
+# (RankingUpdater) instead of on every heartbeat.
+class Ranking:
+
+	def __init__(self, presence: ViewerPresence, category_scores: Dict[str, int]):
+		self.presence = presence
+		self.category_scores = category_scores
+
+		self.followers: Dict[str, int] = {}
+		self.dirty: Set[str] = set()
+
+	def viewer_count(self, creator: str) -> int:
+		return self.presence.count(creator)
+
+	def follower_count(self, creator: str) -> int:
+		return self.followers.get(creator, 0)
+
+	def score(self, stream: StreamData) -> float:
+		return VIEWER_WEIGHT * self.viewer_count(stream.creator) \
+			+ FOLLOWER_WEIGHT * self.follower_count(stream.creator) \
+			+ self.category_scores.get(stream.category, 0)
+
+	def viewer_seen(self, creator: str, viewer: str):
+		if self.presence.seen(creator, viewer):
+			self.dirty.add(creator)
+
+	def clear(self, creator: str):
+		if self.presence.clear(creator):
+			self.dirty.add(creator)
+
+	def expire(self):
+		self.dirty |= self.presence.expire()
+
+	def set_followers(self, counts: Dict[str, int]):
+		for creator in set(counts) | set(self.followers):
+			if counts.get(creator, 0) != self.followers.get(creator, 0):
+				self.dirty.add(creator)
+
+		self.followers = counts
+
+	def take_dirty(self) -> Set[str]:
+		dirty = self.dirty
+		self.dirty = set()
+		return dirty
+
+# Periodically expires viewers, re-sorts the dirty streams and refreshes the
+# follower counts of the live streams (from the tokens api).
+class RankingUpdater:
+
+	def __init__(self, ranking: Ranking,
+			directory,
+			upstreams,
+			follower_counts_url: str,
+			rerank_interval: timedelta,
+			followers_interval: timedelta):
+
+		self.ranking = ranking
+		self.directory = directory
+		self.upstreams = upstreams
+		self.follower_counts_url = follower_counts_url
+		self.rerank_interval = rerank_interval.total_seconds()
+		self.followers_interval = followers_interval.total_seconds()
+
+		self.tasks: List[asyncio.Task] = []
+
+	async def start(self):
+		self.tasks.append(asyncio.create_task(self.rerank_loop()))
+		self.tasks.append(asyncio.create_task(self.followers_loop()))
+
+	async def stop(self):
+		for task in self.tasks:
+			task.cancel()
+
+		await asyncio.gather(*self.tasks, return_exceptions=True)
+		self.tasks = []
+
+	def rerank(self):
+		self.ranking.expire()
+		self.directory.rerank(self.ranking.take_dirty())
+
+	async def rerank_loop(self):
+		while True:
+			await asyncio.sleep(self.rerank_interval)
+			try:
+				self.rerank()
+			except Exception as e:
+				print(f"Failed to rerank streams: {e}")
+
+	async def refresh_followers(self):
+		creators = self.directory.creators()
+		if len(creators) == 0:
+			self.ranking.set_followers({})
+			return
+
+		# tokens_api limits the number of users per request.
+		counts = {}
+		for start in range(0, len(creators), FOLLOWER_COUNTS_BATCH):
+			batch = creators[start:start + FOLLOWER_COUNTS_BATCH]
+			res = await self.upstreams.post(TOKENS_API, self.follower_counts_url, json=batch)
+			if res.status_code != 200:
+				print(f"Failed to fetch follower counts: {res.status_code}")
+				return
+
+			counts.update(res.json())
+
+		self.ranking.set_followers(counts)
+
+	async def followers_loop(self):
+		while True:
+			try:
+				await self.refresh_followers()
+			except Exception as e:
+				print(f"Failed to refresh follower counts: {e}")
+
+			await asyncio.sleep(self.followers_interval)
@@ -0,0 +1,145 @@
+from heapq import nsmallest
+from typing import Callable, Dict, List, Set, Tuple
+
+from stream_registry.src.ordered_index import NUMBER, KeyTypes
+
+# (-score, creator)
+SEARCH_KEY_TYPES: KeyTypes = (NUMBER, str)
+
+GRAM_LEN = 3
+
+# Relevance weights, match on the creator's name is worth more than the one
+# on the title (same as the weights in the stream_data text index).
+EXACT_CREATOR = 100
+CREATOR_PREFIX = 50
+IN_CREATOR = 20
+TITLE_WORD_PREFIX = 10
+IN_TITLE = 5
+
+# In-process search over the creator names and titles of the live streams.
+# Queries of at least GRAM_LEN characters are resolved using the trigram
+# index (intersection of the posting sets, then verified as a substring, same
+# semantics as the old $indexOfCP query, just case insensitive), shorter ones
+# are matched as word prefixes using the prefix index.
+class SearchIndex:
+
+	def __init__(self):
+		self.grams: Dict[str, Set[str]] = {}
+		self.prefixes: Dict[str, Set[str]] = {}
+		self.fields: Dict[str, Tuple[str, str]] = {} # creator -> (creator, title)
+
+	def __len__(self):
+		return len(self.fields)
+
+	def add(self, creator: str, title: str):
+		self.remove(creator)
+
+		fields = (creator.lower(), title.lower())
+		self.fields[creator] = fields
+
+		for gram in grams_of(fields):
+			self.grams.setdefault(gram, set()).add(creator)
+
+		for prefix in prefixes_of(fields):
+			self.prefixes.setdefault(prefix, set()).add(creator)
+
+	def remove(self, creator: str):
+		fields = self.fields.pop(creator, None)
+		if fields is None:
+			return
+
+		for gram in grams_of(fields):
+			discard_from(self.grams, gram, creator)
+
+		for prefix in prefixes_of(fields):
+			discard_from(self.prefixes, prefix, creator)
+
+	# Returns (-score, creator) keys ordered by relevance (and then by name). 
+	# Only the accepted ones ranked after the provided key (previous page's 
+	# last one) are considered and if limit is provided only the best limit
+	# of them are sorted.
+	def search(self, query: str, 
+			limit: int = None, 
+			accept: Callable[[str], bool] = None,
+			after: Tuple[int, str] = None) -> List[Tuple[int, str]]:
+
+		query = query.strip().lower()
+		if query == "":
+			return []
+
+		if len(query) >= GRAM_LEN:
+			candidates = self.gram_candidates(query)
+		else:
+			candidates = self.prefixes.get(query, set())
+
+		if accept is not None:
+			candidates = filter(accept, candidates)
+
+		# Gram candidates are not verified, score of 0 means query is not 
+		# actually contained in any of the fields.
+		scored = ( (-score, creator) 
+					for creator in candidates
+					if (score := self.score(query, creator)) > 0 )
+
+		if after is not None:
+			after = tuple(after)
+			scored = ( key for key in scored if key > after )
+
+		if limit is not None:
+			return nsmallest(limit, scored)
+		else:
+			return sorted(scored)
+
+	def gram_candidates(self, query: str) -> Set[str]:
+		postings = []
+		for gram in grams_of((query,)):
+			gram_postings = self.grams.get(gram)
+			if gram_postings is None:
+				return set()
+
+			postings.append(gram_postings)
+
+		postings.sort(key=len)
+		if len(postings) == 1:
+			return postings[0]
+
+		return postings[0].intersection(*postings[1:])
+
+	def score(self, query: str, creator: str) -> int:
+		name, title = self.fields[creator]
+		score = 0
+
+		if name == query:
+			score += EXACT_CREATOR
+		elif name.startswith(query):
+			score += CREATOR_PREFIX
+		elif query in name:
+			score += IN_CREATOR
+
+		if title.startswith(query) or f" {query}" in title:
+			score += TITLE_WORD_PREFIX
+		elif query in title:
+			score += IN_TITLE
+
+		return score
+
+def grams_of(fields: Tuple[str, ...]) -> Set[str]:
+	return { field[i:i+GRAM_LEN]
+			for field in fields
+			for i in range(len(field) - GRAM_LEN + 1) }
+
+# Word prefixes shorter than GRAM_LEN, longer queries use grams.
+def prefixes_of(fields: Tuple[str, ...]) -> Set[str]:
+	return { word[:length]
+			for field in fields
+			for word in field.split()
+			for length in range(1, GRAM_LEN) }
+
+def discard_from(index: Dict[str, Set[str]], key: str, creator: str):
+	postings = index.get(key)
+	if postings is None:
+		return
+
+	postings.discard(creator)
+	if len(postings) == 0:
+		del index[key]
@@ -1,20 +1,25 @@
 from mongoengine import Document, StringField, ListField, LongField
-from mongoengine import BooleanField, EmbeddedDocumentField, IntField
+from mongoengine import BooleanField, EmbeddedDocumentField, IntField, DictField
 
 from ipaddress import ip_address
 
 from stream_registry.src.media_server_data import MediaServerData
 
+# Written by the presence flushes of every replica, not a part of the
+# stream's state (see stream_directory.py and AsyncDb.watch_streams).
+VIEWER_COUNT_FIELDS = ('viewer_count', 'replica_viewer_counts')
+
 class StreamData(Document):
 
-	# will enable searching streams by title and creator_name
-	# meta = {'indexes': [
-	# 				{'fields': ['$title', "$creator"],
-	# 				'default_language': 'english',
-	# 				'weights': {'title': 2, 'creator': 10}
-	# 				}
-	# 			]
-	# 		}
+	# Enables searching streams by title and creator_name (Db.get_by_query),
+	# api itself uses the in-process search index (search_index.py).
+	meta = {'indexes': [
+					{'fields': ['$title', "$creator"],
+					'default_language': 'english',
+					'weights': {'title': 2, 'creator': 10}
+					}
+				]
+			}
 
 	title = StringField(required=True, max_length=120)
 	creator = StringField(required=True, max_length=20)
@@ -28,7 +33,11 @@ class StreamData(Document):
 
 	is_public = BooleanField(required=True, default=False)
 
+	# Sum of the replica_viewer_counts, every registry replica counts (and
+	# flushes) only the viewers whose heartbeats it received, see
+	# viewer_presence.py.
 	viewer_count = IntField()
+	replica_viewer_counts = DictField()
 
 	@staticmethod
 	def empty(streamer:str, ingest_ip:str, stream_key:str):
@@ -0,0 +1,354 @@
+import asyncio
+from datetime import timedelta
+from time import monotonic, time
+from typing import Dict, Iterable, List, Tuple
+
+from stream_registry.src.ordered_index import OrderedIndex, Key
+from stream_registry.src.ordered_index import creation_key, views_key
+from stream_registry.src.ordered_index import CREATION_KEY_TYPES, VIEWS_KEY_TYPES
+from stream_registry.src.ranking import Ranking
+from stream_registry.src.search_index import SearchIndex
+from stream_registry.src.stream_data import StreamData, VIEWER_COUNT_FIELDS
+
+SYNC_LOCAL = 'local'
+SYNC_CHANGE_STREAM = 'change_stream'
+
+# Values of the api's ordering param.
+ORDER_NONE = 'None'
+ORDER_VIEWS = 'Views'
+ORDER_RECOMMENDED = 'Recommended'
+
+# In-process snapshot of the live streams (stream_data collection), used to
+# serve every read endpoint from the memory. Kept up to date either by the
+# api's write paths (single replica) or by the mongo change stream (multiple
+# replicas), in both cases periodically reconciled with the db (DirectorySync).
+# Dicts with None values are used as ordered sets so that pagination over
+# indices is stable.
+# Viewer counts (StreamData.viewer_count) are set from the ranking, not from
+# the db documents.
+# Only accessed from the event loop, no locking required.
+class StreamDirectory:
+
+	def __init__(self, ranking: Ranking):
+		self.ranking = ranking
+		self.streams: Dict[str, StreamData] = {}
+		self.by_category: Dict[str, Dict[str, None]] = {}
+		self.by_region: Dict[str, Dict[str, None]] = {}
+		self.by_id: Dict[object, str] = {}
+		self.search_index = SearchIndex()
+		self.orderings: Dict[str, OrderedIndex] = {
+			ORDER_NONE: OrderedIndex(creation_key, CREATION_KEY_TYPES),
+			ORDER_VIEWS: OrderedIndex(views_key, VIEWS_KEY_TYPES),
+			# (-score, str(_id), creator)
+			ORDER_RECOMMENDED: OrderedIndex(self.recommended_key, VIEWS_KEY_TYPES)
+		}
+
+		# Creators changed while the full reload was in progress, their
+		# in-memory state is newer than the one read from the db.
+		self.touched: set = None
+
+		self.version = 0
+		self.last_change = monotonic()
+
+	def __len__(self):
+		return len(self.streams)
+
+	def get(self, creator: str) -> StreamData:
+		return self.streams.get(creator)
+
+	def is_live(self, creator: str) -> bool:
+		return creator in self.streams
+
+	def put(self, stream: StreamData):
+		if stream is None:
+			return
+
+		self.unindex(stream.creator)
+		self.index(stream)
+		self.changed(stream.creator)
+
+	def remove(self, creator: str):
+		if creator is None:
+			return
+
+		self.unindex(creator)
+		self.changed(creator)
+
+	def remove_by_id(self, id):
+		self.remove(self.by_id.get(id))
+
+	def creators(self) -> List[str]:
+		return list(self.streams)
+
+	# Re-sorts the streams whose viewer count or score changed.
+	def rerank(self, creators: Iterable[str]):
+		for creator in creators:
+			stream = self.streams.get(creator)
+			if stream is None:
+				continue
+
+			stream.viewer_count = self.ranking.viewer_count(creator)
+			for ordering in self.orderings.values():
+				ordering.put(stream)
+
+	def recommended_key(self, stream: StreamData) -> Key:
+		return (-self.ranking.score(stream), str(stream.id), stream.creator)
+
+	# Listings return the page and the key to continue after (None if this
+	# was the last page), see ordered_index.py.
+	def all(self, ordering: str,
+			count: int,
+			start: int = 0,
+			after: Key = None) -> Tuple[List[StreamData], Key]:
+
+		keys = self.ordering(ordering).page(count, start=start, after=after)
+		return self.resolve(keys, count)
+
+	def get_by_category(self, category: str,
+						region: str,
+						ordering: str,
+						count: int,
+						start: int = 0,
+						after: Key = None) -> Tuple[List[StreamData], Key]:
+
+		in_category = self.by_category.get(category, {})
+		in_region = self.by_region.get(region, {})
+
+		def accept(creator: str):
+			return creator in in_category and creator in in_region
+
+		keys = self.ordering(ordering).page(count, 
+											start=start, 
+											after=after, 
+											accept=accept)
+		return self.resolve(keys, count)
+
+	# Ranked by relevance, only the streams available in the region.
+	def get_by_query(self, name_query: str,
+					region: str,
+					count: int,
+					start: int = 0,
+					after: Key = None) -> Tuple[List[StreamData], Key]:
+
+		in_region = self.by_region.get(region, {})
+
+		if after is not None:
+			start = 0
+
+		keys = self.search_index.search(name_query, 
+										limit=start + count, 
+										accept=in_region.__contains__,
+										after=after)
+		return self.resolve(keys[start:], count)
+
+	def ordering(self, ordering: str) -> OrderedIndex:
+		return self.orderings[self.ordering_name(ordering)]
+
+	# Unknown orderings fall back to the creation order.
+	def ordering_name(self, ordering: str) -> str:
+		return ordering if ordering in self.orderings else ORDER_NONE
+
+	def resolve(self, keys: List[Key], count: int) -> Tuple[List[StreamData], Key]:
+		streams = [ self.streams[key[-1]] for key in keys ]
+		next_key = keys[-1] if len(keys) == count and count > 0 else None
+
+		return streams, next_key
+
+	# Returns the number of streams whose state differed from the one in the
+	# db (missing, stale or no longer live), i.e. the drift since the last
+	# reload.
+	def reload(self, streams: Iterable[StreamData]) -> int:
+		fresh = { s.creator: s for s in streams }
+		touched = self.touched or set()
+		self.touched = None
+
+		drift = 0
+		for creator in list(self.streams):
+			if creator not in fresh and creator not in touched:
+				drift += 1
+				self.unindex(creator)
+
+		for creator, stream in fresh.items():
+			if creator in touched:
+				continue
+
+			stream.viewer_count = self.ranking.viewer_count(creator)
+			current = self.streams.get(creator)
+			if current is None or stream_state(current) != stream_state(stream):
+				drift += 1
+				self.unindex(creator)
+				self.index(stream)
+
+		if drift > 0:
+			self.version += 1
+			self.last_change = monotonic()
+
+		return drift
+
+	def begin_reload(self):
+		self.touched = set()
+
+	def changed(self, creator: str):
+		self.version += 1
+		self.last_change = monotonic()
+
+		if self.touched is not None:
+			self.touched.add(creator)
+
+	def index(self, stream: StreamData):
+		stream.viewer_count = self.ranking.viewer_count(stream.creator)
+		self.streams[stream.creator] = stream
+		self.by_id[stream.id] = stream.creator
+		self.by_category.setdefault(stream.category, {})[stream.creator] = None
+		self.search_index.add(stream.creator, stream.title)
+
+		for ordering in self.orderings.values():
+			ordering.put(stream)
+
+		for server in stream.media_servers:
+			self.by_region.setdefault(server.region, {})[stream.creator] = None
+
+	def unindex(self, creator: str):
+		stream = self.streams.pop(creator, None)
+		if stream is None:
+			return
+
+		self.by_id.pop(stream.id, None)
+		drop_from(self.by_category, stream.category, creator)
+		self.search_index.remove(creator)
+
+		for ordering in self.orderings.values():
+			ordering.remove(creator)
+
+		for server in stream.media_servers:
+			drop_from(self.by_region, server.region, creator)
+
+# Document without the viewer counts, they change with every presence flush
+# and are taken from the ranking anyway.
+def stream_state(stream: StreamData) -> Dict:
+	state = stream.to_mongo().to_dict()
+	for field in VIEWER_COUNT_FIELDS:
+		state.pop(field, None)
+
+	return state
+
+def drop_from(index: Dict[str, Dict[str, None]], key: str, creator: str):
+	members = index.get(key)
+	if members is None:
+		return
+
+	members.pop(creator, None)
+	if len(members) == 0:
+		del index[key]
+
+# Keeps the directory consistent with the db. Full reload is done on start
+# and then periodically, in change_stream mode changes done by other registry
+# replicas are applied as they arrive (requires replica set and motor driver).
+class DirectorySync:
+
+	def __init__(self, directory: StreamDirectory,
+			db,
+			mode: str,
+			resync_interval: timedelta):
+
+		self.directory = directory
+		self.db = db
+		self.mode = mode
+		self.resync_interval = resync_interval.total_seconds()
+
+		self.tasks: List[asyncio.Task] = []
+		self.resync_lock = asyncio.Lock()
+
+		self.last_resync = None
+		self.last_drift = 0
+		self.total_drift = 0
+		self.resyncs = 0
+		self.events = 0
+		self.event_lag = 0.0
+		self.watch_failures = 0
+
+	async def start(self):
+		await self.resync()
+
+		if self.mode == SYNC_CHANGE_STREAM and not hasattr(self.db, 'watch_streams'):
+			print("Change stream requires motor db driver, using local sync.")
+			self.mode = SYNC_LOCAL
+
+		self.tasks.append(asyncio.create_task(self.resync_loop()))
+		if self.mode == SYNC_CHANGE_STREAM:
+			self.tasks.append(asyncio.create_task(self.watch_loop()))
+
+	async def stop(self):
+		for task in self.tasks:
+			task.cancel()
+
+		await asyncio.gather(*self.tasks, return_exceptions=True)
+		self.tasks = []
+
+	async def resync(self):
+		async with self.resync_lock:
+			self.directory.begin_reload()
+			streams = await self.db.get_all_streams()
+
+			self.last_drift = self.directory.reload(streams)
+			self.total_drift += self.last_drift
+			self.last_resync = monotonic()
+			self.resyncs += 1
+
+		if self.last_drift > 0:
+			print(f"Stream directory reloaded, drift: {self.last_drift}")
+
+	async def resync_loop(self):
+		while True:
+			await asyncio.sleep(self.resync_interval)
+			try:
+				await self.resync()
+			except Exception as e:
+				print(f"Failed to reload stream directory: {e}")
+
+	async def watch_loop(self):
+		while True:
+			try:
+				async with self.db.watch_streams() as change_stream:
+					# Catch up with the changes missed while (re)connecting.
+					await self.resync()
+					async for change in change_stream:
+						self.apply(change)
+
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				self.watch_failures += 1
+				print(f"Stream directory change stream failed: {e}")
+				await asyncio.sleep(1)
+
+	def apply(self, change):
+		self.events += 1
+		self.event_lag = time() - change['clusterTime'].time
+
+		operation = change['operationType']
+		if operation == 'delete':
+			self.directory.remove_by_id(change['documentKey']['_id'])
+		elif operation in ('insert', 'update', 'replace'):
+			document = change.get('fullDocument')
+			if document is None:
+				# Removed before the lookup, delete event will follow.
+				return
+
+			self.directory.put(StreamData._from_son(document))
+
+	def as_dict(self):
+		now = monotonic()
+		return {
+			'mode': self.mode,
+			'streams': len(self.directory),
+			'version': self.directory.version,
+			'last_change_age_s': now - self.directory.last_change,
+			'last_resync_age_s': now - self.last_resync if self.last_resync else None,
+			'last_resync_drift': self.last_drift,
+			'total_drift': self.total_drift,
+			'resyncs': self.resyncs,
+			'change_events': self.events,
+			'change_event_lag_s': self.event_lag,
+			'watch_failures': self.watch_failures
+		}
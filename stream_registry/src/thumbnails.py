@@ -0,0 +1,307 @@
+import asyncio
+from dataclasses import dataclass, asdict
+from datetime import timedelta
+from hashlib import sha1
+from time import monotonic, perf_counter
+from typing import Dict, List, Optional, Protocol
+
+from shared_model.latency_histogram import LatencyHistogram
+from stream_registry.src.media_server_data import MediaServerData
+from stream_registry.src.stream_data import StreamData
+
+TNAIL_MEDIA_TYPE = 'image/jpeg'
+PREVIEW_QUALITY = 'preview'
+
+# Thumbnail generators, see FfmpegPull and local_preview.py.
+TNAIL_PULL = 'pull'
+TNAIL_LOCAL_PREVIEW = 'local_preview'
+
+@dataclass
+class Thumbnail:
+	data: bytes
+	etag: str
+	expires_at: float # monotonic
+
+	def is_expired(self) -> bool:
+		return monotonic() >= self.expires_at
+
+	# Seconds left, used as the Cache-Control max-age.
+	def max_age(self) -> int:
+		return max(0, int(self.expires_at - monotonic()))
+
+@dataclass
+class StreamTnailStats:
+	generated: int = 0
+	failures: int = 0
+	last_ms: float = 0
+	max_ms: float = 0
+	total_ms: float = 0
+
+	def observe(self, elapsed_ms: float):
+		self.generated += 1
+		self.last_ms = elapsed_ms
+		self.max_ms = max(self.max_ms, elapsed_ms)
+		self.total_ms += elapsed_ms
+
+	def as_dict(self):
+		data = asdict(self)
+		data['avg_ms'] = self.total_ms / self.generated if self.generated > 0 else 0
+		return data
+
+@dataclass
+class ThumbnailStats:
+	hits: int = 0
+	# Expired thumbnail served while the new one is being generated.
+	stale_hits: int = 0
+	# Expired for longer than max_stale (regeneration kept failing), dropped.
+	stale_dropped: int = 0
+	misses: int = 0
+	# Requests that joined an already scheduled generation.
+	coalesced: int = 0
+	# Generation not scheduled because the queue was full.
+	rejected: int = 0
+	refreshes: int = 0
+	evictions: int = 0
+
+def preview_quality_filter(server: MediaServerData):
+	return server.quality == PREVIEW_QUALITY
+
+class ThumbnailGenerator(Protocol):
+
+	async def generate(self, stream: StreamData) -> Optional[bytes]:
+		...
+
+# Grabs a single frame from one of the stream's preview renditions, jpeg is
+# read from the ffmpeg's stdout so nothing is written to the disk.
+class FfmpegPull:
+
+	def __init__(self, timeout: timedelta):
+		self.timeout = timeout.total_seconds()
+
+	async def generate(self, stream: StreamData) -> Optional[bytes]:
+		for server in filter(preview_quality_filter, stream.media_servers):
+			data = await self.pull(server.media_url)
+			if data is not None:
+				return data
+
+		return None
+
+	async def pull(self, media_url: str) -> Optional[bytes]:
+		print(f"Pulling tnail from: {media_url}")
+		proc = await asyncio.create_subprocess_exec(
+			"ffmpeg",
+			# Replace SessionOrigin field with some secret, or somehow
+			# authenticate registry service.
+			# "-headers", "sessionorigin: streamregistry",
+			"-i", media_url,
+			"-vframes", "1",
+			"-f", "image2pipe",
+			"-vcodec", "mjpeg",
+			"pipe:1",
+			stdout=asyncio.subprocess.PIPE,
+			stderr=asyncio.subprocess.DEVNULL)
+
+		try:
+			data, _ = await asyncio.wait_for(proc.communicate(), self.timeout)
+		except asyncio.TimeoutError:
+			print(f"Tnail pull timed out: {media_url}")
+			return None
+		finally:
+			# Timed out or cancelled (registry shutdown).
+			if proc.returncode is None:
+				proc.kill()
+				await proc.wait()
+
+		if proc.returncode != 0 or len(data) == 0:
+			print(f"Tnail pull failed, return code: {proc.returncode}")
+			return None
+
+		return data
+
+# Thumbnails of the live streams served from memory. Generation is done by a
+# fixed number of workers taking streamers from a bounded queue, concurrent
+# requests for the same streamer share a single generation. Expired
+# thumbnail is still served (stale) while the new one is generated and the
+# ones about to expire are refreshed in the background, so apart from the
+# first request for a stream, clients don't wait for the generator.
+# Thumbnail expired for longer than max_stale is no longer served.
+# Used from the event loop only, no locking required.
+class Thumbnails:
+
+	def __init__(self, directory,
+			generator: ThumbnailGenerator,
+			workers: int,
+			queue_size: int,
+			longevity: timedelta,
+			refresh_ahead: timedelta,
+			refresh_interval: timedelta,
+			max_stale: timedelta):
+
+		self.directory = directory
+		self.generator = generator
+		self.workers = workers
+		self.longevity = longevity.total_seconds()
+		self.refresh_ahead = refresh_ahead.total_seconds()
+		self.refresh_interval = refresh_interval.total_seconds()
+		self.max_stale = max_stale.total_seconds()
+
+		self.cache: Dict[str, Thumbnail] = {}
+		self.pending: Dict[str, asyncio.Future] = {}
+		self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize=queue_size)
+
+		self.stats = ThumbnailStats()
+		self.latency = LatencyHistogram()
+		self.stream_stats: Dict[str, StreamTnailStats] = {}
+
+		self.tasks: List[asyncio.Task] = []
+
+	async def start(self):
+		for _ in range(self.workers):
+			self.tasks.append(asyncio.create_task(self.worker()))
+
+		self.tasks.append(asyncio.create_task(self.refresh_loop()))
+
+	async def stop(self):
+		for task in self.tasks:
+			task.cancel()
+
+		await asyncio.gather(*self.tasks, return_exceptions=True)
+		self.tasks = []
+
+		for future in self.pending.values():
+			future.cancel()
+		self.pending = {}
+
+	# Returns None if thumbnail couldn't be generated (or scheduled).
+	async def get(self, streamer: str) -> Optional[Thumbnail]:
+		tnail = self.cache.get(streamer)
+		if tnail is not None and self.is_too_stale(tnail):
+			self.drop_stale(streamer)
+			tnail = None
+
+		if tnail is not None:
+			if not tnail.is_expired():
+				self.stats.hits += 1
+			else:
+				self.stats.stale_hits += 1
+				self.schedule(streamer)
+
+			return tnail
+
+		pending = self.schedule(streamer)
+		if pending is None:
+			return None
+
+		self.stats.misses += 1
+		# Shielded so that one cancelled request doesn't cancel the
+		# generation for the others waiting on it.
+		return await asyncio.shield(pending)
+
+	def schedule(self, streamer: str) -> Optional[asyncio.Future]:
+		pending = self.pending.get(streamer)
+		if pending is not None:
+			self.stats.coalesced += 1
+			return pending
+
+		try:
+			self.queue.put_nowait(streamer)
+		except asyncio.QueueFull:
+			self.stats.rejected += 1
+			return None
+
+		pending = asyncio.get_running_loop().create_future()
+		self.pending[streamer] = pending
+		return pending
+
+	async def worker(self):
+		while True:
+			streamer = await self.queue.get()
+
+			try:
+				tnail = await self.generate(streamer)
+			except Exception as e:
+				print(f"Error while generating tnail for: {streamer}, reason: {e}")
+				tnail = None
+
+			pending = self.pending.pop(streamer, None)
+			if pending is not None and not pending.done():
+				pending.set_result(tnail)
+
+	async def generate(self, streamer: str) -> Optional[Thumbnail]:
+		stream = self.directory.get(streamer)
+		if stream is None:
+			print(f"Stream ended before the tnail was generated: {streamer}")
+			self.evict(streamer)
+			return None
+
+		stats = self.stream_stats.setdefault(streamer, StreamTnailStats())
+
+		start = perf_counter()
+		data = await self.generator.generate(stream)
+		elapsed_ms = (perf_counter() - start) * 1000
+
+		if data is None:
+			print(f"Failed to generate tnail for: {streamer}")
+			stats.failures += 1
+			return None
+
+		stats.observe(elapsed_ms)
+		self.latency.observe(elapsed_ms)
+
+		tnail = Thumbnail(data=data,
+						etag=f'"{sha1(data).hexdigest()}"',
+						expires_at=monotonic() + self.longevity)
+
+		self.cache[streamer] = tnail
+		return tnail
+
+	def is_too_stale(self, tnail: Thumbnail) -> bool:
+		return monotonic() - tnail.expires_at > self.max_stale
+
+	def drop_stale(self, streamer: str):
+		print(f"Tnail of: {streamer} expired for longer than: {self.max_stale}s, dropped.")
+		del self.cache[streamer]
+		self.stats.stale_dropped += 1
+
+	def evict(self, streamer: str):
+		if self.cache.pop(streamer, None) is not None:
+			self.stats.evictions += 1
+
+		self.stream_stats.pop(streamer, None)
+
+	# Drops thumbnails (and stats) of the ended streams and regenerates the
+	# ones about to expire. Streams without a cached thumbnail (generation
+	# kept failing) still have their stats.
+	async def refresh_loop(self):
+		while True:
+			await asyncio.sleep(self.refresh_interval)
+
+			for streamer in list(self.stream_stats):
+				if not self.directory.is_live(streamer):
+					self.evict(streamer)
+
+			refresh_before = monotonic() + self.refresh_ahead
+			for streamer, tnail in list(self.cache.items()):
+				if not self.directory.is_live(streamer):
+					self.evict(streamer)
+				elif self.is_too_stale(tnail):
+					self.drop_stale(streamer)
+					if streamer not in self.pending:
+						self.schedule(streamer)
+				elif tnail.expires_at <= refresh_before and streamer not in self.pending:
+					if self.schedule(streamer) is not None:
+						self.stats.refreshes += 1
+
+	def as_dict(self):
+		generator_stats = getattr(self.generator, 'as_dict', None)
+
+		return {**asdict(self.stats),
+				'generator': generator_stats() if generator_stats is not None else {},
+				'cached': len(self.cache),
+				'cached_bytes': sum(len(t.data) for t in self.cache.values()),
+				'pending': len(self.pending),
+				'queued': self.queue.qsize(),
+				'workers': self.workers,
+				'latency': self.latency.as_dict(),
+				'streams': { streamer: stats.as_dict()
+							for streamer, stats in self.stream_stats.items() }}
@@ -0,0 +1,87 @@
+import asyncio
+from dataclasses import dataclass
+from datetime import timedelta
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from time import perf_counter
+from typing import Dict
+
+from httpx import AsyncClient, Limits, Timeout, Response as HttpxResp
+
+from shared_model.latency_histogram import LatencyHistogram
+
+TOKENS_API = 'tokens_api'
+
+@dataclass
+class UpstreamStats:
+	limit: int
+	requests: int = 0
+	failures: int = 0
+	in_flight: int = 0
+	# Requests that had to wait for one of the upstream's slots.
+	waits: int = 0
+
+# One long lived, keep-alive client shared by all of the registry's outbound
+# calls. Each upstream (service) gets its own concurrency limit so that one
+# slow service can't take all of the connections from the pool.
+class Upstreams:
+
+	def __init__(self, limits: Dict[str, int],
+			timeout: timedelta,
+			keepalive_expiry: timedelta):
+
+		self.semaphores = { name: asyncio.Semaphore(limit)
+							for name, limit in limits.items() }
+		self.stats = { name: UpstreamStats(limit=limit)
+							for name, limit in limits.items() }
+		self.latency = { name: LatencyHistogram() for name in limits }
+
+		total = sum(limits.values())
+		self.client = AsyncClient(
+			limits=Limits(max_connections=total,
+						max_keepalive_connections=total,
+						keepalive_expiry=keepalive_expiry.total_seconds()),
+			timeout=Timeout(timeout.total_seconds()),
+			# Client is shared between users, cookies are passed per request
+			# (see cookie_header) and none of the received ones are stored.
+			cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])))
+
+	async def close(self):
+		await self.client.aclose()
+
+	async def get(self, upstream: str, url: str, cookies=None) -> HttpxResp:
+		return await self.request(upstream, 'GET', url, cookies=cookies)
+
+	async def post(self, upstream: str, url: str, json=None, cookies=None) -> HttpxResp:
+		return await self.request(upstream, 'POST', url, json=json, cookies=cookies)
+
+	async def request(self, upstream: str, method: str, url: str,
+				json=None, cookies=None) -> HttpxResp:
+
+		semaphore = self.semaphores[upstream]
+		stats = self.stats[upstream]
+
+		if semaphore.locked():
+			stats.waits += 1
+
+		async with semaphore:
+			stats.requests += 1
+			stats.in_flight += 1
+			start = perf_counter()
+			try:
+				headers = {'Cookie': cookie_header(cookies)} if cookies else None
+				return await self.client.request(method, url, json=json, headers=headers)
+			except Exception:
+				stats.failures += 1
+				raise
+			finally:
+				stats.in_flight -= 1
+				self.latency[upstream].observe((perf_counter() - start) * 1000)
+
+	def as_dict(self):
+		return { name: {**stats.__dict__,
+						'saturation': stats.in_flight / stats.limit,
+						'latency': self.latency[name].as_dict()}
+				for name, stats in self.stats.items() }
+
+def cookie_header(cookies: Dict[str, str]) -> str:
+	return "; ".join([ f"{key}={value}" for key, value in cookies.items() ])
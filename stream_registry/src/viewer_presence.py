@@ -0,0 +1,172 @@
+import asyncio
+from dataclasses import dataclass, asdict
+from datetime import timedelta
+from math import ceil
+from time import monotonic, perf_counter
+from typing import Dict, List, Set, Tuple
+
+@dataclass
+class PresenceStats:
+	heartbeats: int = 0
+	joined: int = 0
+	expired: int = 0
+	flushes: int = 0
+	flushed_streams: int = 0
+	flush_failures: int = 0
+	last_flush_ms: float = 0
+
+# Viewer heartbeats (/continue_view) aggregated in memory instead of one
+# ViewerData document per viewer. Time is split into buckets of bucket_len
+# seconds, every viewer is kept only in the bucket of their last heartbeat
+# and whole buckets older than the window are dropped at once, so a viewer
+# expires between window and window + bucket_len after their last heartbeat.
+# Heartbeat, count read and expiry (per viewer) are all O(1).
+# Counts that changed since the last flush are persisted by PresenceFlusher.
+class ViewerPresence:
+
+	def __init__(self, window: timedelta, bucket_len: timedelta):
+		self.bucket_len = bucket_len.total_seconds()
+		self.window_buckets = max(1, ceil(window / bucket_len))
+
+		# creator -> {viewer -> bucket of the last heartbeat}
+		self.last_seen: Dict[str, Dict[str, int]] = {}
+		# bucket -> {(creator, viewer)}
+		self.buckets: Dict[int, Set[Tuple[str, str]]] = {}
+		# Creators whose count changed since the last flush.
+		self.unflushed: Set[str] = set()
+
+		self.stats = PresenceStats()
+
+	def current_bucket(self) -> int:
+		return int(monotonic() // self.bucket_len)
+
+	def count(self, creator: str) -> int:
+		return len(self.last_seen.get(creator, ()))
+
+	def total(self) -> int:
+		return sum(len(viewers) for viewers in self.last_seen.values())
+
+	# Returns whether this is a new viewer (count changed).
+	def seen(self, creator: str, viewer: str) -> bool:
+		self.stats.heartbeats += 1
+
+		bucket = self.current_bucket()
+		viewers = self.last_seen.setdefault(creator, {})
+		prev_bucket = viewers.get(viewer)
+		if prev_bucket == bucket:
+			return False
+
+		if prev_bucket is not None:
+			self.buckets[prev_bucket].discard((creator, viewer))
+
+		viewers[viewer] = bucket
+		self.buckets.setdefault(bucket, set()).add((creator, viewer))
+
+		if prev_bucket is not None:
+			return False
+
+		self.stats.joined += 1
+		self.unflushed.add(creator)
+		return True
+
+	# Returns whether stream had any viewers.
+	def clear(self, creator: str) -> bool:
+		viewers = self.last_seen.pop(creator, None)
+		self.unflushed.discard(creator)
+		if viewers is None:
+			return False
+
+		for viewer, bucket in viewers.items():
+			self.buckets[bucket].discard((creator, viewer))
+
+		return True
+
+	# Drops buckets that fell out of the window, returns creators whose count
+	# changed.
+	def expire(self) -> Set[str]:
+		limit = self.current_bucket() - self.window_buckets
+		changed = set()
+
+		for bucket in [ b for b in self.buckets if b < limit ]:
+			for creator, viewer in self.buckets.pop(bucket):
+				viewers = self.last_seen[creator]
+				del viewers[viewer]
+				if len(viewers) == 0:
+					del self.last_seen[creator]
+
+				changed.add(creator)
+				self.stats.expired += 1
+
+		self.unflushed |= changed
+		return changed
+
+	def take_unflushed(self) -> Dict[str, int]:
+		counts = { creator: self.count(creator) for creator in self.unflushed }
+		self.unflushed = set()
+		return counts
+
+	def as_dict(self):
+		data = asdict(self.stats)
+		data['streams'] = len(self.last_seen)
+		data['viewers'] = self.total()
+		data['buckets'] = len(self.buckets)
+		data['unflushed'] = len(self.unflushed)
+		return data
+
+# Periodically writes the changed viewer counts (single bulk write per
+# flush), so that db (and the Db sort pipelines) follows the in-memory
+# counts with at most one flush interval of delay. Every replica writes its
+# own counts (StreamData.replica_viewer_counts) and viewer_count is their
+# sum, replicas don't overwrite each other's counts. Counts of a replica
+# that was killed (not stopped) stay until the stream ends.
+class PresenceFlusher:
+
+	def __init__(self, presence: ViewerPresence, db, interval: timedelta, replica: str):
+		self.presence = presence
+		self.db = db
+		self.interval = interval.total_seconds()
+		self.replica = replica
+
+		self.tasks: List[asyncio.Task] = []
+
+	async def start(self):
+		self.tasks.append(asyncio.create_task(self.flush_loop()))
+
+	async def stop(self):
+		for task in self.tasks:
+			task.cancel()
+
+		await asyncio.gather(*self.tasks, return_exceptions=True)
+		self.tasks = []
+
+		# Viewers of this replica are no longer counted, their heartbeats
+		# will go to the other replicas.
+		self.presence.unflushed |= self.presence.last_seen.keys()
+		self.presence.last_seen = {}
+		self.presence.buckets = {}
+		await self.flush()
+
+	async def flush(self):
+		counts = self.presence.take_unflushed()
+		if len(counts) == 0:
+			return
+
+		stats = self.presence.stats
+		start = perf_counter()
+		try:
+			await self.db.set_viewer_counts(counts, self.replica)
+		except Exception as e:
+			print(f"Failed to flush viewer counts: {e}")
+			stats.flush_failures += 1
+			# Retried on the next flush (with the counts current at that time).
+			self.presence.unflushed |= counts.keys()
+			return
+
+		stats.flushes += 1
+		stats.flushed_streams += len(counts)
+		stats.last_flush_ms = (perf_counter() - start) * 1000
+
+	async def flush_loop(self):
+		while True:
+			await asyncio.sleep(self.interval)
+			await self.flush()
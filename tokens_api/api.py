@@ -1,6 +1,8 @@
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, UTC
 import random
 import string
+from time import perf_counter
 from typing import Any, Dict, List
 from requests import post
 import uvicorn
@@ -9,7 +11,9 @@ from httpx import AsyncClient
 from config import config
 
 from shared_model.continue_view_request import ContinueViewRequest
-import users_db
+from shared_model.latency_histogram import LatencyHistogram
+from async_users_db import AsyncUsersDb, open_users_db
+from identity_cache import CachedUsersDb, IdentityCache
 
 from supertokens_python import init, InputAppInfo, SupertokensConfig
 from supertokens_python import get_all_cors_headers
@@ -101,7 +105,7 @@ def override_default_emailpassword(defaultImp: APIInterface)->APIInterface:
 		new_user = UserDoc(tokens_id=result.user.user_id,
 					username=username_field.value,
 					email=result.user.email)
-		users_db.save_user(new_user)
+		await db.save_user(new_user)
 		
 		return result
 
@@ -158,7 +162,26 @@ init(
 )
 
 
-app = FastAPI()
+db: AsyncUsersDb = None
+identity_cache = IdentityCache(config.identity_cache_ttl, config.identity_cache_size)
+
+# Key validation blocks the ingest's rtmp publish (on_publish callback).
+KEY_VALIDATION_BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000]
+key_validation_latency = LatencyHistogram(KEY_VALIDATION_BUCKETS_MS)
+key_validation_results = {'matched': 0, 'rejected': 0}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+	global db
+
+	print(f"Connecting {config.db_driver} users db with pool size: {config.db_pool_size}")
+	db = CachedUsersDb(await open_users_db(config), identity_cache)
+
+	yield
+
+	db.close()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
 	get_fast_api_middleware()
 )
@@ -178,23 +201,25 @@ def gen_exp_date(longevity) -> datetime:
 	return datetime.now(UTC) + timedelta(seconds=longevity)
 
 @app.get("/auth/get_key")
-def get_key(session: SessionContainer = Depends(verify_session())):
+async def get_key(session: SessionContainer = Depends(verify_session())):
 	print("Processing get key request.")
 
 	if session is None: 
 		raise HTTPException(status_code=code.HTTP_401_UNAUTHORIZED)
 
 	tokens_id = session.user_id
-	user = users_db.get_user_by_tokens_id(tokens_id)
+	user = await db.get_user_by_tokens_id(tokens_id)
 	# I guess this has to be not None as well.
 
 	print("Found user : ")
 	print(user.to_json() if user is not None else "User is None.")
-	key = users_db.get_key_for_user(user)
+	key = await db.get_key_for_user(user)
 
 	if key is None:
 		print("Key not found, will generate new.")
 		key = StreamKeyDoc(owner=user)
+
+	key.owner_name = user.username
 	
 	if key.is_expired():
 		print("Key expired or not initialized, reinitialize.")
@@ -203,40 +228,34 @@ def get_key(session: SessionContainer = Depends(verify_session())):
 		print(f"Key date: {key.exp_date}")
 
 	print(f"Key generated: {key.value}")
-	users_db.save_key(key)
+	await db.save_key(key)
 
 	return KeyResponse.success(value=key.value, expiration_date=key.exp_date)
 
-# Nginx cant' forward cookies and this is used in on_publish callback.
+# Nginx cant' forward cookies and this is used (through the stream registry)
+# in the on_publish callback.
 # This should be guarded somehow but at this point ... it's fine.
-@app.get("/match_key/{req_key}")
-def match_key(req_key:str):
-	print(f"Processing match key request with: {req_key}")
-
-	if not req_key: # not None and not empty
-		print("Invalid/no key provided.")
-		res_data = KeyResponse.failure("Invalid/no key provider.")
-		raise HTTPException(status_code=code.HTTP_400_BAD_REQUEST, detail=res_data)
-		return jsonify(res_data), status.HTTP_400_BAD_REQUEST
-
-	stream_key = users_db.get_key_by_value(req_key)
-
-	if stream_key is None: 
-		print("No such key.")
-		# res_data = KeyResponse.failure("No such key")
+# Key is matched and invalidated by a single query, see claim_key.
+@app.get("/validate_key/{req_key}")
+async def validate_key(req_key: str):
+	start = perf_counter()
+	try:
+		username = await db.claim_key(req_key)
+	finally:
+		key_validation_latency.observe((perf_counter() - start) * 1000)
+
+	if username is None:
+		key_validation_results['rejected'] += 1
+		print(f"Key invalid/expired: {req_key}")
 		raise HTTPException(status_code=code.HTTP_404_NOT_FOUND, detail="No such key.")
-	
-	if stream_key.is_expired():
-		print("Key invalid/expired.")
-		# res_data = KeyResponse.failure("Key invalid.")
-		raise HTTPException(status_code=code.HTTP_404_NOT_FOUND, detail="No such key.")
-
-	users_db.invalidata_key(stream_key)
 
-	res_data = KeyResponse.success(value=stream_key.owner.username)
-	print(f"Key successfully matched with: {res_data.value}")
+	key_validation_results['matched'] += 1
+	return KeyResponse.success(value=username)
 
-	return res_data
+# Kept for the registries still configured with it, same as validate_key.
+@app.get("/match_key/{req_key}")
+async def match_key(req_key:str):
+	return await validate_key(req_key)
 
 def to_public_user(model: UserDoc)->User:
 	return User(username=model.username, email=model.email)
@@ -245,13 +264,14 @@ def to_publick_key(model: StreamKeyDoc)->StreamKey:
 	return StreamKey(value=model.value,
 				  exp_data=model.exp_date.isoformat())
 
+# Denormalized usernames, the referenced users are never dereferenced.
 def to_public_follow_record(record: FollowingDoc)->FollowingInfo:
-	return FollowingInfo(username=record.owner.username,
-					following=record.following.username, 
+	return FollowingInfo(username=record.owner_name,
+					following=record.following_name, 
 					from_date=record.followed_at)
 
 @app.get("/get_user/{username}")
-def get_user(username:str):
+async def get_user(username:str):
 
 	print(f"Processing get user request for: {username}")
 
@@ -259,7 +279,7 @@ def get_user(username:str):
 		raise HTTPException(status_code=code.HTTP_400_BAD_REQUEST, 
 					  	detail="Username not provided")
 
-	user_data = users_db.get_user_by_username(username)
+	user_data = await db.get_user_by_username(username)
 
 	if user_data is None: 
 		raise HTTPException(status_code=code.HTTP_404_NOT_FOUND)
@@ -267,10 +287,10 @@ def get_user(username:str):
 	return PublicUser(username=user_data.username, email=user_data.email)
 	
 @app.get("/get_user_from_tokensid/{tokensid}")
-def get_user_from_tokensid(tokensid: str):
+async def get_user_from_tokensid(tokensid: str):
 	print(f"Processing get user from tokensid for: {tokensid}")
 
-	user_data = users_db.get_user_by_tokens_id(tokensid)
+	user_data = await db.get_user_by_tokens_id(tokensid)
 	if user_data is None:
 		print("No user for such token.")
 		raise HTTPException(status_code=code.HTTP_404_NOT_FOUND, 
@@ -279,28 +299,49 @@ def get_user_from_tokensid(tokensid: str):
 	return to_public_user(user_data)
 
 @app.get("/get_following")
-def get_following(session: SessionContainer = Depends(verify_session())):
+async def get_following(session: SessionContainer = Depends(verify_session())):
 	print(f"Processing (session verified) get followed request.")
 
 	if session is None: 
 		raise HTTPException(status_code=code.HTTP_401_UNAUTHORIZED)
 	
 	tokens_id = session.user_id
-	user = users_db.get_user_by_tokens_id(tokens_id)
+	user = await db.get_user_by_tokens_id(tokens_id)
 
-	follow_data = users_db.get_following(user.username)
-	if follow_data is None:
-		print(f"Following query failed for: {user.username}")
-		raise HTTPException(status_code=code.HTTP_500_INTERNAL_SERVER_ERROR)
+	follow_data = await db.get_following(user.username)
 
 	return list(map(to_public_follow_record, follow_data))
 
+@app.get("/get_followers")
+async def get_followers(session: SessionContainer = Depends(verify_session())):
+	print(f"Processing (session verified) get followers request.")
+
+	if session is None: 
+		raise HTTPException(status_code=code.HTTP_401_UNAUTHORIZED)
+	
+	user = await db.get_user_by_tokens_id(session.user_id)
+	follow_data = await db.get_followers(user.username)
+
+	return list(map(to_public_follow_record, follow_data))
+
+# Used by the stream registry for ranking the live streams, not protected,
+# the number of users per request is limited (the registry batches them).
+@app.post("/follower_counts")
+async def get_follower_counts(usernames: List[str]) -> Dict[str, int]:
+	print(f"Processing follower counts request for {len(usernames)} users.")
+
+	if len(usernames) > config.follower_counts_max:
+		raise HTTPException(status_code=code.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+						detail=f"At most {config.follower_counts_max} usernames.")
+
+	return await db.get_follower_counts(usernames)
+
 @app.get("/is_following/{whom}")
-def is_following(whom: str, session: SessionContainer = Depends(verify_session())):
+async def is_following(whom: str, session: SessionContainer = Depends(verify_session())):
 	if session is None: 
 		raise HTTPException(status_code=code.HTTP_401_UNAUTHORIZED)
 
-	follow_res = users_db.is_following(session.user_id, whom)
+	follow_res = await db.is_following(session.user_id, whom)
 	if follow_res:
 		return "Success, is following."
 	else:
@@ -309,7 +350,7 @@ def is_following(whom: str, session: SessionContainer = Depends(verify_session()
 # not protected, used just for bots
 @app.get("/remove/{username}")
 async def remove_user(username: str):
-	user:UserDoc = users_db.get_user_by_username(username)
+	user:UserDoc = await db.get_user_by_username(username)
 	if user is None: 
 		print("No such user.")
 		raise HTTPException(status_code=code.HTTP_404_NOT_FOUND, 
@@ -320,23 +361,23 @@ async def remove_user(username: str):
 	await delete_user(user.tokens_id) # returns None
 	print("User removed from tokens db.")
 
-	users_db.remove_follow_rec_for(user)
+	await db.remove_follow_rec_for(user)
 	print("Follow records removed.")
 
-	users_db.remove_user(user)
+	await db.remove_user(user)
 	print("User removed from session db.")
 
 	return "Should be success."
 
 @app.get("/is_authenticated")
-def check_session(session: SessionContainer = Depends(verify_session())):
+async def check_session(session: SessionContainer = Depends(verify_session())):
 	print("Processing is authorized request.")
 	if session is None: 
 		print("Unauthorized")
 		raise HTTPException(status_code=code.HTTP_401_UNAUTHORIZED)
 	
 	print("Authorized")
-	return to_public_user(users_db.get_user_by_tokens_id(session.user_id))
+	return to_public_user(await db.get_user_by_tokens_id(session.user_id))
 
 @app.get("/auth/authorize_viewer")
 async def authorize_viewer(request:Request, 
@@ -348,7 +389,7 @@ async def authorize_viewer(request:Request,
 		print("Unauthorized.")
 		raise HTTPException(status_code=code.HTTP_401_UNAUTHORIZED)
 
-	user = users_db.get_user_by_tokens_id(session.user_id)
+	user = await db.get_user_by_tokens_id(session.user_id)
 	stream_name = request.headers.get("X-Stream-Username")
 	# Lets just assume that the stream name is actually gonna be provided ... 
 
@@ -372,7 +413,7 @@ async def authorize_chatter(request:Request,
 		print("Unauthorized.")
 		raise HTTPException(status_code=code.HTTP_401_UNAUTHORIZED)
 
-	user = users_db.get_user_by_tokens_id(session.user_id)
+	user = await db.get_user_by_tokens_id(session.user_id)
 
 	print(f"Authorizing chatter: {user.username} for: {channel}")
 
@@ -384,7 +425,7 @@ async def follow(channel:str, session: SessionContainer = Depends(verify_session
 	if session is None: 
 		raise HTTPException(status_code=code.HTTP_401_UNAUTHORIZED)
 	
-	res = users_db.follow(session.user_id, channel)
+	res = await db.follow(session.user_id, channel)
 	if res is None: 
 		raise HTTPException(code.HTTP_500_INTERNAL_SERVER_ERROR)
 	else: 
@@ -395,10 +436,18 @@ async def unfollow(channel:str, session: SessionContainer = Depends(verify_sessi
 	if session is None: 
 		raise HTTPException(status_code=code.HTTP_401_UNAUTHORIZED)
 	
-	res = users_db.unfollow(session.user_id, channel)
+	res = await db.unfollow(session.user_id, channel)
 	
 	return "Success."
 
+@app.get("/stats/identity_cache")
+async def get_identity_cache_stats():
+	return identity_cache.as_dict()
+
+@app.get("/stats/key_validation")
+async def get_key_validation_stats():
+	return {**key_validation_results, 'latency': key_validation_latency.as_dict()}
+
 async def update_view_count(username, stream):
 	print(f"Will update view count for: {stream}")
 
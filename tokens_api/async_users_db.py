@@ -0,0 +1,261 @@
+from datetime import datetime as dt, timedelta, UTC
+from typing import Dict, List, Tuple
+
+from mongoengine.connection import get_db
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from starlette.concurrency import run_in_threadpool
+
+import users_db
+from config import Config
+from schema import bootstrap, bootstrap_indexes
+from users_db import pool_options
+from tokens_api.db_model import FollowingDoc, UserDoc, StreamKeyDoc
+
+DRIVER_MOTOR = 'motor'
+DRIVER_SYNC = 'sync'
+
+FOLLOW_RECORD_PROJECTION = {'_id': False, 'owner_name': True,
+							'following_name': True, 'followed_at': True}
+
+# Motor (asyncio) implementation of the users_db functions, same arguments and
+# same return values (mongoengine documents built from the raw ones using
+# _from_son). Referenced users are fetched together with the documents
+# referencing them (and set on them), dereferencing would go through the
+# sync mongoengine connection. Single instance is created on startup, the
+# client holds the connection pool shared by all of the requests.
+class AsyncUsersDb:
+
+	def __init__(self, conn_string: str, pool_size: int = 100, wait_timeout: timedelta = None):
+		self.conn_string = conn_string
+		self.client = AsyncIOMotorClient(conn_string, **pool_options(pool_size, wait_timeout))
+
+		database = self.client.get_default_database()
+		self.users = database[UserDoc._get_collection_name()]
+		self.keys = database[StreamKeyDoc._get_collection_name()]
+		self.following = database[FollowingDoc._get_collection_name()]
+
+	# Startup only, uses its own short lived sync client, see schema.py.
+	async def ensure_indexes(self):
+		await run_in_threadpool(bootstrap_indexes, self.conn_string)
+
+	def close(self):
+		self.client.close()
+
+	@staticmethod
+	def to_user(doc) -> UserDoc:
+		return UserDoc._from_son(doc) if doc is not None else None
+
+	async def get_user_by_username(self, username: str) -> UserDoc:
+		return self.to_user(await self.users.find_one({'username': username}))
+
+	async def get_user_by_tokens_id(self, id: str) -> UserDoc:
+		return self.to_user(await self.users.find_one({'tokens_id': id}))
+
+	async def get_users_by_usernames(self, usernames: List[str]) -> Dict[str, UserDoc]:
+		cursor = self.users.find({'username': {'$in': usernames}})
+		return { doc['username']: UserDoc._from_son(doc) async for doc in cursor }
+
+	async def get_users_by_tokens_ids(self, ids: List[str]) -> Dict[str, UserDoc]:
+		cursor = self.users.find({'tokens_id': {'$in': ids}})
+		return { doc['tokens_id']: UserDoc._from_son(doc) async for doc in cursor }
+
+	# Both users in a single query, either one is None if missing.
+	async def get_user_and_channel(self, tokens_id: str, channel: str) -> Tuple[UserDoc, UserDoc]:
+		user, f_channel = None, None
+		async for doc in self.users.find({'$or': [{'tokens_id': tokens_id},
+												{'username': channel}]}):
+			if doc.get('tokens_id') == tokens_id:
+				user = UserDoc._from_son(doc)
+			if doc.get('username') == channel:
+				f_channel = UserDoc._from_son(doc)
+
+		return user, f_channel
+
+	async def get_key_for_user(self, user: UserDoc) -> StreamKeyDoc:
+		doc = await self.keys.find_one({'owner': user.id})
+		if doc is None:
+			return None
+
+		key = StreamKeyDoc._from_son(doc)
+		key.owner = user
+		return key
+
+	# Upserted by the owner, concurrent saves of a user's new key don't end
+	# up as multiple keys.
+	async def save_key(self, key: StreamKeyDoc) -> StreamKeyDoc:
+		key.validate()
+		data = key.to_mongo().to_dict()
+		data.pop('_id', None)
+
+		saved = await self.keys.find_one_and_replace({'owner': key.owner.id},
+													data,
+													projection={'_id': True},
+													upsert=True,
+													return_document=ReturnDocument.AFTER)
+		key.id = saved['_id']
+		return key
+
+	async def save_user(self, user: UserDoc) -> UserDoc:
+		user.validate()
+		insert_res = await self.users.insert_one(user.to_mongo().to_dict())
+		user.id = insert_res.inserted_id
+		return user
+
+	# Key and its owner in a single round trip.
+	async def get_key_by_value(self, key_value: str) -> StreamKeyDoc:
+		pipeline = [{'$match': {'value': key_value}},
+					{'$limit': 1},
+					{'$lookup': {'from': UserDoc._get_collection_name(),
+								'localField': 'owner',
+								'foreignField': '_id',
+								'as': 'owner_doc'}}]
+
+		docs = await self.keys.aggregate(pipeline).to_list(None)
+		if len(docs) == 0:
+			return None
+
+		owner_docs = docs[0].pop('owner_doc')
+		key = StreamKeyDoc._from_son(docs[0])
+		if len(owner_docs) > 0:
+			key.owner = UserDoc._from_son(owner_docs[0])
+
+		return key
+
+	# Single use keys, the key is matched (unexpired) and invalidated by a
+	# single atomic query, concurrent publishes with the same key can't both
+	# succeed. Returns the owner's username or None if there is no such key.
+	async def claim_key(self, key_value: str) -> str:
+		doc = await self.keys.find_one_and_update(
+			{'value': key_value, 'exp_date': {'$gt': dt.now(UTC)}},
+			{'$set': {'exp_date': None}},
+			projection={'owner': True, 'owner_name': True})
+
+		if doc is None:
+			return None
+
+		if doc.get('owner_name') is not None:
+			return doc['owner_name']
+
+		owner = await self.users.find_one({'_id': doc['owner']}, projection={'username': True})
+		return owner['username'] if owner is not None else None
+
+	async def invalidata_key(self, key: StreamKeyDoc) -> StreamKeyDoc:
+		await self.keys.update_one({'_id': key.id}, {'$set': {'exp_date': None}})
+		key.exp_date = None
+		return key
+
+	async def remove_user_by_username(self, username: str):
+		delete_res = await self.users.delete_one({'username': username})
+		return delete_res.deleted_count
+
+	async def remove_user(self, user: UserDoc):
+		delete_res = await self.users.delete_one({'_id': user.id})
+		return delete_res.deleted_count
+
+	# Both directions, the user's follow records and the records of its
+	# followers.
+	async def remove_follow_rec_for(self, user: UserDoc):
+		delete_res = await self.following.delete_many({'$or': [{'owner_name': user.username},
+															{'following_name': user.username}]})
+		return delete_res.deleted_count
+
+	# Follow records projected to the (denormalized) usernames, owner and
+	# following references are not set on the returned documents.
+	async def find_follow_records(self, query: Dict) -> List[FollowingDoc]:
+		cursor = self.following.find(query, projection=FOLLOW_RECORD_PROJECTION)
+		return [ FollowingDoc._from_son(doc) async for doc in cursor ]
+
+	# Whom the user follows, single query.
+	async def get_following(self, username: str) -> List[FollowingDoc]:
+		return await self.find_follow_records({'owner_name': username})
+
+	# Who follows the user, single query.
+	async def get_followers(self, username: str) -> List[FollowingDoc]:
+		return await self.find_follow_records({'following_name': username})
+
+	async def get_follower_counts(self, usernames: List[str]) -> Dict[str, int]:
+		counts = self.following.aggregate([
+			{'$match': {'following_name': {'$in': usernames}}},
+			{'$group': {'_id': '$following_name', 'count': {'$sum': 1}}}])
+
+		return { c['_id']: c['count'] async for c in counts }
+
+	async def is_following(self, user_tokens_id: str, followed: str) -> bool:
+		return await self.is_following_user(*await self.get_user_and_channel(user_tokens_id, followed))
+
+	async def follow(self, user_tokens_id: str, channel: str) -> FollowingDoc:
+		return await self.follow_user(*await self.get_user_and_channel(user_tokens_id, channel))
+
+	async def unfollow(self, user_tokens_id: str, channel: str):
+		return await self.unfollow_user(*await self.get_user_and_channel(user_tokens_id, channel))
+
+	# Variants taking the already fetched users (see identity_cache.py).
+	async def is_following_user(self, user: UserDoc, followed_user: UserDoc) -> bool:
+		if user is None or followed_user is None:
+			return False
+
+		count = await self.following.count_documents({'owner': user.id,
+													'following': followed_user.id},
+													limit=1)
+		return count > 0
+
+	async def follow_user(self, user: UserDoc, f_channel: UserDoc) -> FollowingDoc:
+		if user is None or f_channel is None:
+			return None
+
+		# Unique (owner, following), following twice returns the existing record.
+		doc = await self.following.find_one_and_update(
+			{'owner': user.id, 'following': f_channel.id},
+			{'$setOnInsert': {'owner_name': user.username,
+							'following_name': f_channel.username,
+							'followed_at': dt.now()}},
+			upsert=True,
+			return_document=ReturnDocument.AFTER)
+
+		record = FollowingDoc._from_son(doc)
+		record.owner = user
+		record.following = f_channel
+		return record
+
+	async def unfollow_user(self, user: UserDoc, f_channel: UserDoc):
+		if user is None or f_channel is None:
+			return 0
+
+		delete_res = await self.following.delete_many({'owner': user.id,
+													'following': f_channel.id})
+		return delete_res.deleted_count
+
+# Exposes the sync users_db functions with the same (awaitable) interface as
+# the AsyncUsersDb, each call is executed in the starlette's threadpool so
+# that at least the event loop is not blocked.
+class ThreadedUsersDb:
+
+	def __init__(self, pool_size: int = 100, wait_timeout: timedelta = None):
+		users_db.connect(pool_size, wait_timeout)
+
+	async def ensure_indexes(self):
+		removed = await run_in_threadpool(bootstrap, get_db())
+		print(f"Indexes verified, removed duplicates: {removed}")
+
+	def close(self):
+		users_db.disconnect()
+
+	def __getattr__(self, name):
+		function = getattr(users_db, name)
+
+		async def threaded_call(*args, **kwargs):
+			return await run_in_threadpool(function, *args, **kwargs)
+
+		return threaded_call
+
+async def open_users_db(config: Config):
+	if config.db_driver == DRIVER_SYNC:
+		db = ThreadedUsersDb(config.db_pool_size, config.db_pool_wait_timeout)
+	else:
+		db = AsyncUsersDb(config.users_db_conn_string,
+						config.db_pool_size,
+						config.db_pool_wait_timeout)
+
+	await db.ensure_indexes()
+	return db
@@ -2,8 +2,15 @@ from mongoengine import Document, StringField, DateTimeField
 from mongoengine import ListField, ReferenceField
 from datetime import datetime
 
+# Indexes are created (and verified) on startup by schema.py, not by
+# mongoengine on the first query.
 class UserDoc(Document):
-	meta={'collection': 'user'}
+	meta={'collection': 'user',
+		'auto_create_index': False,
+		'indexes': [
+			{'fields': ['tokens_id'], 'unique': True, 'sparse': True},
+			{'fields': ['username'], 'unique': True}
+		]}
 
 	tokens_id = StringField()
 	username = StringField(required=True)
@@ -11,18 +18,42 @@ class UserDoc(Document):
 
 
 class StreamKeyDoc(Document):
-	meta = {'collection': 'streamKey'}
+	# Single key per user, regenerated in place (see get_key).
+	meta = {'collection': 'streamKey',
+			'auto_create_index': False,
+			'indexes': [
+				{'fields': ['value'], 'unique': True},
+				{'fields': ['owner'], 'unique': True}
+			]}
 
 	value = StringField(required=True)
 	exp_date = DateTimeField()
 	owner = ReferenceField(UserDoc)
+	# Denormalized owner.username, key validation doesn't have to fetch the
+	# owner (see claim_key). Missing on the keys saved before it was added.
+	owner_name = StringField()
 
 	def is_expired(self) -> bool:
 		return self.exp_date is None or datetime.now() > self.exp_date
 	
+# Follow graph edge, the usernames are denormalized into it so that both
+# "who follows X" and "whom X follows" are answered by a single (covered by
+# an index) query, without dereferencing the users. Usernames can't be
+# changed. Set on insert (see follow_user), backfilled for the older
+# records by schema.py.
 class FollowingDoc(Document):
-	meta = {'collection':'following'}
+	meta = {'collection':'following',
+			'auto_create_index': False,
+			'indexes': [
+				{'fields': ['owner', 'following'], 'unique': True},
+				# whom the user follows
+				{'fields': ['owner_name', 'following_name'], 'unique': True},
+				# followers of a user, follower counts
+				{'fields': ['following_name']}
+			]}
 
 	owner = ReferenceField(UserDoc)
 	following = ReferenceField(UserDoc)
+	owner_name = StringField()
+	following_name = StringField()
 	followed_at = DateTimeField()
@@ -0,0 +1,159 @@
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from datetime import timedelta
+from time import monotonic
+from typing import Awaitable, Callable, Dict, Tuple
+
+from tokens_api.db_model import UserDoc
+
+BY_TOKENS_ID = 'tokens_id'
+BY_USERNAME = 'username'
+
+@dataclass
+class IdentityCacheStats:
+	hits: int = 0
+	misses: int = 0
+	# Lookups that joined an already running query for the same user.
+	coalesced: int = 0
+	evictions: int = 0
+	invalidations: int = 0
+
+# Bounded (LRU) in-process cache of the users, both by the tokens (supertokens)
+# id and by the username, almost every authenticated request maps the session
+# to the user. A fetched user is stored under both keys and invalidated
+# under both. Invalidation also discards the results of the queries already
+# running at that moment, they may have read the old document. Only found
+# (not None) users are cached. Ttl bounds the staleness of the changes made
+# by the other api processes.
+# Used from the event loop only, no locking required.
+class IdentityCache:
+
+	def __init__(self, ttl: timedelta, max_size: int):
+		self.ttl = ttl.total_seconds()
+		self.max_size = max_size
+		# (kind, key) -> (user, expires_at)
+		self.entries: OrderedDict[Tuple[str, str], Tuple[UserDoc, float]] = OrderedDict()
+		self.pending: Dict[Tuple[str, str], asyncio.Future] = {}
+		# Incremented by every invalidation.
+		self.generation = 0
+		self.stats = IdentityCacheStats()
+
+	async def get(self, kind: str, key: str, fetch: Callable[[], Awaitable[UserDoc]]) -> UserDoc:
+		entry_key = (kind, key)
+		entry = self.entries.get(entry_key)
+		if entry is not None:
+			user, expires_at = entry
+			if monotonic() < expires_at:
+				self.entries.move_to_end(entry_key)
+				self.stats.hits += 1
+				return user
+
+			del self.entries[entry_key]
+
+		pending = self.pending.get(entry_key)
+		if pending is not None:
+			self.stats.coalesced += 1
+			return await asyncio.shield(pending)
+
+		self.stats.misses += 1
+		generation = self.generation
+		pending = asyncio.ensure_future(fetch())
+		self.pending[entry_key] = pending
+		pending.add_done_callback(lambda task: self.on_fetched(entry_key, generation, task))
+
+		# Shielded so that one cancelled caller doesn't cancel the query for
+		# the others waiting on it.
+		return await asyncio.shield(pending)
+
+	def on_fetched(self, entry_key: Tuple[str, str], generation: int, task: asyncio.Future):
+		self.pending.pop(entry_key, None)
+
+		if task.cancelled() or task.exception() is not None:
+			return
+
+		if generation == self.generation:
+			self.put(task.result())
+
+	def put(self, user: UserDoc):
+		if user is None:
+			return
+
+		expires_at = monotonic() + self.ttl
+		for entry_key in ((BY_TOKENS_ID, user.tokens_id), (BY_USERNAME, user.username)):
+			self.entries[entry_key] = (user, expires_at)
+			self.entries.move_to_end(entry_key)
+
+		while len(self.entries) > self.max_size:
+			self.entries.popitem(last=False)
+			self.stats.evictions += 1
+
+	# Drops the user under both keys, given either one of them (or both). Has
+	# to be called on sign up, removal and username change.
+	def invalidate(self, tokens_id: str = None, username: str = None):
+		self.generation += 1
+		self.stats.invalidations += 1
+
+		for kind, key in ((BY_TOKENS_ID, tokens_id), (BY_USERNAME, username)):
+			entry = self.entries.pop((kind, key), None)
+			if entry is not None:
+				user = entry[0]
+				self.entries.pop((BY_TOKENS_ID, user.tokens_id), None)
+				self.entries.pop((BY_USERNAME, user.username), None)
+
+	def as_dict(self):
+		lookups = self.stats.hits + self.stats.misses + self.stats.coalesced
+		return {**asdict(self.stats),
+				'hit_ratio': self.stats.hits / lookups if lookups > 0 else 0,
+				'size': len(self.entries),
+				'max_size': self.max_size,
+				'pending': len(self.pending)}
+
+# Users db (AsyncUsersDb or ThreadedUsersDb) with the user lookups served
+# from the IdentityCache, every other call goes straight to the db.
+class CachedUsersDb:
+
+	def __init__(self, db, cache: IdentityCache):
+		self.db = db
+		self.cache = cache
+
+	def __getattr__(self, name):
+		return getattr(self.db, name)
+
+	async def get_user_by_tokens_id(self, id: str) -> UserDoc:
+		return await self.cache.get(BY_TOKENS_ID, id,
+								lambda: self.db.get_user_by_tokens_id(id))
+
+	async def get_user_by_username(self, username: str) -> UserDoc:
+		return await self.cache.get(BY_USERNAME, username,
+								lambda: self.db.get_user_by_username(username))
+
+	async def get_user_and_channel(self, tokens_id: str, channel: str) -> Tuple[UserDoc, UserDoc]:
+		return await asyncio.gather(self.get_user_by_tokens_id(tokens_id),
+									self.get_user_by_username(channel))
+
+	async def is_following(self, user_tokens_id: str, followed: str) -> bool:
+		return await self.db.is_following_user(*await self.get_user_and_channel(user_tokens_id, followed))
+
+	async def follow(self, user_tokens_id: str, channel: str):
+		return await self.db.follow_user(*await self.get_user_and_channel(user_tokens_id, channel))
+
+	async def unfollow(self, user_tokens_id: str, channel: str):
+		return await self.db.unfollow_user(*await self.get_user_and_channel(user_tokens_id, channel))
+
+	async def save_user(self, user: UserDoc) -> UserDoc:
+		saved = await self.db.save_user(user)
+		self.cache.invalidate(user.tokens_id, user.username)
+		return saved
+
+	async def remove_user(self, user: UserDoc):
+		removed = await self.db.remove_user(user)
+		self.cache.invalidate(user.tokens_id, user.username)
+		return removed
+
+	async def remove_user_by_username(self, username: str):
+		# Tokens id entry may outlive the username one (lru).
+		user = await self.get_user_by_username(username)
+		removed = await self.db.remove_user_by_username(username)
+		self.cache.invalidate(user.tokens_id if user is not None else None, username)
+		return removed
@@ -0,0 +1,199 @@
+from argparse import ArgumentParser
+from typing import Dict, List, Tuple
+
+from mongoengine import Document
+from pymongo import IndexModel, MongoClient, UpdateOne
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+
+from config import config
+from tokens_api.db_model import FollowingDoc, UserDoc, StreamKeyDoc
+
+DESCRIPTION = "Creates and verifies the indexes of the tokens_api collections."
+
+MODELS = [ UserDoc, StreamKeyDoc, FollowingDoc ]
+
+# Redundant documents (created before the unique indexes existed) that are
+# removed before creating them, the oldest one is kept. Done only while the
+# unique index is missing (or with --migrate), it's a full collection scan.
+# Duplicate users can't be resolved automatically.
+DEDUPLICATED = [ (StreamKeyDoc, ['owner']),
+				(FollowingDoc, ['owner', 'following']) ]
+
+BACKFILL_BATCH = 1000
+FOLLOW_NAME_FIELDS = ['owner_name', 'following_name']
+
+# Indexes the models used to declare, dropped (by name) by the migration
+# that replaced them. Every index costs a write on every insert.
+REPLACED_INDEXES = [ (FollowingDoc, 'following_1') ] # by following_name_1
+
+INDEX_NOT_FOUND = 27
+
+class SchemaError(Exception):
+	pass
+
+def index_models(model: Document) -> List[IndexModel]:
+	models = []
+	for spec in model._meta['index_specs']:
+		options = { key: value for key, value in spec.items() if key != 'fields' }
+		models.append(IndexModel(spec['fields'], **options))
+
+	return models
+
+def remove_duplicates(database: Database, model: Document, fields: List[str]) -> int:
+	collection = database[model._get_collection_name()]
+	groups = collection.aggregate([
+		{'$group': {'_id': { field: f"${field}" for field in fields },
+					'ids': {'$push': '$_id'},
+					'count': {'$sum': 1}}},
+		{'$match': {'count': {'$gt': 1}}}],
+		allowDiskUse=True)
+
+	redundant = []
+	for group in groups:
+		redundant.extend(sorted(group['ids'])[1:])
+
+	if len(redundant) == 0:
+		return 0
+
+	return collection.delete_many({'_id': {'$in': redundant}}).deleted_count
+
+# Sets the denormalized usernames on the follow records created before they
+# existed. Records of the no longer existing users are removed (they were
+# never returned).
+def backfill_follow_names(database: Database) -> int:
+	following = database[FollowingDoc._get_collection_name()]
+	users = database[UserDoc._get_collection_name()]
+
+	missing = following.find({'$or': [{'owner_name': None}, {'following_name': None}]},
+							projection={'owner': True, 'following': True})
+
+	updated = 0
+	batch = []
+	for doc in missing:
+		batch.append(doc)
+		if len(batch) >= BACKFILL_BATCH:
+			updated += backfill_batch(following, users, batch)
+			batch = []
+
+	if len(batch) > 0:
+		updated += backfill_batch(following, users, batch)
+
+	return updated
+
+def backfill_batch(following: Collection, users: Collection, batch: List[Dict]) -> int:
+	ids = list({ doc.get(field) for doc in batch for field in ('owner', 'following') })
+	names = { doc['_id']: doc['username']
+			for doc in users.find({'_id': {'$in': ids}}, projection={'username': True}) }
+
+	updates = []
+	dangling = []
+	for doc in batch:
+		owner_name = names.get(doc.get('owner'))
+		following_name = names.get(doc.get('following'))
+		if owner_name is None or following_name is None:
+			dangling.append(doc['_id'])
+		else:
+			updates.append(UpdateOne({'_id': doc['_id']},
+									{'$set': {'owner_name': owner_name,
+											'following_name': following_name}}))
+
+	if len(dangling) > 0:
+		following.delete_many({'_id': {'$in': dangling}})
+
+	if len(updates) > 0:
+		following.bulk_write(updates, ordered=False)
+
+	return len(updates)
+
+def unique_index_exists(database: Database, model: Document, fields: List[str]) -> bool:
+	collection = database[model._get_collection_name()]
+	key = [ (field, 1) for field in fields ]
+	return any(list(info['key']) == key and info.get('unique', False)
+				for info in collection.index_information().values())
+
+def drop_replaced_indexes(database: Database) -> List[Tuple[str, str]]:
+	dropped = []
+	for model, name in REPLACED_INDEXES:
+		collection = database[model._get_collection_name()]
+		try:
+			collection.drop_index(name)
+		except OperationFailure as e:
+			# Already dropped (or never created).
+			if e.code != INDEX_NOT_FOUND:
+				raise SchemaError(f"Failed to drop index: {name} on: {collection.name}, reason: {e}")
+
+			continue
+
+		dropped.append((collection.name, name))
+
+	return dropped
+
+# Returns the declared indexes missing (or with different options) in the
+# database as (collection, index name) pairs.
+def verify_indexes(database: Database) -> List[Tuple[str, str]]:
+	missing = []
+	for model in MODELS:
+		collection = database[model._get_collection_name()]
+		existing = { tuple(info['key']): info for info in collection.index_information().values() }
+
+		for index in index_models(model):
+			document = index.document
+			info = existing.get(tuple(document['key'].items()))
+			if info is None or \
+					info.get('unique', False) != document.get('unique', False) or \
+					info.get('sparse', False) != document.get('sparse', False):
+				missing.append((collection.name, document['name']))
+
+	return missing
+
+# Idempotent, run on every api startup (and usable as a migration script).
+# Once the indexes exist it only verifies them, unless migrate is set.
+def bootstrap(database: Database, migrate: bool = False) -> Dict[str, int]:
+	removed = {}
+	for model, fields in DEDUPLICATED:
+		if migrate or not unique_index_exists(database, model, fields):
+			removed[model._get_collection_name()] = remove_duplicates(database, model, fields)
+
+	# Follow names migration, before the (unique) index on the names is created.
+	migrate_names = migrate or not unique_index_exists(database, FollowingDoc, FOLLOW_NAME_FIELDS)
+	if migrate_names:
+		backfilled = backfill_follow_names(database)
+		print(f"Backfilled usernames of {backfilled} follow records.")
+
+	for model in MODELS:
+		collection = database[model._get_collection_name()]
+		try:
+			collection.create_indexes(index_models(model))
+		except OperationFailure as e:
+			raise SchemaError(f"Failed to create indexes on: {collection.name}, reason: {e}")
+
+	# After the replacements are created, no query is left without an index.
+	if migrate_names:
+		dropped = drop_replaced_indexes(database)
+		print(f"Dropped replaced indexes: {dropped}")
+
+	missing = verify_indexes(database)
+	if len(missing) > 0:
+		raise SchemaError(f"Indexes missing after bootstrap: {missing}")
+
+	return removed
+
+def bootstrap_indexes(conn_string: str, migrate: bool = False) -> Dict[str, int]:
+	client = MongoClient(conn_string)
+	try:
+		removed = bootstrap(client.get_default_database(), migrate)
+	finally:
+		client.close()
+
+	print(f"Indexes verified, removed duplicates: {removed}")
+	return removed
+
+if __name__ == '__main__':
+	parser = ArgumentParser(description=DESCRIPTION)
+	parser.add_argument('--url', action='store', default=config.users_db_conn_string)
+	# Deduplicate (and backfill) even if the unique indexes already exist.
+	parser.add_argument('--migrate', action='store_true')
+	args = parser.parse_args()
+	bootstrap_indexes(args.url, args.migrate)
@@ -10,6 +10,7 @@ setup(
                     # 'flask_restful',
 					# 'flask_cors',
 					'mongoengine',
+					'motor',
                     'jsonpickle',
                     'requests',
 					# "Werkzeug==2.2", # required for flask
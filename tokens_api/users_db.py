@@ -1,97 +1,132 @@
-from typing import List
+from typing import Dict, List, Tuple
 import mongoengine
+from mongoengine.queryset.visitor import Q
 from config import config
 from tokens_api.db_model import FollowingDoc, UserDoc, StreamKeyDoc
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta, UTC
 
-def connect():
-	host_url = config.users_db_conn_string
+FOLLOW_RECORD_FIELDS = ['owner_name', 'following_name', 'followed_at']
 
-	mongoengine.connect(host=host_url)
+# Called once on startup, the client holds the connection pool shared by all
+# of the requests. Same options are passed to the async (motor) client, see
+# async_users_db.py.
+def pool_options(pool_size: int, wait_timeout: timedelta):
+	options = {'maxPoolSize': pool_size}
+	if wait_timeout is not None:
+		options['waitQueueTimeoutMS'] = int(wait_timeout.total_seconds()*1000)
 
-# Why are all of these synchronous. ... ... .... ... ... ... ... .
+	return options
+
+def connect(pool_size: int = 100, wait_timeout: timedelta = None):
+	mongoengine.connect(host=config.users_db_conn_string,
+					**pool_options(pool_size, wait_timeout))
+
+def disconnect():
+	mongoengine.disconnect()
 
 def get_user_by_username(username: str)->UserDoc:
-	connect()
 	print(f"Quering user with username: {username}")
 	return UserDoc.objects(username=username).first()
 
 def get_user_by_tokens_id(id: str)->UserDoc:
-	connect()
 	print(f"Quering user with token id: {id}")
 	return UserDoc.objects(tokens_id=id).first()
 
+def get_users_by_usernames(usernames: List[str])->Dict[str, UserDoc]:
+	return { user.username: user for user in UserDoc.objects(username__in=usernames) }
+
+def get_users_by_tokens_ids(ids: List[str])->Dict[str, UserDoc]:
+	return { user.tokens_id: user for user in UserDoc.objects(tokens_id__in=ids) }
+
+def get_user_and_channel(tokens_id: str, channel: str)->Tuple[UserDoc, UserDoc]:
+	return get_user_by_tokens_id(tokens_id), get_user_by_username(channel)
+
 def get_key_for_user(user: UserDoc)->StreamKeyDoc:
-	connect()
 	print(f"Quering stream key for: {user.username}")
 	return StreamKeyDoc.objects(owner=user).first()
 
 def save_key(key: StreamKeyDoc)->StreamKeyDoc:
-	connect()
 	print(f"Saving key for: {key.owner.username}")
 	return key.save()
 
 def save_user(user: UserDoc)->UserDoc:
-	connect()
 	print(f"Saving new user: {user.username}")
 	return user.save()
 
 def get_key_by_value(key_value:str)->StreamKeyDoc:
-	connect()
 	return StreamKeyDoc.objects(value=key_value).first()
 
+# See AsyncUsersDb.claim_key.
+def claim_key(key_value: str)->str:
+	key = StreamKeyDoc.objects(value=key_value, exp_date__gt=dt.now(UTC)) \
+		.modify(set__exp_date=None)
+
+	if key is None:
+		return None
+
+	return key.owner_name if key.owner_name is not None else key.owner.username
+
 def invalidata_key(key: StreamKeyDoc)->StreamKeyDoc:
-	connect()
 	key.exp_date=None
 	return key.save()
 
 def remove_user_by_username(username: str):
-	connect()
 	user = get_user_by_username(username)
 	return user.delete() if user is not None else None
 
 def remove_user(user: UserDoc):
-	connect()
 	return user.delete()
 
+# See AsyncUsersDb.remove_follow_rec_for.
 def remove_follow_rec_for(user:UserDoc):
-	connect()
-	return FollowingDoc.objects(owner=user.id).delete()
+	return FollowingDoc.objects(Q(owner_name=user.username) | 
+							Q(following_name=user.username)).delete()
 
+# See AsyncUsersDb.get_following and get_followers.
 def get_following(username: str)->List[FollowingDoc]:
+	return list(FollowingDoc.objects(owner_name=username).only(*FOLLOW_RECORD_FIELDS))
 
-	connect()
+def get_followers(username: str)->List[FollowingDoc]:
+	return list(FollowingDoc.objects(following_name=username).only(*FOLLOW_RECORD_FIELDS))
 
-	user_doc = get_user_by_username(username)
-	if user_doc is None: 
-		return None
-	
-	return FollowingDoc.objects(owner=user_doc.id)
+def get_follower_counts(usernames: List[str])->Dict[str, int]:
+	counts = FollowingDoc.objects(following_name__in=usernames)\
+		.aggregate([{'$group': {'_id': '$following_name', 'count': {'$sum': 1}}}])
+
+	return { c['_id']: c['count'] for c in counts }
 
 def is_following(user_tokens_id: str, followed:str)->bool:
-	connect()
+	return is_following_user(*get_user_and_channel(user_tokens_id, followed))
+
+def follow(user_tokens_id: str, channel: str)->FollowingDoc: 
+	return follow_user(*get_user_and_channel(user_tokens_id, channel))
+
+def unfollow(user_tokens_id: str, channel: str)->FollowingDoc: 
+	return unfollow_user(*get_user_and_channel(user_tokens_id, channel))
 
-	user = get_user_by_tokens_id(user_tokens_id)
-	if user is None: 
+# Variants taking the already fetched users (see identity_cache.py).
+def is_following_user(user: UserDoc, followed_user: UserDoc)->bool:
+	if user is None or followed_user is None: 
 		return False
-	
-	followed_user = get_user_by_username(followed)
-	if followed_user is None: 
-		return
 
 	follow_doc = FollowingDoc.objects(owner=user.id, following=followed_user.id)
 
 	return  follow_doc is not None and len(follow_doc)>0
 
-def follow(user_tokens_id: str, channel: str)->FollowingDoc: 
-	user = get_user_by_tokens_id(user_tokens_id)
-	f_channel = get_user_by_username(channel)
-
-	record = FollowingDoc(owner=user, following=f_channel, followed_at=dt.now())
-	return record.save()
+def follow_user(user: UserDoc, f_channel: UserDoc)->FollowingDoc: 
+	if user is None or f_channel is None:
+		return None
 
-def unfollow(user_tokens_id: str, channel: str)->FollowingDoc: 
-	user = get_user_by_tokens_id(user_tokens_id)
-	f_channel = get_user_by_username(channel)
+	# Unique (owner, following), following twice returns the existing record.
+	return FollowingDoc.objects(owner=user.id, following=f_channel.id)\
+		.modify(upsert=True, 
+				new=True, 
+				set_on_insert__owner_name=user.username,
+				set_on_insert__following_name=f_channel.username,
+				set_on_insert__followed_at=dt.now())
+
+def unfollow_user(user: UserDoc, f_channel: UserDoc)->FollowingDoc: 
+	if user is None or f_channel is None:
+		return 0
 
 	return FollowingDoc.objects(owner=user.id, following=f_channel.id).delete()
\ No newline at end of file
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+# Run from the project root with PYTHONPATH=.:chat_relay/src
+# Load test for the chat relay backplane (chat_relay/src/backplane.py).
+# Every replica is a separate process running the relay's FanOut and
+# RedisBackplane with fake (counting) websockets, each channel's viewers are
+# split evenly between the replicas and every replica publishes as fast as
+# it can. Cluster throughput is the number of messages delivered to the
+# viewers per second, with the per-replica fan-out work shrinking as
+# replicas are added it should grow linearly with the replica count (as
+# long as there are enough cores and the pub/sub server keeps up).
+# Starts the pub/sub stand-in (pubsub_standin.py) unless --url is provided.
+
+from argparse import ArgumentParser
+import asyncio
+from multiprocessing import Process, Queue
+import os
+import subprocess
+import sys
+from time import perf_counter, sleep, time
+
+from backplane import RedisBackplane
+from fanout import FanOut, BatchConfig, POLICY_DROP_OLDEST
+
+DESCRIPTION = "Measures chat throughput for different numbers of relay replicas."
+
+STANDIN_PORT = 6390
+SEND_QUEUE_SIZE = 256
+BATCH_WINDOW = 0.005
+BATCH_SIZE = 100
+# Published messages between two yields to the writers.
+PUBLISH_BURST = 20
+# Fake viewers don't opt in for batched frames.
+FANOUT_BATCHING = BatchConfig(window=0.075, size=50, hot_rate=20)
+
+def setup_arg_parser():
+	parser = ArgumentParser(description=DESCRIPTION)
+	parser.add_argument('--url', action='store', default=None)
+	parser.add_argument('--replicas', action='store', default='1,2,4')
+	parser.add_argument('--channels', action='store', default='4')
+	# Per channel, split between the replicas.
+	parser.add_argument('--viewers', action='store', default='400')
+	parser.add_argument('--duration', action='store', default='5')
+
+	return parser.parse_args()
+
+class CountingSocket:
+
+	def __init__(self):
+		self.received = 0
+
+	async def send_text(self, payload: str):
+		self.received += 1
+
+	async def close(self, code: int = 1000):
+		pass
+
+async def run_replica(url: str, ind: int, channels: int, viewers: int,
+					start_at: float, duration: float, results: Queue):
+
+	fanout = FanOut(SEND_QUEUE_SIZE, POLICY_DROP_OLDEST, FANOUT_BATCHING)
+	backplane = RedisBackplane(url, BATCH_WINDOW, BATCH_SIZE)
+
+	def deliver(channel, payloads):
+		for payload in payloads:
+			fanout.publish(channel, payload)
+
+	await backplane.start(deliver)
+
+	names = [ f"channel-{c}" for c in range(channels) ]
+	sockets = []
+	for channel in names:
+		backplane.subscribe(channel)
+		for viewer in range(viewers):
+			socket = CountingSocket()
+			sockets.append(socket)
+			fanout.join(channel, socket, f"viewer-{ind}-{viewer}")
+
+	await asyncio.sleep(max(0, start_at - time()))
+
+	published = 0
+	deadline = perf_counter() + duration
+	while perf_counter() < deadline:
+		for _ in range(PUBLISH_BURST):
+			channel = names[published % channels]
+			payload = f'{{"sender":"replica-{ind}","type":"text","txtContent":"msg {published}"}}'
+			fanout.publish(channel, payload)
+			backplane.publish(channel, payload)
+			published += 1
+
+		await asyncio.sleep(0)
+
+	delivered = sum(socket.received for socket in sockets)
+	stats = backplane.as_dict()
+	dropped = sum(channel['dropped'] for channel in fanout.as_dict()['channels'].values())
+	await backplane.stop()
+
+	results.put({'published': published,
+				'received': stats['received'],
+				'delivered': delivered,
+				'dropped': dropped})
+
+def replica_process(*args):
+	asyncio.run(run_replica(*args))
+
+def measure(url: str, replicas: int, channels: int, viewers: int, duration: float):
+	results = Queue()
+	start_at = time() + 2 # connect and subscribe first
+	procs = [ Process(target=replica_process,
+					args=(url, ind, channels, viewers // replicas,
+						start_at, duration, results))
+			for ind in range(replicas) ]
+
+	for proc in procs:
+		proc.start()
+
+	totals = {'published': 0, 'received': 0, 'delivered': 0, 'dropped': 0}
+	for _ in procs:
+		for key, value in results.get().items():
+			totals[key] += value
+
+	for proc in procs:
+		proc.join()
+
+	return totals
+
+if __name__ == '__main__':
+	args = setup_arg_parser()
+	duration = float(args.duration)
+
+	standin = None
+	url = args.url
+	if url is None:
+		url = f"redis://localhost:{STANDIN_PORT}"
+		standin = subprocess.Popen([sys.executable, 'utils/bench/pubsub_standin.py',
+								'--port', str(STANDIN_PORT)], env=os.environ)
+		sleep(1)
+
+	print(f"{os.cpu_count()} cores, pub/sub at: {url}")
+	try:
+		for replicas in map(int, args.replicas.split(',')):
+			totals = measure(url, replicas, int(args.channels), int(args.viewers), duration)
+			print(f"{replicas:>3} replicas: "
+				f"published {totals['published'] / duration:10.0f}/s  "
+				f"cross-node {totals['received'] / duration:10.0f}/s  "
+				f"delivered {totals['delivered'] / duration:12.0f}/s  "
+				f"dropped {totals['dropped']}")
+	finally:
+		if standin is not None:
+			standin.terminate()
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+# Run from the project root with PYTHONPATH=.:chat_relay/src
+# Compares the json chat frames with the compact encoding
+# (chat_relay/src/compact.py): bytes on the wire and encode/decode cpu time
+# per message, for single message frames and batches (as sent by the
+# relay's batching writer). Messages are the bot chatter's, sent by a
+# configurable number of distinct senders.
+
+from argparse import ArgumentParser
+from json import dumps, loads
+from random import Random
+from time import perf_counter
+
+from compact import SenderTable, SenderNames, encode_body, decode_client_body
+from utils.bots.messages import messages
+
+DESCRIPTION = "Measures bytes and cpu time per chat message of the json and the compact encoding."
+
+def setup_arg_parser():
+	parser = ArgumentParser(description=DESCRIPTION)
+	parser.add_argument('--messages', action='store', default='100000')
+	parser.add_argument('--senders', action='store', default='50')
+	parser.add_argument('--batch', action='store', default='1,20')
+	parser.add_argument('--seed', action='store', default='1')
+
+	return parser.parse_args()
+
+def generate(count: int, senders: int, seed: int):
+	rand = Random(seed)
+	return [ {'sender': f"viewer_{rand.randrange(senders)}",
+			'type': 'text',
+			'txtContent': rand.choice(messages)}
+			for _ in range(count) ]
+
+def batches(items, size: int):
+	return [ items[ind:ind + size] for ind in range(0, len(items), size) ]
+
+def serialize_json(msg: dict) -> str:
+	return dumps(msg, separators=(",", ":"), ensure_ascii=False)
+
+# Server serializes every message once, the frame is built from the
+# serialized payloads, clients parse the frames.
+def bench_json(msgs, batch: int):
+	start = perf_counter()
+	payloads = [ serialize_json(msg) for msg in msgs ]
+	if batch == 1:
+		frames = payloads
+	else:
+		frames = [ '[' + ','.join(group) + ']' for group in batches(payloads, batch) ]
+	encode_time = perf_counter() - start
+
+	start = perf_counter()
+	for frame in frames:
+		loads(frame)
+	decode_time = perf_counter() - start
+
+	size = sum(len(frame.encode()) for frame in frames)
+	return size, encode_time, decode_time
+
+# Bodies are encoded once, records (sender ids) per connection.
+def bench_compact(msgs, batch: int):
+	start = perf_counter()
+	bodies = [ (msg['sender'], encode_body(msg['type'], msg['txtContent'])) for msg in msgs ]
+	senders = SenderTable()
+	frames = [ b''.join(senders.encode(*body) for body in group)
+			for group in batches(bodies, batch) ]
+	encode_time = perf_counter() - start
+
+	start = perf_counter()
+	names = SenderNames()
+	for frame in frames:
+		names.decode(frame)
+	decode_time = perf_counter() - start
+
+	size = sum(len(frame) for frame in frames)
+	return size, encode_time, decode_time
+
+# Messages sent by the clients, parsed by the relay.
+def bench_receive(msgs):
+	json_frames = [ serialize_json(msg) for msg in msgs ]
+	compact_frames = [ encode_body(msg['type'], msg['txtContent']) for msg in msgs ]
+
+	start = perf_counter()
+	for frame in json_frames:
+		loads(frame)
+	json_time = perf_counter() - start
+
+	start = perf_counter()
+	for frame in compact_frames:
+		decode_client_body(frame)
+	compact_time = perf_counter() - start
+
+	return (sum(len(frame.encode()) for frame in json_frames), json_time,
+			sum(len(frame) for frame in compact_frames), compact_time)
+
+def report(name: str, count: int, size: int, encode_time: float, decode_time: float):
+	print(f"  {name:<8} {size / count:8.1f} B/msg  "
+		f"encode {encode_time / count * 1e9:8.0f} ns/msg  "
+		f"decode {decode_time / count * 1e9:8.0f} ns/msg")
+
+if __name__ == '__main__':
+	args = setup_arg_parser()
+	count = int(args.messages)
+	msgs = generate(count, int(args.senders), int(args.seed))
+
+	print(f"{count} messages from {args.senders} senders")
+	for batch in map(int, args.batch.split(',')):
+		print(f"relay -> client, {batch} message(s) per frame")
+		report('json', count, *bench_json(msgs, batch))
+		report('compact', count, *bench_compact(msgs, batch))
+
+	json_size, json_time, compact_size, compact_time = bench_receive(msgs)
+	print("client -> relay")
+	print(f"  {'json':<8} {json_size / count:8.1f} B/msg  parse {json_time / count * 1e9:8.0f} ns/msg")
+	print(f"  {'compact':<8} {compact_size / count:8.1f} B/msg  parse {compact_time / count * 1e9:8.0f} ns/msg")
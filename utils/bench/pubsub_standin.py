@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+# Run from the project root with PYTHONPATH=.
+# Minimal stand-in for the redis pub/sub used by the chat relay backplane
+# (chat_relay/src/backplane.py), speaks just enough of the protocol:
+# SUBSCRIBE, UNSUBSCRIBE, PUBLISH and PING.
+
+from argparse import ArgumentParser
+import asyncio
+from typing import Dict, Set
+
+from chat_relay.src.backplane import encode_command, read_reply
+
+DESCRIPTION = "Redis protocol compatible pub/sub stand-in."
+
+def setup_arg_parser():
+	parser = ArgumentParser(description=DESCRIPTION)
+	parser.add_argument('--port', action='store', default='6379')
+
+	return parser.parse_args()
+
+def encode_push(*args) -> bytes:
+	parts = [ b"*%d\r\n" % len(args) ]
+	for arg in args:
+		if isinstance(arg, int):
+			parts.append(b":%d\r\n" % arg)
+		else:
+			parts.append(encode_command(arg)[len(b"*1\r\n"):])
+
+	return b''.join(parts)
+
+class PubSub:
+
+	def __init__(self):
+		self.subscribers: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+
+	async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		subscribed: Set[bytes] = set()
+		try:
+			while True:
+				command = await read_reply(reader)
+				name = command[0].upper()
+
+				if name == b'SUBSCRIBE':
+					for channel in command[1:]:
+						subscribed.add(channel)
+						self.subscribers.setdefault(channel, set()).add(writer)
+						writer.write(encode_push(b'subscribe', channel, len(subscribed)))
+
+				elif name == b'UNSUBSCRIBE':
+					for channel in command[1:]:
+						subscribed.discard(channel)
+						self.subscribers.get(channel, set()).discard(writer)
+						writer.write(encode_push(b'unsubscribe', channel, len(subscribed)))
+
+				elif name == b'PUBLISH':
+					channel, data = command[1], command[2]
+					receivers = self.subscribers.get(channel, set())
+					message = encode_push(b'message', channel, data)
+					for receiver in receivers:
+						receiver.write(message)
+
+					writer.write(b":%d\r\n" % len(receivers))
+
+				elif name == b'PING':
+					writer.write(b"+PONG\r\n")
+
+				else:
+					writer.write(b"-ERR unknown command\r\n")
+
+				await writer.drain()
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		finally:
+			for channel in subscribed:
+				self.subscribers.get(channel, set()).discard(writer)
+
+			writer.close()
+
+async def serve(port: int):
+	pubsub = PubSub()
+	server = await asyncio.start_server(pubsub.handle, '0.0.0.0', port)
+	print(f"Pub/sub stand-in listening on: {port}")
+
+	async with server:
+		await server.serve_forever()
+
+if __name__ == '__main__':
+	args = setup_arg_parser()
+	asyncio.run(serve(int(args.port)))
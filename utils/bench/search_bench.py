@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+# Run from the project root with PYTHONPATH=.
+# Compares registry's search index (stream_registry/src/search_index.py) with
+# the linear substring scan equivalent to the old $indexOfCP query.
+
+from argparse import ArgumentParser
+from random import randrange, seed
+from statistics import median
+from time import perf_counter
+
+from stream_registry.src.search_index import SearchIndex
+
+DESCRIPTION = "Measures stream search latency for different stream counts."
+
+WORDS = ['chess', 'music', 'live', 'coding', 'art', 'gaming', 'talk',
+		'speedrun', 'painting', 'science', 'late', 'night', 'chill', 'ranked']
+
+# Same as the frontend's page size.
+PAGE = 20
+
+QUERIES = ['streamer-4242', 'streamer-1', 'speedrun', 'night chill', 'ch', 'xyz']
+
+def setup_arg_parser():
+	parser = ArgumentParser(description=DESCRIPTION)
+	parser.add_argument('--sizes', action='store', default='10000,100000,1000000')
+	parser.add_argument('--repeat', action='store', default='20')
+
+	return parser.parse_args()
+
+def gen_title(ind: int):
+	return " ".join(WORDS[randrange(0, len(WORDS))] for _ in range(3)) + f" #{ind}"
+
+def gen_streams(count: int):
+	return [ (f"streamer-{ind}", gen_title(ind)) for ind in range(count) ]
+
+def scan(streams, query: str):
+	query = query.lower()
+	return [ creator for creator, title in streams
+			if query in creator.lower() or query in title.lower() ]
+
+def measure(func, repeat: int):
+	times = []
+	for _ in range(repeat):
+		start = perf_counter()
+		result = func()
+		times.append((perf_counter() - start) * 1000)
+
+	return median(times), len(result)
+
+if __name__ == '__main__':
+	args = setup_arg_parser()
+	seed(42)
+
+	for size in map(int, args.sizes.split(',')):
+		streams = gen_streams(size)
+
+		start = perf_counter()
+		index = SearchIndex()
+		for creator, title in streams:
+			index.add(creator, title)
+		print(f"=== {size} streams, index built in: {perf_counter() - start:.1f}s")
+
+		for query in QUERIES:
+			index_ms, index_cnt = measure(lambda: index.search(query, limit=PAGE), 
+										int(args.repeat))
+			scan_ms, scan_cnt = measure(lambda: scan(streams, query), 3)
+
+			print(f"{query:>15}: index {index_ms:9.3f}ms (first {index_cnt})"
+				f"  scan {scan_ms:9.3f}ms ({scan_cnt} hits, unranked)")
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+
+# Run from the project root with PYTHONPATH=.
+# Compares registry's thumbnail generators (stream_registry/src/thumbnails.py
+# and stream_registry/src/local_preview.py): ffmpeg subprocess pulling the
+# preview hls (through the cdn if --url is provided) and the in-process
+# decode of the newest local preview segment.
+
+from argparse import ArgumentParser
+import asyncio
+import os
+from datetime import timedelta
+from statistics import median
+from time import perf_counter
+
+from stream_registry.src.local_preview import LocalPreview, PLAYLIST_NAME
+from stream_registry.src.thumbnails import FfmpegPull
+
+DESCRIPTION = "Measures thumbnail generation latency of the ffmpeg pull and the local preview decode."
+
+def setup_arg_parser():
+	parser = ArgumentParser(description=DESCRIPTION)
+	parser.add_argument('--preview-dir', action='store', default='/var/www/preview')
+	parser.add_argument('--stream', action='store', required=True)
+	# Preview hls url served by the cdn, local playlist is pulled if missing
+	# (measures just the subprocess and decoder start-up then).
+	parser.add_argument('--url', action='store', default=None)
+	parser.add_argument('--repeat', action='store', default='20')
+
+	return parser.parse_args()
+
+async def measure(func, repeat: int):
+	times = []
+	size = 0
+	for _ in range(repeat):
+		start = perf_counter()
+		data = await func()
+		times.append((perf_counter() - start) * 1000)
+
+		if data is None:
+			print("Generation failed.")
+			return None, None, 0
+
+		size = len(data)
+
+	return median(times), max(times), size
+
+async def main(args):
+	repeat = int(args.repeat)
+
+	local = LocalPreview(args.preview_dir)
+	pull = FfmpegPull(timedelta(seconds=30))
+
+	url = args.url
+	if url is None:
+		url = os.path.join(args.preview_dir, args.stream, PLAYLIST_NAME)
+
+	results = {
+		'local_preview': await measure(
+			lambda: asyncio.to_thread(local.grab, args.stream), repeat),
+		'ffmpeg_pull': await measure(lambda: pull.pull(url), repeat)
+	}
+
+	for name, (median_ms, max_ms, size) in results.items():
+		if median_ms is None:
+			print(f"{name:>15}: failed")
+		else:
+			print(f"{name:>15}: median {median_ms:9.3f}ms  max {max_ms:9.3f}ms  ({size}B jpeg)")
+
+if __name__ == '__main__':
+	asyncio.run(main(setup_arg_parser()))
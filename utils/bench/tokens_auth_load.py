@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+# Run from the project root with PYTHONPATH=.:tokens_api
+# Load test for the tokens_api users db (tokens_api/async_users_db.py).
+# Runs the lookup done by every authorized request (user by tokens id) from
+# concurrent tasks, the way concurrent requests run on the api's event loop:
+#   blocking - sync users_db called on the event loop (how the handlers
+#              used to call it)
+#   threaded - sync users_db through the threadpool (sync driver)
+#   motor    - AsyncUsersDb (motor driver)
+# Seeds --users users (tokens_id bench-<n>) unless they already exist,
+# --cleanup removes them afterwards.
+# With --inmemory a throwaway mongod is started through pymongo_inmemory
+# (downloads the mongod binary on the first run) instead of using --url.
+
+from argparse import ArgumentParser
+import asyncio
+from contextlib import redirect_stdout
+import os
+from random import randrange
+from statistics import median
+from time import perf_counter
+
+import users_db
+from async_users_db import AsyncUsersDb, ThreadedUsersDb
+from config import config
+from tokens_api.db_model import UserDoc
+
+DESCRIPTION = "Measures tokens_api auth lookup throughput of the sync and the async users db."
+
+TOKENS_ID_PREFIX = 'bench-'
+INMEMORY_DB = 'session_auth_bench'
+SEED_BATCH = 10000
+
+def setup_arg_parser():
+	parser = ArgumentParser(description=DESCRIPTION)
+	parser.add_argument('--url', action='store', default=config.users_db_conn_string)
+	parser.add_argument('--users', action='store', default='10000')
+	parser.add_argument('--concurrency', action='store', default='1,10,100')
+	parser.add_argument('--requests', action='store', default='5000')
+	parser.add_argument('--pool-size', action='store', default='100')
+	parser.add_argument('--cleanup', action='store_true')
+	parser.add_argument('--inmemory', action='store_true')
+
+	return parser.parse_args()
+
+def tokens_id(ind: int) -> str:
+	return f"{TOKENS_ID_PREFIX}{ind}"
+
+def seed(users: int):
+	collection = UserDoc._get_collection()
+	existing = collection.count_documents({'tokens_id': {'$regex': f"^{TOKENS_ID_PREFIX}"}})
+	for start in range(existing, users, SEED_BATCH):
+		collection.insert_many([ {'tokens_id': tokens_id(ind),
+								'username': f"bench_user_{ind}",
+								'email': f"bench_user_{ind}@mail.com"}
+								for ind in range(start, min(users, start + SEED_BATCH)) ])
+
+async def blocking_lookup(id: str):
+	return users_db.get_user_by_tokens_id(id)
+
+async def run(lookup, users: int, concurrency: int, requests: int):
+	latencies = []
+	remaining = requests
+
+	async def worker():
+		nonlocal remaining
+		while remaining > 0:
+			remaining -= 1
+			start = perf_counter()
+			user = await lookup(tokens_id(randrange(users)))
+			latencies.append((perf_counter() - start) * 1000)
+			if user is None:
+				raise RuntimeError("Seeded user not found.")
+
+	start = perf_counter()
+	await asyncio.gather(*[ worker() for _ in range(concurrency) ])
+	elapsed = perf_counter() - start
+
+	latencies.sort()
+	return requests / elapsed, median(latencies), latencies[int(len(latencies) * 0.99)]
+
+async def main(args):
+	users = int(args.users)
+	requests = int(args.requests)
+	pool_size = int(args.pool_size)
+
+	config.users_db_conn_string = args.url
+	threaded = ThreadedUsersDb(pool_size)
+	seed(users)
+
+	motor = AsyncUsersDb(args.url, pool_size)
+	drivers = [ ('blocking', blocking_lookup),
+				('threaded', threaded.get_user_by_tokens_id),
+				('motor', motor.get_user_by_tokens_id) ]
+
+	for concurrency in map(int, args.concurrency.split(',')):
+		print(f"concurrency {concurrency}")
+		for name, lookup in drivers:
+			# Sync users_db logs every query.
+			with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+				throughput, p50, p99 = await run(lookup, users, concurrency, requests)
+
+			print(f"  {name:<9} {throughput:9.0f} req/s  p50 {p50:7.2f} ms  p99 {p99:7.2f} ms")
+
+	if args.cleanup:
+		UserDoc._get_collection().delete_many({'tokens_id': {'$regex': f"^{TOKENS_ID_PREFIX}"}})
+
+	motor.close()
+	threaded.close()
+
+if __name__ == '__main__':
+	args = setup_arg_parser()
+	if args.inmemory:
+		import pymongo_inmemory
+		with pymongo_inmemory.Mongod(None) as mongod:
+			args.url = f"{mongod.connection_string}/{INMEMORY_DB}"
+			asyncio.run(main(args))
+	else:
+		asyncio.run(main(args))
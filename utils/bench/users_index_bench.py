@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+# Run from the project root with PYTHONPATH=.:tokens_api
+# Lookup latency of the tokens_api hot queries without and with the indexes
+# declared in tokens_api/db_model.py (created by tokens_api/schema.py).
+# Seeds --users users, as many stream keys and --follows follow records
+# into a separate (bench) database, which is dropped afterwards unless
+# --keep is provided.
+# With --inmemory a throwaway mongod is started through pymongo_inmemory
+# (downloads the mongod binary on the first run) instead of using --url.
+
+from argparse import ArgumentParser
+from random import randrange
+from statistics import median
+from time import perf_counter
+
+from bson import ObjectId
+from pymongo import MongoClient
+
+from schema import bootstrap
+from tokens_api.db_model import FollowingDoc, UserDoc, StreamKeyDoc
+
+DESCRIPTION = "Measures tokens_api lookup latency with and without the indexes."
+
+SEED_BATCH = 10000
+
+def setup_arg_parser():
+	parser = ArgumentParser(description=DESCRIPTION)
+	parser.add_argument('--url', action='store', default='mongodb://localhost:27017')
+	parser.add_argument('--db', action='store', default='session_auth_bench')
+	parser.add_argument('--users', action='store', default='1000000')
+	parser.add_argument('--follows', action='store', default='1000000')
+	# Collection scans at 1M documents take a while.
+	parser.add_argument('--samples', action='store', default='50')
+	parser.add_argument('--keep', action='store_true')
+	parser.add_argument('--inmemory', action='store_true')
+
+	return parser.parse_args()
+
+def seed(database, users: int, follows: int):
+	users_col = database[UserDoc._get_collection_name()]
+	keys_col = database[StreamKeyDoc._get_collection_name()]
+	follow_col = database[FollowingDoc._get_collection_name()]
+
+	ids = []
+	for start in range(0, users, SEED_BATCH):
+		batch = [ {'_id': ObjectId(),
+				'tokens_id': f"tokens-{ind}",
+				'username': f"user_{ind}",
+				'email': f"user_{ind}@mail.com"}
+				for ind in range(start, min(users, start + SEED_BATCH)) ]
+
+		users_col.insert_many(batch, ordered=False)
+		keys_col.insert_many([ {'value': f"key{ind:010d}", 'owner': user['_id']}
+							for ind, user in enumerate(batch, start) ], ordered=False)
+		ids.extend(user['_id'] for user in batch)
+
+	# (owner, following) pairs are unique, following is owner + offset.
+	def follow_rec(owner: int, following: int):
+		return {'owner': ids[owner],
+				'following': ids[following],
+				'owner_name': f"user_{owner}",
+				'following_name': f"user_{following}"}
+
+	for start in range(0, follows, SEED_BATCH):
+		follow_col.insert_many([ follow_rec(ind % users, (ind % users + 1 + ind // users) % users)
+								for ind in range(start, min(follows, start + SEED_BATCH)) ],
+								ordered=False)
+
+	return ids
+
+def queries(database, ids, users: int):
+	users_col = database[UserDoc._get_collection_name()]
+	keys_col = database[StreamKeyDoc._get_collection_name()]
+	follow_col = database[FollowingDoc._get_collection_name()]
+
+	def user_ind():
+		return randrange(users)
+
+	return [
+		('user by tokens_id', lambda: users_col.find_one({'tokens_id': f"tokens-{user_ind()}"})),
+		('user by username', lambda: users_col.find_one({'username': f"user_{user_ind()}"})),
+		('key by value (match_key)', lambda: keys_col.find_one({'value': f"key{user_ind():010d}"})),
+		('key by owner (get_key)', lambda: keys_col.find_one({'owner': ids[user_ind()]})),
+		('follow by (owner, following)', lambda: (lambda ind: follow_col.find_one(
+			{'owner': ids[ind], 'following': ids[(ind + 1) % users]}))(user_ind())),
+		('whom user follows', lambda: list(follow_col.find({'owner_name': f"user_{user_ind()}"},
+														{'_id': False, 'following_name': True}))),
+		('followers of user', lambda: list(follow_col.find({'following_name': f"user_{user_ind()}"},
+														{'_id': False, 'owner_name': True}))),
+		('follower count', lambda: follow_col.count_documents({'following_name': f"user_{user_ind()}"})),
+	]
+
+def measure(query, samples: int):
+	times = []
+	for _ in range(samples):
+		start = perf_counter()
+		query()
+		times.append((perf_counter() - start) * 1000)
+
+	times.sort()
+	return median(times), times[int(len(times) * 0.99)]
+
+def report(database, ids, users: int, samples: int):
+	for name, query in queries(database, ids, users):
+		p50, p99 = measure(query, samples)
+		print(f"  {name:<30} p50 {p50:9.3f} ms  p99 {p99:9.3f} ms")
+
+if __name__ == '__main__':
+	args = setup_arg_parser()
+	users = int(args.users)
+	samples = int(args.samples)
+
+	if args.inmemory:
+		import pymongo_inmemory
+		# Stops the mongod on close.
+		client = pymongo_inmemory.MongoClient()
+	else:
+		client = MongoClient(args.url)
+
+	client.drop_database(args.db)
+	database = client[args.db]
+
+	print(f"Seeding {users} users and keys, {args.follows} follows ...")
+	ids = seed(database, users, int(args.follows))
+
+	print("without indexes")
+	report(database, ids, users, samples)
+
+	start = perf_counter()
+	bootstrap(database)
+	print(f"with indexes (bootstrap took {perf_counter() - start:.1f} s)")
+	report(database, ids, users, samples)
+
+	if not args.keep:
+		client.drop_database(args.db)
+
+	client.close()